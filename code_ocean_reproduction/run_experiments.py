@@ -20,6 +20,8 @@ data_dir = f"data_{timenow}" ##datasets to be unzipped here
 os.mkdir(data_dir)
 output_dir = f"results_{timenow}" ### result tables will be saved here in .csv format
 os.mkdir(output_dir)
+resume_dir = None ### set to the output_dir of an interrupted run to skip the experiments it already finished
+store_dir = resume_dir if resume_dir else output_dir ### finished experiments are appended here as they complete
 
 #function to auto download data
 auto_download = False # set to True to auto-download
@@ -36,13 +38,9 @@ if auto_download:
 # @title load libraries
 # <editor-fold desc="load libraries">
 
-#set to true to install torchmetrics if using google colab
-using_google_colab = False
+#set to true to mount google drive if using google colab
 using_google_drive = False
 
-if using_google_colab:
-  !pip install torchmetrics
-
 if using_google_drive:
   from google.colab import drive
   drive.mount('/content/drive')
@@ -53,13 +51,19 @@ import os
 import pandas as pd
 import torch
 import torch.nn as nn
-import torchmetrics
 import json
 from itertools import product
+from collections import OrderedDict
 from datetime import date, datetime
 import time
+import copy
+import tempfile
+import threading
+import queue
 import random
 import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import matplotlib.pyplot as plt
 import matplotlib
@@ -95,21 +99,249 @@ def rec_listdir(dir):
     return paths
 
 
-def compute_metrics(yhat, y):
-    y = torch.squeeze(y).to('cpu')
-    yhat = torch.squeeze(yhat).to('cpu')
-    num_classes = y.shape[1]
-    y = torch.argmax(y, dim=1)
-    yhat_argmax = torch.argmax(yhat, dim=1)
-    auc = torchmetrics.AUROC(task="multiclass", num_classes=num_classes, average="macro")(yhat, y)
-    acc = torchmetrics.Accuracy(task="multiclass", num_classes=num_classes, average="macro")(yhat_argmax, y)
-    recall = torchmetrics.Recall(task="multiclass", num_classes=num_classes, average="macro")(yhat_argmax, y)
-    prec = torchmetrics.Precision(task="multiclass", num_classes=num_classes, average="macro")(yhat_argmax, y)
-    f1 = torchmetrics.F1Score(task="multiclass", num_classes=num_classes, average="macro")(yhat_argmax, y)
+'''
+metric engine for macro AUROC, accuracy, recall, precision and F1 (same definitions as the torchmetrics
+multiclass metrics). All five come from one confusion matrix and one sorted pass over the scores.
+yhat may carry leading model dimensions (..., n, n_classes), in which case every model is scored at once.
+stacked=True keeps a leading model dimension even for a single model, so metrics are always (models, 5).
+update() can be called batch by batch, so predictions never need to be concatenated.
+thresholds=None keeps the scores for an exact AUROC, an integer number of thresholds bins the scores
+into histograms instead, so memory stays constant. as in torchmetrics, a model's scores are treated as logits
+(and softmaxed) when any of its scores over all updates lies outside [0, 1], so the binned path keeps
+histograms of both the raw and the softmaxed scores and picks one in compute()
+'''
+class MetricAccumulator:
+    def __init__(self, num_classes, thresholds=None, stacked=False):
+        self.num_classes = num_classes
+        self.thresholds = thresholds
+        self.stacked = stacked
+        self.confusion = 0  # (..., true class, predicted class)
+        self.scores = []
+        self.labels = []
+        self.pos_hist = 0  # (raw or softmaxed, ..., class, bin)
+        self.neg_hist = 0
+        self.outside = False  # (...) whether a model had scores outside [0, 1]
+
+    def update(self, yhat, y):
+        num_classes = self.num_classes
+        y = y.detach().reshape(-1, num_classes)
+        n = y.shape[0]
+        yhat = yhat.detach().to(y.device)
+        if self.stacked:
+            yhat = yhat.reshape(-1, n, num_classes)
+        elif yhat.numel() == n * num_classes:
+            yhat = yhat.reshape(n, num_classes)
+        elif yhat.shape[-2] != n:
+            yhat = yhat.reshape(-1, n, num_classes)
+        lead_shape = yhat.shape[:-2]
+        n_models = lead_shape.numel()
+        y_idx = torch.argmax(y, dim=1)
+
+        # confusion matrix for every model with one bincount
+        yhat_idx = torch.argmax(yhat, dim=-1).reshape(n_models, n)
+        model_offset = torch.arange(n_models, device=y.device)[:, None] * num_classes ** 2
+        flat_idx = model_offset + y_idx * num_classes + yhat_idx
+        confusion = torch.bincount(flat_idx.flatten(), minlength=n_models * num_classes ** 2)
+        self.confusion = self.confusion + confusion.reshape(lead_shape + (num_classes, num_classes))
+
+        # whether scores are logits is decided in compute(), over every update
+        self.outside = self.outside | ((yhat < 0) | (yhat > 1)).flatten(start_dim=-2).any(dim=-1)
+        if self.thresholds is None:
+            self.scores.append(yhat)
+            self.labels.append(y_idx)
+        else:
+            scores = torch.stack([yhat, torch.softmax(yhat, dim=-1)])
+            bins = torch.clamp((scores * self.thresholds).long(), min=0, max=self.thresholds - 1)
+            is_pos = nn.functional.one_hot(y_idx, num_classes).bool()
+            self.pos_hist = self.pos_hist + self._histogram(bins, is_pos, self.thresholds)
+            self.neg_hist = self.neg_hist + self._histogram(bins, ~is_pos, self.thresholds)
+
+    @staticmethod
+    def _histogram(group_idx, mask, n_groups):
+        # counts of masked entries per (..., class, group), group_idx is (..., n, n_classes)
+        mask = mask.expand(group_idx.shape).transpose(-1, -2)
+        group_idx = group_idx.transpose(-1, -2)
+        n_rows = group_idx.shape[:-1].numel()
+        row_offset = torch.arange(n_rows, device=group_idx.device).reshape(group_idx.shape[:-1] + (1,)) * n_groups
+        counts = torch.bincount((group_idx + row_offset).flatten(),
+                                weights=mask.flatten().float(),
+                                minlength=n_rows * n_groups)
+        return counts.reshape(group_idx.shape[:-1] + (n_groups,))
+
+    def _exact_histograms(self):
+        # one sort per class, tied scores share a group so that they count as half
+        scores = torch.concatenate(self.scores, dim=-2)
+        outside = torch.as_tensor(self.outside, device=scores.device)
+        scores = torch.where(outside[..., None, None], torch.softmax(scores, dim=-1), scores)
+        y_idx = torch.concatenate(self.labels)
+        n = scores.shape[-2]
+        scores_sorted, order = torch.sort(scores, dim=-2)
+        is_pos = nn.functional.one_hot(y_idx, self.num_classes).bool()
+        is_pos = torch.gather(is_pos.expand(scores.shape), dim=-2, index=order)
+        new_group = scores_sorted[..., 1:, :] != scores_sorted[..., :-1, :]
+        group_idx = torch.concatenate([torch.zeros_like(new_group[..., :1, :]), new_group], dim=-2)
+        group_idx = group_idx.long().cumsum(dim=-2)
+        pos_hist = self._histogram(group_idx, is_pos, n)
+        neg_hist = self._histogram(group_idx, ~is_pos, n)
+        return pos_hist, neg_hist
+
+    def compute(self):
+        confusion = self.confusion.double()
+        tp = torch.diagonal(confusion, dim1=-2, dim2=-1)
+        fn = confusion.sum(dim=-1) - tp
+        fp = confusion.sum(dim=-2) - tp
+
+        def safe_divide(a, b):
+            return torch.where(b > 0, a / torch.clamp(b, min=1), torch.zeros_like(a))
+
+        # macro average over classes that occur in targets or predictions
+        weights = ((tp + fp + fn) > 0).double()
+
+        def macro(score):
+            return safe_divide((score * weights).sum(dim=-1), weights.sum(dim=-1))
+
+        recall = macro(safe_divide(tp, tp + fn))
+        prec = macro(safe_divide(tp, tp + fp))
+        f1 = macro(safe_divide(2 * tp, 2 * tp + fp + fn))
+        acc = recall
+
+        # AUROC as the Mann-Whitney statistic over ascending score groups
+        if self.thresholds is None:
+            pos_hist, neg_hist = self._exact_histograms()
+        else:
+            outside = torch.as_tensor(self.outside, device=self.pos_hist.device)[..., None, None]
+            pos_hist = torch.where(outside, self.pos_hist[1], self.pos_hist[0])
+            neg_hist = torch.where(outside, self.neg_hist[1], self.neg_hist[0])
+        pos_hist = pos_hist.double()
+        neg_hist = neg_hist.double()
+        neg_below = torch.cumsum(neg_hist, dim=-1) - neg_hist
+        n_pos = pos_hist.sum(dim=-1)
+        n_neg = neg_hist.sum(dim=-1)
+        auc = safe_divide((pos_hist * (neg_below + 0.5 * neg_hist)).sum(dim=-1), n_pos * n_neg)
+        auc = auc.mean(dim=-1)
+
+        out = torch.stack([auc, acc, recall, prec, f1], dim=-1)
+
+        return out.float().to('cpu')
 
-    out = torch.stack([auc, acc, recall, prec, f1])
 
-    return out
+def compute_metrics(yhat, y, thresholds=None):
+    num_classes = y.shape[-1]
+    metric_accumulator = MetricAccumulator(num_classes=num_classes, thresholds=thresholds)
+    metric_accumulator.update(yhat, y)
+    return metric_accumulator.compute()
+
+
+'''
+run predict_fn once over the rows of x in batches and stream the predictions into one metric accumulator per split.
+split_masks maps split names to boolean masks or index tensors over the rows of x,
+e.g. {"train": folds != fold, "val": folds == fold}, and a dictionary of metrics is returned.
+Rows outside every split are skipped. Without split_masks the metrics over all rows are returned. stacked predictions
+are (models, rows, classes), giving metrics of shape (models, 5) per split, also for a single model
+'''
+def evaluate_splits(predict_fn, x, y, split_masks=None, batch_size=1000, stacked=False):
+    if split_masks is None:
+        data = as_split(x, y)
+        metric_accumulator = MetricAccumulator(num_classes=data.num_classes, stacked=stacked)
+        for x_i, y_i in BatchProducer(data, batch_size):
+            metric_accumulator.update(predict_fn(x_i), y_i)
+        return metric_accumulator.compute()
+
+    data = as_split(x, y)
+    n_rows = len(data)
+
+    # boolean masks for every split, and their union
+    masks = {}
+    for split_name, mask in split_masks.items():
+        mask = torch.as_tensor(mask, device="cpu")
+        if mask.dtype != torch.bool:
+            idx = mask
+            mask = torch.zeros(n_rows, dtype=torch.bool)
+            mask[idx] = True
+        masks[split_name] = mask
+    union = torch.stack(list(masks.values())).any(dim=0)
+
+    # only the rows of the union are gathered, batch by batch, and the masks are taken over those rows
+    if not union.all():
+        data = data.subset(torch.where(union)[0])
+        masks = {split_name: mask[union] for split_name, mask in masks.items()}
+
+    metric_accumulators = {split_name: MetricAccumulator(num_classes=data.num_classes, stacked=stacked)
+                           for split_name in masks}
+    start = 0
+    for x_i, y_i in BatchProducer(data, batch_size):
+        yhat_i = predict_fn(x_i)
+        for split_name, mask in masks.items():
+            mask_i = mask[start:start + len(y_i)].to(y_i.device)
+            if mask_i.any():
+                yhat_mask_i = yhat_i[:, mask_i] if stacked else yhat_i[mask_i]
+                metric_accumulators[split_name].update(yhat_mask_i, y_i[mask_i])
+        start += len(y_i)
+
+    return {split_name: metric_accumulators[split_name].compute() for split_name in masks}
+
+
+'''
+apply stacked layer weights w (models, in, out) to x. x is (n, ..., in) when all models share it (the input of the
+first layer), otherwise (models * n, ..., in) with the rows of each model together. returns (models * n, ..., out)
+'''
+def stacked_linear(x, w, shared):
+    n_models = w.shape[0]
+    if shared:
+        out = x.reshape(1, -1, x.shape[-1]) @ w
+        return out.reshape((n_models * x.shape[0],) + x.shape[1:-1] + (w.shape[-1],))
+    out = x.reshape(n_models, -1, x.shape[-1]) @ w
+    return out.reshape(x.shape[:-1] + (w.shape[-1],))
+
+
+'''
+group the w_lists whose layers have the same shapes and stack their weights. returns a list of
+(indices of the w_lists, list of stacked (models, in, out) layer weights)
+'''
+def stack_w_lists(w_lists):
+    groups = {}
+    for i, w_list in enumerate(w_lists):
+        groups.setdefault(tuple(tuple(w.shape) for w in w_list), []).append(i)
+    return [(idx, [torch.stack([w_lists[i][l].to(device) for i in idx]) for l in range(len(w_lists[idx[0]]))])
+            for idx in groups.values()]
+
+
+'''
+evaluate many w_lists on the same data in one pass over x. w_lists with the same layer shapes are stacked and
+predicted together by predict_stacked (a predict_forward_*_stacked function, called with predict_kwargs), so each
+layer is unfolded once for all of them. returns a list with the metrics of each w_list (a dictionary of metrics per
+split when split_masks are given, see evaluate_splits), or its predictions over x if return_predictions
+'''
+def evaluate_forward_stacked(x,
+                             y,
+                             w_lists,
+                             predict_stacked,
+                             batch_size=1000,
+                             split_masks=None,
+                             return_predictions=False,
+                             **predict_kwargs,
+                             ):
+    groups = stack_w_lists(w_lists)
+    order = [i for idx, _ in groups for i in idx]
+
+    def predict_fn(x_i):
+        return torch.concatenate([predict_stacked(x_i, w_stack, **predict_kwargs) for _, w_stack in groups])
+
+    if return_predictions:
+        yhat = torch.concatenate([predict_fn(x_i) for x_i, _ in BatchProducer(as_split(x, y), batch_size)], dim=1)
+        out = list(yhat)
+    else:
+        metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size, stacked=True)
+        if split_masks is None:
+            out = list(metrics)
+        else:
+            out = [{split_name: metrics[split_name][k] for split_name in metrics} for k in range(len(order))]
+
+    # back to the order of w_lists
+    results = [None] * len(w_lists)
+    for k, i in enumerate(order):
+        results[i] = out[k]
+    return results
 
 
 def expand_grid(dictionary):
@@ -117,6 +349,119 @@ def expand_grid(dictionary):
                         columns=dictionary.keys())
 
 
+'''
+experiment grid runner. every grid row is passed to experiment_fn as keyword arguments, and the returned
+dict (merged with the row) is appended to store_file as one json line as soon as the row finishes, so a
+crashed run loses at most the rows in flight. rows whose key is already in store_file are skipped.
+on cpu the rows run across n_workers forked processes (which share the loaded data copy-on-write), each
+limited to threads_per_worker torch threads so the workers do not oversubscribe the cores.
+on cuda/mps, or with n_workers=1, the rows run one after another in this process.
+each row is seeded with seed + its row number, so results do not depend on the order rows finish in.
+experiment_fn may return None to skip a row; skipped rows are not stored and are retried on restart.
+settings holds the fixed (module level) settings experiment_fn reads besides the row, e.g. hidden_dim. they are
+part of every row's key, so a store written under other settings is not reused
+'''
+n_grid_workers = 1 # processes used for cpu experiment grids
+grid_threads_per_worker = None # torch threads per process, None splits the cores evenly between processes
+
+
+def to_builtin(value):
+    if isinstance(value, (torch.Tensor, np.generic)):
+        return value.item()
+    return value
+
+
+def grid_key(row, settings=None):
+    key = {k: to_builtin(v) for k, v in row.items()}
+    if settings:
+        key["settings"] = {k: to_builtin(v) for k, v in settings.items()}
+    return json.dumps(key, sort_keys=True)
+
+
+def read_grid_store(store_file):
+    completed = {}
+    if os.path.exists(store_file):
+        with open(store_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # last line of a run that was killed mid-write
+                    continue
+                completed[record.pop("grid_key")] = record
+    return completed
+
+
+grid_state = {} # experiment_fn and rows of the running grid, inherited by forked workers instead of pickled
+
+
+def init_grid_worker(threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+
+
+def run_grid_row(i, seed):
+    row = grid_state["rows"][i]
+    random.seed(seed)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    out = grid_state["experiment_fn"](**row)
+    if out is None:
+        return None
+    return {k: to_builtin(v) for k, v in {**row, **out}.items()}
+
+
+def run_experiment_grid(experiment_fn,
+                        grid,
+                        store_file,
+                        n_workers=None,
+                        threads_per_worker=None,
+                        seed=0,
+                        device=device,
+                        settings=None):
+    n_workers = n_grid_workers if n_workers is None else n_workers
+    threads_per_worker = grid_threads_per_worker if threads_per_worker is None else threads_per_worker
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+    rows = grid.to_dict("records")
+    keys = [grid_key(row, settings) for row in rows]
+    completed = read_grid_store(store_file)
+    pending = [i for i in range(len(rows)) if keys[i] not in completed]
+    if len(pending) < len(rows):
+        print(f"{len(rows) - len(pending)} of {len(rows)} experiments already in {store_file}")
+    grid_state.update(experiment_fn=experiment_fn, rows=rows)
+
+    with open(store_file, "a") as store:
+        if store.tell() > 0:
+            with open(store_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b"\n":  # start a new line after a partly written record
+                    store.write("\n")
+
+        def save(i, out):
+            if out is None:
+                print(f"experiment {i} skipped")
+                return
+            completed[keys[i]] = out
+            store.write(json.dumps({"grid_key": keys[i], **out}) + "\n")
+            store.flush()
+
+        if n_workers <= 1 or device != "cpu" or len(pending) <= 1:
+            for i in pending:
+                print(i)
+                save(i, run_grid_row(i, seed + i))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context("fork"),
+                                     initializer=init_grid_worker,
+                                     initargs=(threads_per_worker,)) as pool:
+                futures = {pool.submit(run_grid_row, i, seed + i): i for i in pending}
+                for future in as_completed(futures):
+                    print(futures[future])
+                    save(futures[future], future.result())
+
+    return pd.DataFrame([completed[key] for key in keys if key in completed])
+
+
 def standardise_fn(x, dim=0):
     x_ = torch.clone(x.detach())
     mu = x_.mean(dim=dim, keepdims=True)
@@ -166,12 +511,48 @@ if not os.path.exists("tables"):
 
 
 
-def load_dataset(dataset_i, data_dir=data_dir, channels_last=True):
+'''
+dataset cache shared by all experiment sections. the first load of a dataset converts its .npz to float32 .npy
+files in data_dir/npy_cache, after which every load memory-maps those files copy-on-write, so nothing is
+decompressed or converted again and forked grid workers read the same pages. loaded tensors are kept in
+dataset_cache (least recently used first out) until they exceed dataset_cache_max_bytes.
+the returned tensors are shared between callers and must not be modified in place
+'''
+dataset_cache = OrderedDict()
+dataset_cache_max_bytes = 16 * 1024 ** 3
+
+
+def dataset_npy_files(dataset_i, data_dir=data_dir):
     output_name = os.path.join(data_dir, f"{dataset_i}_data.npz")
-    if not os.path.exists(output_name):
-        raise FileNotFoundError(f"Dataset {dataset_i} not found in {output_name}")
-    npzfile = np.load(output_name)
-    X_trainval, Y_trainval, X_test, Y_test, folds =  [torch.tensor(npzfile[i], dtype=torch.float32, device=device) for i in npzfile.files]
+    cache_dir = os.path.join(data_dir, "npy_cache")
+    names_file = os.path.join(cache_dir, f"{dataset_i}_arrays.json")
+    if not os.path.exists(names_file):
+        if not os.path.exists(output_name):
+            raise FileNotFoundError(f"Dataset {dataset_i} not found in {output_name}")
+        os.makedirs(cache_dir, exist_ok=True)
+        npzfile = np.load(output_name)
+        for name in npzfile.files:
+            npy_file = os.path.join(cache_dir, f"{dataset_i}_{name}.npy")
+            np.save(npy_file + ".tmp.npy", npzfile[name].astype(np.float32))
+            os.replace(npy_file + ".tmp.npy", npy_file)
+        # written last, marks the conversion as complete
+        with open(names_file, "w") as f:
+            json.dump(npzfile.files, f)
+    with open(names_file) as f:
+        names = json.load(f)
+    return [os.path.join(cache_dir, f"{dataset_i}_{name}.npy") for name in names]
+
+
+def load_dataset(dataset_i, data_dir=data_dir, channels_last=True):
+    cache_key = (dataset_i, data_dir, device)
+    if cache_key in dataset_cache:
+        dataset_cache.move_to_end(cache_key)
+    else:
+        arrays = [np.load(npy_file, mmap_mode="c") for npy_file in dataset_npy_files(dataset_i, data_dir)]
+        dataset_cache[cache_key] = [torch.from_numpy(array).to(device) for array in arrays]
+        while len(dataset_cache) > 1 and sum(t.nbytes for v in dataset_cache.values() for t in v) > dataset_cache_max_bytes:
+            dataset_cache.popitem(last=False)
+    X_trainval, Y_trainval, X_test, Y_test, folds = dataset_cache[cache_key]
     if not channels_last:
         permute_dims = (0, -1) + tuple(range(1, X_trainval.ndim - 1))
         X_trainval = torch.permute(X_trainval, dims=permute_dims)
@@ -180,17 +561,228 @@ def load_dataset(dataset_i, data_dir=data_dir, channels_last=True):
     return X_trainval, Y_trainval, X_test, Y_test, folds
 
 
+def fold_indices(folds, fold):
+    train_idx = torch.where(folds != fold)[0]
+    val_idx = torch.where(folds == fold)[0]
+    return train_idx, val_idx
+
+
+'''
+a split of a dataset kept as row indices into the full x and y tensors, so fold splits and few-shot subsamples
+cost an index array instead of a copy of the data. rows are gathered one batch at a time, when the batch is used.
+trainers and evaluators accept a DataSplit in place of x, in which case y is taken from the split (pass y=None)
+'''
+class DataSplit:
+    def __init__(self, x, y, idx=None):
+        self.x = x
+        self.y = y
+        # row indices are kept on the cpu, indexing a gpu tensor with them gathers on the gpu
+        self.idx = torch.arange(len(x)) if idx is None else torch.as_tensor(idx, device="cpu")
+        self.whole = idx is None  # every row in order, batches are views of x
+
+    def __len__(self):
+        return len(self.idx)
+
+    @property
+    def shape(self):
+        return (len(self.idx),) + tuple(self.x.shape[1:])
+
+    @property
+    def ndim(self):
+        return self.x.ndim
+
+    @property
+    def num_classes(self):
+        return self.y.shape[-1]
+
+    def subset(self, idx):
+        # idx indexes the rows of this split
+        return DataSplit(self.x, self.y, self.idx[torch.as_tensor(idx, device="cpu")])
+
+    def transpose(self, dim0, dim1):
+        # transposes a view of the full x, the row dimension must stay first
+        return DataSplit(self.x.transpose(dim0, dim1), self.y, self.idx)
+
+    def permute(self, *dims):
+        # permutes a view of the full x, the row dimension must stay first
+        return DataSplit(self.x.permute(*dims), self.y, self.idx)
+
+    def labels(self):
+        return self.y[self.idx]
+
+    def gather(self):
+        return self.x[self.idx], self.y[self.idx]
+
+    def batch_indices(self, batch_size, shuffle=False):
+        # the shuffle is drawn when this is called
+        idx = self.idx[torch.randperm(len(self.idx))] if shuffle else self.idx
+        return torch.split(idx, batch_size)
+
+    def batches(self, batch_size, shuffle=False):
+        if self.whole and not shuffle:
+            yield from zip(torch.split(self.x, batch_size), torch.split(self.y, batch_size))
+            return
+        for idx_i in self.batch_indices(batch_size, shuffle=shuffle):
+            yield self.x[idx_i], self.y[idx_i]
+
+    def batch_lists(self, batch_size, shuffle=False):
+        x_batches, y_batches = [], []
+        for x_i, y_i in self.batches(batch_size, shuffle=shuffle):
+            x_batches.append(x_i)
+            y_batches.append(y_i)
+        return x_batches, y_batches
+
+    def n_batches(self, batch_size):
+        return -(-len(self.idx) // batch_size)
+
+    @staticmethod
+    def concatenate(splits):
+        if all(split.x is splits[0].x and split.y is splits[0].y for split in splits):
+            return DataSplit(splits[0].x, splits[0].y, torch.concatenate([split.idx for split in splits]))
+        x, y = zip(*[split.gather() for split in splits])
+        return DataSplit(torch.concatenate(x), torch.concatenate(y))
+
+
+def as_split(x, y=None):
+    if isinstance(x, DataSplit):
+        return x
+    return DataSplit(x, y)
+
+
+batch_prefetch = 2 # batches gathered ahead of the training loop by a background thread, 0 gathers them in the loop
+batch_pin_memory = True # pin cpu batches when a cuda device is available, so their copies are asynchronous
+
+
+def prefetch_batches(batches, n_prefetch):
+    '''runs a batch iterator in a background thread, up to n_prefetch batches ahead of the consumer'''
+    buffer = queue.Queue(maxsize=n_prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for batch in batches:
+                while not stop.is_set():
+                    try:
+                        buffer.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            buffer.put(done)
+        except Exception as e:
+            buffer.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = buffer.get()
+            if batch is done:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        # a consumer that stops early releases the producer
+        stop.set()
+
+
+'''
+iterates the (x, y) batches of a DataSplit on the device. rows are gathered by index, so shuffling never copies
+the whole dataset, and the shuffle is drawn when iteration starts, in the calling thread, so random number use
+is the same with or without prefetching. with prefetch > 0 a background thread gathers (and pins, for cpu data
+a cuda device) the next batches while the current one is used, and copies to the device are then asynchronous.
+transform(x_i) is applied on the device, e.g. a fused augmentation and normalisation from batch_transform.
+device=None leaves batches where the data is, e.g. for batch lists that are moved to the device layer by layer.
+memory_format (e.g. torch.channels_last) is the layout image batches are given in
+'''
+class BatchProducer:
+    def __init__(self, data, batch_size, shuffle=False, prefetch=None, pin_memory=None, transform=None,
+                 device=device, memory_format=None):
+        self.data = as_split(data)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.prefetch = batch_prefetch if prefetch is None else prefetch
+        self.device = device
+        pin_memory = batch_pin_memory if pin_memory is None else pin_memory
+        self.pin_memory = pin_memory and torch.cuda.is_available() and self.data.x.device.type == "cpu"
+        self.transform = transform
+        self.memory_format = memory_format
+
+    def __len__(self):
+        return self.data.n_batches(self.batch_size)
+
+    def gather(self, idx_batches):
+        data = self.data
+        if idx_batches is None:
+            batches = zip(torch.split(data.x, self.batch_size), torch.split(data.y, self.batch_size))
+        else:
+            batches = ((data.x[idx_i], data.y[idx_i]) for idx_i in idx_batches)
+        for x_i, y_i in batches:
+            if self.pin_memory:
+                x_i, y_i = x_i.pin_memory(), y_i.pin_memory()
+            yield x_i, y_i
+
+    def __iter__(self):
+        # whole splits in order are batched as views, otherwise rows are gathered by index
+        idx_batches = None
+        if not (self.data.whole and not self.shuffle):
+            idx_batches = self.data.batch_indices(self.batch_size, self.shuffle)
+        batches = self.gather(idx_batches)
+        if self.prefetch > 0:
+            batches = prefetch_batches(batches, self.prefetch)
+        for x_i, y_i in batches:
+            if self.device is not None:
+                x_i = x_i.to(self.device, non_blocking=self.pin_memory)
+                y_i = y_i.to(self.device, non_blocking=self.pin_memory)
+            if self.transform is not None:
+                x_i = self.transform(x_i)
+            if self.memory_format is not None and x_i.ndim == 4:
+                # a no-op for batches gathered from channels-last data
+                x_i = x_i.contiguous(memory_format=self.memory_format)
+            yield x_i, y_i
+
+    def lists(self):
+        '''every batch at once, as lists of x and y batches'''
+        x_batches, y_batches = [], []
+        for x_i, y_i in self:
+            x_batches.append(x_i)
+            y_batches.append(y_i)
+        return x_batches, y_batches
+
+
+def batch_transform(mean=None, std=None, flip_dims=None):
+    '''
+    one function applying random flips along flip_dims (each sample flipped with probability 0.5 per dimension)
+    and normalisation by mean and std (broadcastable to a batch), for BatchProducer
+    '''
+    def transform(x_i):
+        if flip_dims:
+            for dim in flip_dims:
+                flip = torch.rand(len(x_i), device=x_i.device) < 0.5
+                flip = flip.view((-1,) + (1,) * (x_i.ndim - 1))
+                x_i = torch.where(flip, x_i.flip(dim), x_i)
+        if mean is not None:
+            x_i = x_i - torch.as_tensor(mean, device=x_i.device, dtype=x_i.dtype)
+        if std is not None:
+            x_i = x_i / torch.as_tensor(std, device=x_i.device, dtype=x_i.dtype)
+        return x_i
+    return transform
+
+
 def subsample_dataset(x, y, n_sample):
+    data = as_split(x, y)
+    labels = data.labels()
     idx = []
-    for i in range(y.shape[1]):
-        idx_i = torch.where(y[:, i] == 1)[0]
+    for i in range(labels.shape[1]):
+        idx_i = torch.where(labels[:, i] == 1)[0]
         idx_i = idx_i[torch.randperm(len(idx_i))[:n_sample]]
         idx.append(idx_i)
     idx = torch.concatenate(idx)
-    x = x[idx]
-    y = y[idx]
 
-    return x, y
+    return data.subset(idx)
 
 #@title activation functions
 # <editor-fold desc="Activation Functions">
@@ -221,24 +813,347 @@ forward_activations = list(activation_dict.keys())
 # <editor-fold desc="Forward mlp training and evaluation functions">
 
 '''Ridge regression function to fit weights'''
-def ridge_regression_w(x, y, reg_factor=10, flatten=True, device=device):
+def ridge_regression_w(x, y, reg_factor=10, flatten=True, device=device, solver=None):
     if flatten:
         x = x.reshape((-1, x.shape[-1]))
         y = y.reshape((-1, y.shape[-1]))
 
-    gram_mat = (x.T @ x)
-    gram_mat += torch.eye(gram_mat.shape[0], device=device) * reg_factor
-    try:
-        gram_inv = torch.inverse(gram_mat)
-    except:
-        gram_inv = torch.eye(gram_mat.shape[0], device=device)
-    w_hat = gram_inv @ (x.T @ y)
+    w_hat = ridge_regression_batches([x], [y], reg_factor=reg_factor, solver=solver, device=device)
 
     if flatten:
         w_hat = torch.unsqueeze(w_hat, dim=0)
     return w_hat
 
 
+'''
+precision policies for the ridge statistics. input_dtype is the dtype of the batch matmuls, accum_dtype the dtype
+of the running gram and cross product sums (kahan compensated if compensated), solve_dtype the dtype of the
+regularised inverse. block_rows splits a batch into row blocks whose products are summed at accum_dtype, so
+low precision matmul outputs never sum over more than block_rows rows
+'''
+ridge_precision_dict = {"float32": dict(input_dtype=torch.float32, accum_dtype=torch.float32, compensated=False,
+                                        solve_dtype=torch.float32, block_rows=None),
+                        "float64": dict(input_dtype=torch.float32, accum_dtype=torch.float64, compensated=False,
+                                        solve_dtype=torch.float64, block_rows=None),
+                        "bfloat16": dict(input_dtype=torch.bfloat16, accum_dtype=torch.float32, compensated=True,
+                                         solve_dtype=torch.float64, block_rows=4096),
+                        }
+ridge_precision = "float32" # default policy of RidgeAccumulator
+ridge_report_drift = False # also accumulate a float64 reference and print the weight drift at solve()
+
+
+'''
+streamed ridge regression. update() adds the gram matrix x.T @ x and the cross product x.T @ z of one batch
+(all leading dimensions are rows, scaled by reduce_factor), so the rows of a layer never need to be held at once.
+solve() regularises the gram matrix and returns the weight matrix in the dtype of the first batch.
+precision names a policy in ridge_precision_dict, report_drift solves a float64 reference alongside and keeps the
+relative (frobenius) weight difference in self.drift
+'''
+class RidgeAccumulator:
+    def __init__(self, reduce_factor=1, device=device, precision=None, report_drift=None):
+        self.reduce_factor = reduce_factor
+        self.device = device
+        self.precision = precision if precision else ridge_precision
+        self.policy = ridge_precision_dict[self.precision]
+        self.report_drift = ridge_report_drift if report_drift is None else report_drift
+        # mps has no float64, so float64 sums and solves run on the cpu there
+        self.float64_device = "cpu" if device == "mps" else device
+        self.gram_mat = 0
+        self.xt_z = 0
+        self.compensation = None
+        self.reference = None
+        self.out_dtype = None
+        self.drift = None
+
+    def accumulate_device(self, dtype):
+        return self.float64_device if dtype == torch.float64 else self.device
+
+    def products(self, x_i, z_i, input_dtype, accum_dtype, block_rows=None):
+        x_i = x_i.to(input_dtype)
+        z_i = z_i.to(input_dtype)
+        if block_rows is None or len(x_i) <= block_rows:
+            gram_i = (x_i.T @ x_i).to(accum_dtype)
+            xt_z_i = (x_i.T @ z_i).to(accum_dtype)
+        else:
+            gram_i = 0
+            xt_z_i = 0
+            for j in range(0, len(x_i), block_rows):
+                x_j = x_i[j:j + block_rows]
+                gram_i = gram_i + (x_j.T @ x_j).to(accum_dtype)
+                xt_z_i = xt_z_i + (x_j.T @ z_i[j:j + block_rows]).to(accum_dtype)
+        if self.reduce_factor != 1:
+            gram_i *= self.reduce_factor
+            xt_z_i *= self.reduce_factor
+        return gram_i, xt_z_i
+
+    def update(self, x_i, z_i):
+        if self.out_dtype is None:
+            self.out_dtype = x_i.dtype
+        x_i = x_i.reshape(-1, x_i.shape[-1])
+        z_i = z_i.reshape(-1, z_i.shape[-1])
+        accum_dtype = self.policy["accum_dtype"]
+        accum_device = self.accumulate_device(accum_dtype)
+        gram_i, xt_z_i = self.products(x_i.to(accum_device), z_i.to(accum_device),
+                                       self.policy["input_dtype"], accum_dtype, self.policy["block_rows"])
+
+        if not self.policy["compensated"]:
+            self.gram_mat = self.gram_mat + gram_i
+            self.xt_z = self.xt_z + xt_z_i
+        elif self.compensation is None:
+            self.gram_mat, self.xt_z = gram_i, xt_z_i
+            self.compensation = [torch.zeros_like(gram_i), torch.zeros_like(xt_z_i)]
+        else:
+            # kahan summation: carry the low order bits lost by each addition into the next batch
+            sums = [self.gram_mat, self.xt_z]
+            for k, term in enumerate([gram_i, xt_z_i]):
+                term = term - self.compensation[k]
+                total = sums[k] + term
+                self.compensation[k] = (total - sums[k]) - term
+                sums[k] = total
+            self.gram_mat, self.xt_z = sums
+
+        if self.report_drift:
+            ref_gram, ref_xt_z = self.products(x_i.to(self.float64_device), z_i.to(self.float64_device),
+                                               torch.float64, torch.float64)
+            if self.reference is None:
+                self.reference = [ref_gram, ref_xt_z]
+            else:
+                self.reference = [self.reference[0] + ref_gram, self.reference[1] + ref_xt_z]
+
+    def solve_stats(self, gram_mat, xt_z, reg_factor, dtype):
+        solve_device = self.accumulate_device(dtype)
+        gram_mat = gram_mat.to(solve_device, dtype)
+        gram_mat = gram_mat + torch.eye(gram_mat.shape[0], device=solve_device, dtype=dtype) * reg_factor
+        try:
+            gram_inv = torch.inverse(gram_mat)
+        except:
+            print("singular gram matrix, consider increasing regularisation factor")
+            gram_inv = torch.eye(gram_mat.shape[0], device=solve_device, dtype=dtype)
+        return gram_inv @ xt_z.to(solve_device, dtype)
+
+    def solve(self, reg_factor=10.):
+        w_hat = self.solve_stats(self.gram_mat, self.xt_z, reg_factor, self.policy["solve_dtype"])
+        if self.report_drift:
+            w_ref = self.solve_stats(*self.reference, reg_factor, torch.float64)
+            self.drift = (torch.linalg.norm(w_hat.to(w_ref) - w_ref) / torch.linalg.norm(w_ref)).item()
+            print(f"ridge weight drift ({self.precision} vs float64): {self.drift:.3e}")
+        return w_hat.to(self.device, self.out_dtype)
+
+
+'''
+ridge solvers for a layer: "gram" accumulates and inverts the full gram matrix, "cg" never forms it (see
+ridge_regression_cg), "dual" inverts the rows x rows kernel matrix instead (see ridge_regression_dual). "auto" picks
+dual when there are fewer rows (samples, or patches for conv layers) than features and their kernel matrix fits in
+memory, cg when the gram matrix does not fit, and gram otherwise (see ridge_matrix_fits). rank, tol and max_iter of
+cg trade accuracy against passes over the batches
+'''
+ridge_solver = "gram"
+ridge_memory_fraction = 0.5 # share of the free device memory an n x n ridge system may take under "auto"
+ridge_cg_options = dict(rank=128, tol=1e-5, max_iter=200)
+
+
+def available_memory(device=device):
+    '''free memory of the device in bytes, inf when it cannot be queried'''
+    if torch.device(device).type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, AttributeError, OSError):
+        return float("inf")
+
+
+def ridge_matrix_fits(n, device=device):
+    '''
+    whether an n x n ridge system fits in ridge_memory_fraction of the free memory: the summed matrix, its
+    regularised copy and its inverse, at the wider of the accumulation and solve dtypes of ridge_precision
+    '''
+    policy = ridge_precision_dict[ridge_precision]
+    itemsize = max(policy["accum_dtype"].itemsize, policy["solve_dtype"].itemsize)
+    return 3 * n * n * itemsize <= ridge_memory_fraction * available_memory(device)
+
+
+'''
+solver for layer l when solvers is a per-layer list, otherwise solvers itself (None uses ridge_solver)
+'''
+def layer_solver(solvers, l):
+    if isinstance(solvers, (list, tuple)):
+        return solvers[l]
+    return solvers
+
+
+def resolve_ridge_solver(n_features, solver=None, n_rows=None, device=device):
+    solver = solver if solver else ridge_solver
+    if solver == "auto":
+        if n_rows is not None and n_rows < n_features and ridge_matrix_fits(n_rows, device):
+            solver = "dual"
+        elif not ridge_matrix_fits(n_features, device):
+            solver = "cg"
+        else:
+            solver = "gram"
+    return solver
+
+
+'''
+number of rows of a list of batches (all leading dimensions are rows)
+'''
+def batch_rows(x_batches):
+    return sum(x_i.numel() // x_i.shape[-1] for x_i in x_batches)
+
+
+'''
+product of the (reduce_factor scaled) gram matrix of the batches with v, one pass over the batches. the batch
+matmuls run in the batch dtype, the sum in the dtype of v
+'''
+def gram_matvec(x_batches, v, reduce_factor=1, device=device):
+    out = torch.zeros_like(v)
+    for x_i in x_batches:
+        x_i = x_i.to(device).reshape(-1, x_i.shape[-1])
+        out += (x_i.T @ (x_i @ v.to(x_i.dtype))).to(v.dtype)
+    if reduce_factor != 1:
+        out *= reduce_factor
+    return out
+
+
+'''
+ridge regression by conjugate gradients with a randomised nystrom preconditioner (frangella, tropp & udell 2021).
+the gram matrix is only touched through gram_matvec, so memory is O(features x (rank + targets)) and each cg
+iteration is one pass over the batches. the first pass also sketches the gram matrix with rank random directions
+(seeded by seed), whose eigendecomposition preconditions the system. iterates until the relative residual of every
+target column is below tol or max_iter passes. the sketch factorisation and the cg vectors are float64 (float32 on
+mps), the passes over the batches stay in the batch dtype
+'''
+def ridge_regression_cg(x_batches, z_batches, reg_factor=10., reduce_factor=1, rank=128, tol=1e-5, max_iter=200,
+                        seed=0, device=device):
+    dtype = torch.float32 if device == "mps" else torch.float64
+    tiny = torch.finfo(dtype).tiny
+    n_features = x_batches[0].shape[-1]
+    rank = min(rank, n_features)
+    # own generator, so the choice of solver leaves the projection matrices of later layers unchanged
+    generator = torch.Generator(device=device).manual_seed(seed)
+    omega = torch.randn((n_features, rank), device=device, generator=generator)
+    omega = torch.linalg.qr(omega.to(dtype)).Q
+
+    # sketch and cross product in one pass
+    sketch = gram_matvec(x_batches, omega, device=device)
+    xt_z = 0
+    for x_i, z_i in zip(x_batches, z_batches):
+        x_i = x_i.to(device).reshape(-1, x_i.shape[-1])
+        z_i = z_i.to(device).reshape(-1, z_i.shape[-1])
+        xt_z = xt_z + (x_i.T @ z_i).to(dtype)
+    if reduce_factor != 1:
+        sketch *= reduce_factor
+        xt_z *= reduce_factor
+
+    # nystrom approximation u diag(lam) u.T of the gram matrix, shifted by nu for a stable cholesky factor
+    nu = torch.finfo(x_batches[0].dtype).eps * torch.linalg.norm(sketch)
+    sketch = sketch + nu * omega
+    chol = torch.linalg.cholesky(omega.T @ sketch)
+    b = torch.linalg.solve_triangular(chol, sketch.T, upper=False).T
+    u, s, _ = torch.linalg.svd(b, full_matrices=False)
+    lam = torch.clamp(s ** 2 - nu, min=0)
+
+    def precondition(r):
+        ut_r = u.T @ r
+        return (lam[-1] + reg_factor) * (u @ (ut_r / (lam[:, None] + reg_factor))) + r - u @ ut_r
+
+    # preconditioned cg on (gram + reg I) w = x.T z, all target columns at once. converged columns are frozen
+    w_hat = torch.zeros_like(xt_z)
+    r = xt_z.clone()
+    z = precondition(r)
+    p = z.clone()
+    rz = (r * z).sum(0)
+    b_norm = torch.linalg.norm(xt_z, dim=0).clamp(min=tiny)
+    active = torch.linalg.norm(r, dim=0) / b_norm >= tol
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        ap = gram_matvec(x_batches, p, reduce_factor=reduce_factor, device=device) + reg_factor * p
+        alpha = torch.where(active, rz / (p * ap).sum(0).clamp(min=tiny), 0)
+        w_hat += alpha * p
+        r -= alpha * ap
+        active = active & (torch.linalg.norm(r, dim=0) / b_norm >= tol)
+        z = precondition(r)
+        rz_new = (r * z).sum(0)
+        p = z + (rz_new / rz.clamp(min=tiny)) * p
+        rz = rz_new
+    else:
+        if active.any():
+            print("cg did not converge, consider increasing rank or max_iter")
+
+    return w_hat.to(x_batches[0].dtype)
+
+
+'''
+dual (kernel) ridge regression, w = x.T (x x.T + reg I)^-1 z by the woodbury identity. inverts a rows x rows matrix
+rather than the features x features gram, so it is cheaper when there are fewer rows than features. reduce_factor
+scales the gram matrix as in RidgeAccumulator, which rescales the regularisation of the kernel matrix
+'''
+def ridge_regression_dual(x_batches, z_batches, reg_factor=10., reduce_factor=1, device=device):
+    x = torch.concatenate([x_i.to(device).reshape(-1, x_i.shape[-1]) for x_i in x_batches])
+    z = torch.concatenate([z_i.to(device).reshape(-1, z_i.shape[-1]) for z_i in z_batches])
+
+    kernel_mat = x @ x.T
+    kernel_mat += torch.eye(kernel_mat.shape[0], device=device) * (reg_factor / reduce_factor)
+    try:
+        kernel_inv = torch.inverse(kernel_mat)
+    except:
+        print("singular kernel matrix, consider increasing regularisation factor")
+        kernel_inv = torch.eye(kernel_mat.shape[0], device=device)
+    w_hat = x.T @ (kernel_inv @ z)
+
+    return w_hat
+
+
+'''
+ridge regression over batches with the layer's solver (see ridge_solver). n_rows is counted from the batches when
+not given
+'''
+def ridge_regression_batches(x_batches, z_batches, reg_factor=10., reduce_factor=1, solver=None, n_rows=None,
+                             device=device):
+    if n_rows is None:
+        n_rows = batch_rows(x_batches)
+    match resolve_ridge_solver(x_batches[0].shape[-1], solver, n_rows=n_rows, device=device):
+        case "gram":
+            ridge = RidgeAccumulator(reduce_factor=reduce_factor, device=device)
+            for x_i, z_i in zip(x_batches, z_batches):
+                ridge.update(x_i, z_i)
+            w_hat = ridge.solve(reg_factor=reg_factor)
+        case "cg":
+            w_hat = ridge_regression_cg(x_batches, z_batches, reg_factor=reg_factor, reduce_factor=reduce_factor,
+                                        device=device, **ridge_cg_options)
+        case "dual":
+            w_hat = ridge_regression_dual(x_batches, z_batches, reg_factor=reg_factor, reduce_factor=reduce_factor,
+                                          device=device)
+    return w_hat
+
+
+'''
+target potentials z of a forward layer fit (rows of x and y), with the data and label projection matrices q and u
+'''
+def projection_targets(x, y, hidden_dim=16,
+                       activation="relu",
+                       training_method="forward_projection",
+                       device=device,
+                       ):
+    q = torch.randn((x.shape[1], hidden_dim), device=device)  # data projection matrix
+    u = torch.randn((y.shape[1], hidden_dim), device=device)  # label projection matrix
+    y_proj = torch.sign(y @ u)
+    match training_method:
+        case "forward_projection":
+            x_proj = torch.sign(x @ q)
+        case "label_projection":
+            x_proj = torch.zeros_like(y_proj, device=device)
+        case "noisy_label_projection":
+            x_proj = torch.sign(torch.randn_like(y_proj, device=device))
+
+    # optional linear transposition
+    z = x_proj + y_proj
+    z += activation_shift_dict[activation]
+    z *= activation_rescale_dict[activation]
+
+    return z, q, u
+
+
 '''
 function to fit MLP weight matrix for each layer
 '''
@@ -258,21 +1173,11 @@ def fit_w(x, y, hidden_dim=16,
             x = x.reshape((-1, x.shape[-1]))
             y = y.reshape((-1, y.shape[-1]))
 
-        q = torch.randn((x.shape[1], hidden_dim), device=device)  # data projection matrix
-        u = torch.randn((y.shape[1], hidden_dim), device=device)  # label projection matrix
-        y_proj = torch.sign(y @ u)
-        match training_method:
-            case "forward_projection":
-                x_proj = torch.sign(x @ q)
-            case "label_projection":
-                x_proj = torch.zeros_like(y_proj, device=device)
-            case "noisy_label_projection":
-                x_proj = torch.sign(torch.randn_like(y_proj, device=device))
-
-        # optional linear transposition
-        z = x_proj + y_proj
-        z += activation_shift_dict[activation]
-        z *= activation_rescale_dict[activation]
+        z, q, u = projection_targets(x, y,
+                                     hidden_dim=hidden_dim,
+                                     activation=activation,
+                                     training_method=training_method,
+                                     device=device)
 
         w = ridge_regression_w(x, z,
                                reg_factor=reg_factor,
@@ -308,7 +1213,10 @@ def train_forward_mlp(x,
                       reg_factor=10.,
                       return_qu=False,  # returns projection matrices
                       verbose=False,
-                      device=device,):
+                      device=device,
+                      train_accumulator=None,  # MetricAccumulator for output layer predictions on x
+                      ):
+    x, y = as_split(x, y).gather()
     start_time = time.perf_counter()
     activation_fn = activation_dict[activation]
 
@@ -357,24 +1265,258 @@ def train_forward_mlp(x,
     end_time = time.perf_counter()
     training_time = end_time - start_time
 
+    # training set predictions from the features already used to fit the output layer
+    if train_accumulator is not None:
+        train_accumulator.update(x @ w, y)
+
     return w_list, q_list, u_list, training_time
 
 
+'''
+train several forward MLPs on the same data, one model per pair of training_methods and hidden_dims (a list of
+layer widths, or a list of such lists). models whose inputs to a layer coincide (all models at layer 0, afterwards
+models with the same training method and widths so far) are trained as one group: each distinct (training_method,
+width) of the group is fit once, and the targets of all forward fits are solved together against the group's gram
+matrix. a single model draws the same projections as train_forward_mlp. returns a dict from
+(training_method, tuple(hidden_dims)) to (w_list, q_list, u_list, training_time), the time being that of the call
+'''
+def train_forward_mlp_methods(x,
+                              y,
+                              training_methods,
+                              activation,
+                              hidden_dims=[1000] * 3,
+                              reg_factor=10.,
+                              return_qu=False,  # returns projection matrices
+                              verbose=False,
+                              device=device,
+                              ):
+    x, y = as_split(x, y).gather()
+    start_time = time.perf_counter()
+    activation_fn = activation_dict[activation]
+
+    if not isinstance(hidden_dims[0], (list, tuple)):
+        hidden_dims = [hidden_dims]
+    models = list(dict.fromkeys((m, tuple(h)) for m in training_methods for h in hidden_dims))
+    fits = {model: ([], [], []) for model in models}  # w_list, q_list, u_list
+
+    y = y.to(device)
+    groups = [(concatenate_ones(x.to(device)), models)]  # layer inputs and the models sharing them
+    l = 0
+    while groups:
+
+        if verbose:
+            print('fitting layer', l)
+
+        next_groups = []
+        for x_g, group in groups:
+
+            # fitting output layer of the models without further hidden layers, the same for all of them
+            finished = [model for model in group if len(model[1]) == l]
+            if finished:
+                w = ridge_regression_w(x_g, 2 * y - 1, flatten=False, reg_factor=1)
+                for model in finished:
+                    fits[model][0].append(w)
+
+            # fitting hidden weights, one solve for the targets of every forward fit in the group
+            layers = list(dict.fromkeys((m, h[l]) for m, h in group if len(h) > l))
+            layer_fits = {}
+            z_list = []
+            for training_method, hidden_dim in layers:
+                if training_method == "random":
+                    w = torch.randn((x_g.shape[-1], hidden_dim), device=device)
+                    w /= w.norm(dim=-1, keepdim=True)
+                    layer_fits[(training_method, hidden_dim)] = (w, None, None)
+                if training_method in ["forward_projection", "label_projection", "noisy_label_projection"]:
+                    z, q, u = projection_targets(x_g, y,
+                                                 hidden_dim=hidden_dim,
+                                                 activation=activation,
+                                                 training_method=training_method,
+                                                 device=device)
+                    z_list.append(z)
+                    layer_fits[(training_method, hidden_dim)] = (None, q, u)
+            if z_list:
+                w_all = ridge_regression_w(x_g, torch.concatenate(z_list, dim=1),
+                                           reg_factor=reg_factor,
+                                           flatten=False,
+                                           device=device)
+                w_split = iter(torch.split(w_all, [z.shape[1] for z in z_list], dim=1))
+                for key, (w, q, u) in layer_fits.items():
+                    if w is None:
+                        layer_fits[key] = (next(w_split), q, u)
+
+            # forward
+            for (training_method, hidden_dim), (w, q, u) in layer_fits.items():
+                members = [model for model in group if len(model[1]) > l and model[0] == training_method
+                           and model[1][l] == hidden_dim]
+                for model in members:
+                    fits[model][0].append(w)
+                    if training_method != "random":
+                        fits[model][1].append(q if return_qu else None)
+                        fits[model][2].append(u if return_qu else None)
+                next_groups.append((concatenate_ones(activation_fn(x_g @ w)), members))
+
+        groups = next_groups
+        l += 1
+
+    end_time = time.perf_counter()
+    training_time = end_time - start_time
+
+    return {model: (w_list, q_list, u_list, training_time) for model, (w_list, q_list, u_list) in fits.items()}
+
+
+'''
+predictions (models, n, classes) of stacked MLP weights (see stack_w_lists) on the batch x_i
+'''
+def predict_forward_mlp_stacked(x_i,
+                                w_stack,
+                                activation,
+                                ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    shared = True
+    for l in range(len(w_stack) - 1):
+        x_i = concatenate_ones(x_i)
+        x_i = activation_fn(stacked_linear(x_i, w_stack[l], shared))
+        shared = False
+
+    x_i = concatenate_ones(x_i)
+    yhat_i = stacked_linear(x_i, w_stack[-1], shared)
+
+    return yhat_i.reshape(w_stack[-1].shape[0], -1, yhat_i.shape[-1])
+
+
+def predict_forward_mlp(x_i,
+                        w_list,
+                        activation,
+                        ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    for l in range(len(w_list) - 1):
+        x_i = concatenate_ones(x_i)
+        x_i = activation_fn(x_i @ w_list[l])
+
+    x_i = concatenate_ones(x_i)
+    yhat_i = x_i @ w_list[-1]
+
+    return yhat_i
+
+
 def evaluate_forward_mlp(x,
                          y,
                          w_list,
                          activation,
                          ):
+    x, y = as_split(x, y).gather()
+    y = y.to(device)
+    yhat = predict_forward_mlp(x, w_list, activation)
+
+    test_metrics = compute_metrics(yhat, y)
+
+    return test_metrics
+
+
+'''
+train an ensemble of n_members forward MLPs that differ only in their random projections (or weights, for random).
+while the members' inputs coincide (the first layer) their targets are solved together against one gram matrix and
+the weights split, afterwards each layer is fit member by member in the same sweep. a single member draws the same
+projections as train_forward_mlp. returns lists of the members' w_list, q_list and u_list, the averaged-prediction
+model (a function of a batch, predicting with all members in one stacked pass) and the training time
+'''
+def train_forward_mlp_ensemble(x,
+                               y,
+                               training_method,
+                               activation,
+                               n_members=5,
+                               hidden_dims=[1000] * 3,
+                               reg_factor=10.,
+                               return_qu=False,  # returns projection matrices
+                               verbose=False,
+                               device=device,
+                               ):
+    x, y = as_split(x, y).gather()
+    start_time = time.perf_counter()
     activation_fn = activation_dict[activation]
 
-    x = x.to(device)
+    w_lists = [[] for _ in range(n_members)]
+    q_lists = [[] for _ in range(n_members)]
+    u_lists = [[] for _ in range(n_members)]
+
     y = y.to(device)
-    for l in range(len(w_list) - 1):
-        x = concatenate_ones(x)
-        x = activation_fn(x @ w_list[l])
+    x_members = [concatenate_ones(x.to(device))] * n_members
 
-    x = concatenate_ones(x)
-    yhat = x @ w_list[-1]
+    # fit hidden layers
+    for l in range(len(hidden_dims)):
+
+        if verbose:
+            print('fitting layer', l)
+
+        # fitting hidden weights
+        if training_method == "random":
+            for m in range(n_members):
+                w = torch.randn((x_members[m].shape[-1], hidden_dims[l]), device=device)
+                w /= w.norm(dim=-1, keepdim=True)
+                w_lists[m].append(w)
+        if training_method in ["forward_projection", "label_projection", "noisy_label_projection"]:
+            if all(x_m is x_members[0] for x_m in x_members):
+                targets = [projection_targets(x_members[0], y,
+                                              hidden_dim=hidden_dims[l],
+                                              activation=activation,
+                                              training_method=training_method,
+                                              device=device) for _ in range(n_members)]
+                w_all = ridge_regression_w(x_members[0], torch.concatenate([z for z, _, _ in targets], dim=1),
+                                           reg_factor=reg_factor,
+                                           flatten=False,
+                                           device=device)
+                fits = [(w, q, u) for w, (_, q, u) in zip(torch.split(w_all, hidden_dims[l], dim=1), targets)]
+            else:
+                fits = [fit_w(x_members[m], y,
+                              hidden_dim=hidden_dims[l],
+                              flatten=False,
+                              reg_factor=reg_factor,
+                              return_qu=True,
+                              device=device,
+                              activation=activation,
+                              training_method=training_method,
+                              ) for m in range(n_members)]
+            for m, (w, q, u) in enumerate(fits):
+                w_lists[m].append(w)
+                q_lists[m].append(q if return_qu else None)
+                u_lists[m].append(u if return_qu else None)
+
+        # forward
+        x_members = [concatenate_ones(activation_fn(x_members[m] @ w_lists[m][-1])) for m in range(n_members)]
+
+    # fitting output layers
+    if verbose:
+        print('fitting output layers')
+    for m in range(n_members):
+        w_lists[m].append(ridge_regression_w(x_members[m], 2 * y - 1, flatten=False, reg_factor=1))
+
+    end_time = time.perf_counter()
+    training_time = end_time - start_time
+
+    w_stack = stack_w_lists(w_lists)[0][1]
+
+    def ensemble_fn(x_i):
+        return predict_forward_mlp_stacked(x_i, w_stack, activation).mean(dim=0)
+
+    return w_lists, q_lists, u_lists, ensemble_fn, training_time
+
+
+'''
+evaluate the ensemble of w_lists by its averaged predictions
+'''
+def evaluate_forward_mlp_ensemble(x,
+                                  y,
+                                  w_lists,
+                                  activation,
+                                  ):
+    x, y = as_split(x, y).gather()
+    y = y.to(device)
+    w_stack = stack_w_lists(w_lists)[0][1]
+    yhat = predict_forward_mlp_stacked(x, w_stack, activation).mean(dim=0)
 
     test_metrics = compute_metrics(yhat, y)
 
@@ -424,27 +1566,8 @@ z refers to z_tilde, the target neural pre-activation potential
 '''
 
 
-def ridge_regression_w_conv1d(x_batches, z_batches, reg_factor=10., device=device):
-    x_dim = x_batches[0].shape[-1]
-    z_dim = z_batches[1].shape[-1]
-    gram_mat = torch.zeros((x_dim, x_dim), device=device)
-    xt_z = torch.zeros((x_dim, z_dim), device=device)
-    for x_i, z_i in zip(x_batches, z_batches):
-        x_i = x_i.to(device)
-        z_i = z_i.to(device)
-        x_i = x_i.flatten(start_dim=0, end_dim=1)
-        z_i = z_i.flatten(start_dim=0, end_dim=1)
-        gram_mat += x_i.T @ x_i
-        xt_z += x_i.T @ z_i
-
-    # regularise gram matrix
-    gram_mat += torch.eye(gram_mat.shape[0], device=device) * reg_factor
-    try:
-        gram_inv = torch.inverse(gram_mat)
-    except:
-        print("singular matrix, consider increasing regularisation factor")
-        gram_inv = torch.eye(gram_mat.shape[0], device=device)
-    w_hat = gram_inv @ xt_z
+def ridge_regression_w_conv1d(x_batches, z_batches, reg_factor=10., device=device, solver=None):
+    w_hat = ridge_regression_batches(x_batches, z_batches, reg_factor=reg_factor, solver=solver, device=device)
 
     return w_hat
 
@@ -521,14 +1644,12 @@ def train_forward_conv1d(x,
                          return_qu=False,
                          verbose=False,
                          device=device,
+                         train_accumulator=None,  # MetricAccumulator for output layer predictions on x
                          ):
     with torch.no_grad():
 
         activation_fn = activation_dict[activation]
 
-        if y.ndim == 2:
-            y = torch.unsqueeze(y, dim=1)
-
         # define hidden layer dimensions for convolutional pyramid
         hidden_dims = [round(hidden_dim * 2 ** (i // 2)) for i in range(n_blocks * 2)]
 
@@ -537,9 +1658,8 @@ def train_forward_conv1d(x,
         q_list = []
         u_list = []
 
-        rand_idx = torch.randperm(len(x))
-        x_batches = list(torch.split(x[rand_idx], split_size_or_sections=batch_size))
-        y_batches = list(torch.split(y[rand_idx], split_size_or_sections=batch_size))
+        x_batches, y_batches = BatchProducer(as_split(x, y), batch_size, shuffle=True, device=None).lists()
+        y_batches = [torch.unsqueeze(y_i, dim=1) if y_i.ndim == 2 else y_i for y_i in y_batches]
 
         # fit hidden layers
         for l in range(len(hidden_dims)):
@@ -591,42 +1711,84 @@ def train_forward_conv1d(x,
         end_time = time.perf_counter()
         training_time = end_time - start_time
 
+        # training set predictions from the pooled features, argmax of the +-1 targets gives the labels
+        if train_accumulator is not None:
+            for x_i, y_i in zip(x_batches, y_batches):
+                train_accumulator.update(x_i.to(device) @ w, y_i)
+
         return w_list, q_list, u_list, training_time
 
 
-def evaluate_forward_conv1d(x,
-                            y,
-                            w_list,
-                            activation,
-                            kernel_size=3,
-                            batch_size=1000
-                            ):
+def predict_forward_conv1d(x_i,
+                           w_list,
+                           activation,
+                           kernel_size=3,
+                           ):
     activation_fn = activation_dict[activation]
-    x_batches = torch.split(x, split_size_or_sections=batch_size)
+    x_i = x_i.to(device)
 
-    yhat = []
-    for x_i in x_batches:
-        x_i = x_i.to(device)
+    for l in range(len(w_list) - 1):
+        # convolution and pooling
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride).flatten(start_dim=2)
+        x_i = concatenate_ones(x_i)
 
-        for l in range(len(w_list) - 1):
-            # convolution and pooling
-            stride = 2 - ((l + 1) % 2)
-            x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride).flatten(start_dim=2)
-            x_i = concatenate_ones(x_i)
+        # forward
+        x_i = activation_fn(x_i @ w_list[l])
 
-            # forward
-            x_i = activation_fn(x_i @ w_list[l])
+    # output
+    x_i = concatenate_ones(x_i)
+    x_i = torch.mean(x_i, dim=1)
+    yhat_i = x_i @ w_list[-1]
+
+    return yhat_i
+
+
+'''
+predictions (models, n, classes) of stacked conv1d weights (see stack_w_lists) on the batch x_i
+'''
+def predict_forward_conv1d_stacked(x_i,
+                                   w_stack,
+                                   activation,
+                                   kernel_size=3,
+                                   ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
 
-        # output
+    shared = True
+    for l in range(len(w_stack) - 1):
+        # convolution and pooling, once for all models
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride).flatten(start_dim=2)
         x_i = concatenate_ones(x_i)
-        y = torch.squeeze(y)
-        x_i = torch.mean(x_i, dim=1)
-        yhat_i = x_i @ w_list[-1]
-        yhat.append(yhat_i.to("cpu"))
 
-    yhat = torch.concatenate(yhat)
+        # forward
+        x_i = activation_fn(stacked_linear(x_i, w_stack[l], shared))
+        shared = False
+
+    # output
+    x_i = concatenate_ones(x_i)
+    x_i = torch.mean(x_i, dim=1)
+    yhat_i = stacked_linear(x_i, w_stack[-1], shared)
+
+    return yhat_i.reshape(w_stack[-1].shape[0], -1, yhat_i.shape[-1])
+
+
+'''
+evaluate on x, or on several splits of x in one forward pass when split_masks are given
+'''
+def evaluate_forward_conv1d(x,
+                            y,
+                            w_list,
+                            activation,
+                            kernel_size=3,
+                            batch_size=1000,
+                            split_masks=None,
+                            ):
+    def predict_fn(x_i):
+        return predict_forward_conv1d(x_i, w_list, activation, kernel_size=kernel_size)
 
-    metrics = compute_metrics(yhat, y)
+    metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size)
 
     return metrics
 
@@ -644,86 +1806,83 @@ model_parameters = expand_grid({
 })
 conv1d_datasets = ['human_nontata_promoters']
 verbose = True
-
 seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
+
+
+def forward_conv1d_experiment(fold, training_method, activation):
+    hidden_dim = 32
+    n_blocks = 4
+
+    # train 1d conv
+    train_idx, val_idx = fold_indices(folds, fold)
+    train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+    val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+    train_accumulator = MetricAccumulator(num_classes=train_data.num_classes)
+    w_list, _, _, training_time = train_forward_conv1d(x=train_data,
+                                                       y=None,
+                                                       training_method=training_method,
+                                                       hidden_dim=hidden_dim,
+                                                       activation=activation,
+                                                       n_blocks=n_blocks,
+                                                       device=device,
+                                                       batch_size=1000,
+                                                       train_accumulator=train_accumulator
+                                                       )
+    train_metrics = train_accumulator.compute()
+    val_metrics = evaluate_forward_conv1d(x=val_data,
+                                          y=None,
+                                          w_list=w_list,
+                                          activation=activation)
+    test_metrics = evaluate_forward_conv1d(x=X_test,
+                                           y=Y_test,
+                                           w_list=w_list,
+                                           activation=activation)
+    if verbose:
+        print(training_method)
+        print(train_metrics)
+        print(val_metrics)
+        print(test_metrics)
+
+    out = {
+        'dataset': dataset_i,
+        'training_method': training_method,
+        'fold': fold,
+        'activation': activation,
+        'hidden_dim': hidden_dim,
+        'n_blocks': n_blocks,
+        'train_auc': train_metrics[0].item(),
+        'train_acc': train_metrics[1].item(),
+        'train_prec': train_metrics[2].item(),
+        'train_recall': train_metrics[3].item(),
+        'train_f1': train_metrics[4].item(),
+        'val_auc': val_metrics[0].item(),
+        'val_acc': val_metrics[1].item(),
+        'val_prec': val_metrics[2].item(),
+        'val_recall': val_metrics[3].item(),
+        'val_f1': val_metrics[4].item(),
+        'test_auc': test_metrics[0].item(),
+        'test_acc': test_metrics[1].item(),
+        'test_prec': test_metrics[2].item(),
+        'test_recall': test_metrics[3].item(),
+        'test_f1': test_metrics[4].item(),
+        'training_time': training_time,
+    }
+    return out
+
+
 forward_conv1d_experiments = []
 for dataset_i in conv1d_datasets:
 
     print(dataset_i)
     X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i)
 
-    for model_parameters_i in range(len(model_parameters)):
-
-        print(model_parameters_i)
-
-        training_method = model_parameters.training_method[model_parameters_i]
-        fold = model_parameters.fold[model_parameters_i]
-        activation = model_parameters.activation[model_parameters_i]
-        hidden_dim = 32
-        n_blocks = 4
-
-        # train 1d conv
-        train_folds = folds != fold
-        val_folds = torch.logical_not(train_folds)
-        X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-        Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
-
-        w_list, _, _, training_time = train_forward_conv1d(x=X_train,
-                                                           y=Y_train,
-                                                           training_method=training_method,
-                                                           hidden_dim=hidden_dim,
-                                                           activation=activation,
-                                                           n_blocks=n_blocks,
-                                                           device=device,
-                                                           batch_size=1000
-                                                           )
-        train_metrics = evaluate_forward_conv1d(x=X_train,
-                                                y=Y_train,
-                                                w_list=w_list,
-                                                activation=activation)
-        val_metrics = evaluate_forward_conv1d(x=X_val,
-                                              y=Y_val,
-                                              w_list=w_list,
-                                              activation=activation)
-        test_metrics = evaluate_forward_conv1d(x=X_test,
-                                               y=Y_test,
-                                               w_list=w_list,
-                                               activation=activation)
-        if verbose:
-            print(training_method)
-            print(train_metrics)
-            print(val_metrics)
-            print(test_metrics)
-
-        out = {
-            'dataset': dataset_i,
-            'training_method': training_method,
-            'fold': fold,
-            'activation': activation,
-            'hidden_dim': hidden_dim,
-            'n_blocks': n_blocks,
-            'train_auc': train_metrics[0].item(),
-            'train_acc': train_metrics[1].item(),
-            'train_prec': train_metrics[2].item(),
-            'train_recall': train_metrics[3].item(),
-            'train_f1': train_metrics[4].item(),
-            'val_auc': val_metrics[0].item(),
-            'val_acc': val_metrics[1].item(),
-            'val_prec': val_metrics[2].item(),
-            'val_recall': val_metrics[3].item(),
-            'val_f1': val_metrics[4].item(),
-            'test_auc': test_metrics[0].item(),
-            'test_acc': test_metrics[1].item(),
-            'test_prec': test_metrics[2].item(),
-            'test_recall': test_metrics[3].item(),
-            'test_f1': test_metrics[4].item(),
-            'training_time': training_time,
-        }
-        forward_conv1d_experiments.append(out)
-forward_conv1d_experiments = pd.DataFrame(forward_conv1d_experiments)
+    store_file = os.path.join(store_dir, f"forward_conv1d_experiments_{dataset_i}.jsonl")
+    forward_conv1d_experiments.append(run_experiment_grid(forward_conv1d_experiment,
+                                                          model_parameters,
+                                                          store_file=store_file,
+                                                          seed=seed))
+forward_conv1d_experiments = pd.concat(forward_conv1d_experiments, ignore_index=True)
 output_file = os.path.join(output_dir, "forward_conv1d_experiments.csv")
 forward_conv1d_experiments.to_csv(path_or_buf=output_file)
 
@@ -737,35 +1896,28 @@ forward_conv1d_experiments.to_csv(path_or_buf=output_file)
 weights over conv2d data batches. Channels last.
 z refers to the target potentials
 '''
-def ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=10., device=device):
-    x_dim = x_batches[0].shape[-1] # data
-    z_dim = z_batches[1].shape[-1] # targets
-
-    #accumulate data gram matrix and cross product of data and targets
-    gram_mat = torch.zeros((x_dim, x_dim), device=device)
-    xt_z = torch.zeros((x_dim, z_dim), device=device)
-    for x_i, z_i in zip(x_batches, z_batches):
-        x_i = x_i.to(device)
-        z_i = z_i.to(device)
-        x_i = x_i.flatten(start_dim=0, end_dim=2)
-        z_i = z_i.flatten(start_dim=0, end_dim=2)
-        xt_z += x_i.T @ z_i
-        gram_mat += x_i.T @ x_i
+def ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=10., device=device, solver=None):
+    #accumulate data gram matrix and cross product of data and targets, regularise and solve for the weight matrix
+    w_hat = ridge_regression_batches(x_batches, z_batches, reg_factor=reg_factor, solver=solver, device=device)
 
-    #regularise
-    gram_mat += torch.eye(gram_mat.shape[0], device=device) * reg_factor
+    return w_hat
 
-    #invert gram matrix
-    try:
-        gram_inv = torch.inverse(gram_mat)
-    except:
-        print("singular gram matrix, consider increasing regularisation factor")
-        gram_inv = torch.eye(gram_mat.shape[0], device=device)
 
-    #compute weight matrix
-    w_hat = gram_inv @ xt_z
+'''
+output layer features of a conv2d feature map (n, h, w, c): the global average is taken before the ones column
+is added (the same features as averaging after it, without concatenating a full map), flatten keeps a ones
+column per position as predict_forward_conv2d expects. returns (n, 1, 1, features)
+'''
+def pool_output_features(x_i, global_layer="average"):
+    match global_layer:
+        case "average":
+            x_i = torch.mean(x_i, dim=(1, 2), keepdim=True)
+            x_i = concatenate_ones(x_i)
+        case "flatten":
+            x_i = concatenate_ones(x_i)
+            x_i = x_i.flatten(start_dim=1)[:, None, None, :]
+    return x_i
 
-    return w_hat
 
 '''
 function to fit 2d convolutional layer weights over data batches
@@ -780,7 +1932,9 @@ def fit_w_conv2d(x_batches,
                  return_qu=False,
                  activation="relu",
                  device=device,
-                 training_method="forward_projection"):
+                 training_method="forward_projection",
+                 ridge_solver=None,
+                 ):
     x_channels = x_batches[0].shape[-1]
     y_channels = y_batches[0].shape[-1]
 
@@ -814,7 +1968,7 @@ def fit_w_conv2d(x_batches,
         z_batches.append(z_i.to("cpu"))
 
     #fit weight
-    w = ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=reg_factor)
+    w = ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=reg_factor, solver=ridge_solver)
 
     if return_qu:
         return w, q, u
@@ -834,12 +1988,11 @@ def train_forward_conv2d(x,
                          return_qu=False,
                          verbose=False,
                          device=device,
+                         train_accumulator=None,  # MetricAccumulator for output layer predictions on x
+                         ridge_solver=None,  # solver name, or a list with one per hidden layer and the output layer
                          ):
     activation_fn = activation_dict[activation]
 
-    if y.ndim == 2:
-        y = y[:, None, None, :]
-
     hidden_dims = [round(hidden_dim * 2 ** (i // 2)) for i in range(n_blocks * 2)]
 
     start_time = time.perf_counter()
@@ -847,9 +2000,8 @@ def train_forward_conv2d(x,
     q_list = [] # data projection matrices
     u_list = [] # label projeciton matrices
 
-    rand_idx = torch.randperm(len(x))
-    x_batches = list(torch.split(x[rand_idx], split_size_or_sections=batch_size))
-    y_batches = list(torch.split(y[rand_idx], split_size_or_sections=batch_size))
+    x_batches, y_batches = BatchProducer(as_split(x, y), batch_size, shuffle=True, device=None).lists()
+    y_batches = [y_i[:, None, None, :] if y_i.ndim == 2 else y_i for y_i in y_batches]
 
     # fit hidden layers
     for l in range(len(hidden_dims)):
@@ -880,231 +2032,574 @@ def train_forward_conv2d(x,
                                    return_qu=return_qu,
                                    activation=activation,
                                    training_method=training_method,
-                                   reg_factor=reg_factor)
+                                   reg_factor=reg_factor,
+                                   ridge_solver=layer_solver(ridge_solver, l))
             q_list.append(q)
             u_list.append(u)
         w_list.append(w)
 
-        # forward
-        x_batches = [activation_fn(x_i.to(device) @ w).to("cpu") for x_i in x_batches]
+        # forward, the last hidden layer is computed batch by batch while fitting the output layer
+        if l < len(hidden_dims) - 1:
+            x_batches = [activation_fn(x_i.to(device) @ w).to("cpu") for x_i in x_batches]
 
-    # fitting output layer
+    # fitting output layer on pooled features, accumulated without keeping the final feature maps
     if verbose:
         print('fitting output layer')
+    # one pooled row per sample. solvers other than gram also need the pooled features
+    output_ridge = RidgeAccumulator()
+    output_solver = None
+    pooled_batches = []
     for i in range(len(x_batches)):
-        x_batches[i] = concatenate_ones(x_batches[i])
-        x_batches[i] = torch.mean(x_batches[i], dim=(1, 2), keepdim=True)
-        y_batches[i] = 2 * y_batches[i] - 1
+        x_i = pool_output_features(activation_fn(x_batches[i].to(device) @ w_list[-1]))
+        y_i = 2 * y_batches[i].to(device) - 1
+        x_batches[i] = None
+        if output_solver is None:
+            output_solver = resolve_ridge_solver(x_i.shape[-1], layer_solver(ridge_solver, len(hidden_dims)),
+                                                 n_rows=sum(len(y_i) for y_i in y_batches), device=device)
+        if output_solver == "gram":
+            output_ridge.update(x_i, y_i)
+        if output_solver != "gram" or train_accumulator is not None:
+            pooled_batches.append((x_i, y_i))
 
     # fit weight
-    w = ridge_regression_w_conv2d(x_batches, y_batches, reg_factor=1)
+    if output_solver == "gram":
+        w = output_ridge.solve(reg_factor=1)
+    else:
+        pooled_x, pooled_y = zip(*pooled_batches)
+        w = ridge_regression_batches(pooled_x, pooled_y, reg_factor=1, solver=output_solver)
 
     w_list.append(w)
     end_time = time.perf_counter()
     training_time = end_time - start_time
 
+    # training set predictions from the pooled features, argmax of the +-1 targets gives the labels
+    if train_accumulator is not None:
+        for x_i, y_i in pooled_batches:
+            train_accumulator.update(x_i @ w, y_i)
+
     return w_list, q_list, u_list, training_time
 
 
+def predict_forward_conv2d(x_i,
+                           w_list,
+                           activation,
+                           kernel_size=3,
+                           ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    for l in range(len(w_list) - 1):
+
+        # convolution and pooling
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
+        x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+        x_i = x_i.flatten(start_dim=3)
+        x_i = concatenate_ones(x_i)
+
+        # forward
+        x_i = activation_fn(x_i @ w_list[l])
+
+    # extract global average (with the ones column) as prediction
+    x_i = pool_output_features(x_i)[:, 0, 0, :]
+    yhat_i = x_i @ w_list[-1]
+
+    return yhat_i
+
+
+'''
+evaluate on x, or on several splits of x in one forward pass when split_masks are given
+'''
 def evaluate_forward_conv2d(x,
                             y,
                             w_list,
                             activation,
                             kernel_size=3,
-                            batch_size=1000
+                            batch_size=1000,
+                            split_masks=None,
                             ):
-    activation_fn = activation_dict[activation]
-    x_batches = torch.split(x, split_size_or_sections=batch_size)
+    def predict_fn(x_i):
+        return predict_forward_conv2d(x_i, w_list, activation, kernel_size=kernel_size)
 
-    yhat = []
-    for x_i in x_batches:
-        x_i = x_i.to(device)
+    metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size)
 
-        for l in range(len(w_list) - 1):
+    return metrics
 
-            # convolution and pooling
-            stride = 2 - ((l + 1) % 2)
-            x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
-            x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
-            x_i = x_i.flatten(start_dim=3)
-            x_i = concatenate_ones(x_i)
 
-            # forward
-            x_i = activation_fn(x_i @ w_list[l])
 
-        # output
-        x_i = concatenate_ones(x_i)
-        y = torch.squeeze(y)
+# </editor-fold>
 
-        # extract global average as prediction
-        x_i = torch.mean(x_i, dim=(1, 2))
-        yhat_i = x_i @ w_list[-1]
-        yhat.append(yhat_i.to("cpu"))
+#@title sgd training and evaluation functions
 
-    yhat = torch.concatenate(yhat)
+cuda_cache_policy = "oom" # when cached cuda memory is released: "oom" after an out of memory error only, "experiment" also before each model is trained, "epoch" also every epoch
 
-    metrics = compute_metrics(yhat, y)
 
-    return metrics
+def trim_cuda_cache(when):
+    '''releases cached cuda memory if the cache policy trims at this point ("epoch" or "experiment")'''
+    if cuda_cache_policy == "epoch" or (cuda_cache_policy == "experiment" and when == "experiment"):
+        torch.cuda.empty_cache()
 
 
+def with_oom_retry(fn, *args, **kwargs):
+    '''runs fn, and once more after releasing cached cuda memory if it runs out of memory'''
+    try:
+        return fn(*args, **kwargs)
+    except torch.cuda.OutOfMemoryError:
+        # the retry runs outside the except block, so the failed attempt's tensors can be freed first
+        print("out of cuda memory, releasing cached memory and retrying")
+    torch.cuda.empty_cache()
+    return fn(*args, **kwargs)
 
-# </editor-fold>
 
-#@title sgd training and evaluation functions
+def synchronise_device():
+    '''waits for queued device work, for timing'''
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    elif torch.device(device).type == "mps":
+        torch.mps.synchronize()
+
+
+'''
+per-epoch losses kept as detached device tensors, so logging them never waits for the device.
+values() copies them to python floats in one transfer
+'''
+class LossLog:
+    def __init__(self):
+        self.losses = []
+
+    def append(self, loss):
+        self.losses.append(torch.as_tensor(loss).detach().float().reshape(()))
+
+    def __len__(self):
+        return len(self.losses)
+
+    def values(self):
+        if not self.losses:
+            return []
+        return torch.stack([loss.to("cpu") for loss in self.losses]).tolist()
+
+sgd_compile_steps = False # compile the per-method training steps with torch.compile
+sgd_fused_local_steps = True # layerwise methods take one summed backward pass and one foreach adam step per batch
+sgd_precision = "float32" # autocast policy of the sgd forward passes, a key of sgd_precision_dict
+sgd_channels_last = False # 2d convolution weights and image batches in channels-last memory format
+
+# autocast dtype of the forward passes, and whether losses are scaled so small float16 gradients do not underflow.
+# bfloat16 has the float32 exponent range and needs no scaling. parameters and optimiser states stay float32.
+# the backprop and fused steps autocast, the per-layer steps (and direct random target projection) run in float32
+sgd_precision_dict = {"float32": dict(autocast_dtype=None, scale_loss=False),
+                      "bfloat16": dict(autocast_dtype=torch.bfloat16, scale_loss=False),
+                      "float16": dict(autocast_dtype=torch.float16, scale_loss=True),
+                      }
+
+
+def configure_sgd_model(model, precision=None, channels_last=None):
+    '''
+    sets the precision and memory format policy of an sgd model, defaults from sgd_precision and sgd_channels_last.
+    channels_last converts the 4d (2d convolution) weights in place, so optimisers built with the model keep them
+    '''
+    precision = sgd_precision if precision is None else precision
+    channels_last = sgd_channels_last if channels_last is None else channels_last
+    if precision not in sgd_precision_dict:
+        raise ValueError(f"unknown precision {precision}")
+    policy = sgd_precision_dict[precision]
+    model.precision = precision
+    model.autocast_dtype = policy["autocast_dtype"]
+    model.grad_scaler = torch.amp.GradScaler(torch.device(device).type) if policy["scale_loss"] else None
+    model.memory_format = torch.channels_last if channels_last else None
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def sgd_autocast(model):
+    '''autocast context of the model's forward passes, a no-op for float32 models'''
+    dtype = getattr(model, "autocast_dtype", None)
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def channels_first_view(x):
+    '''
+    (n, c, ., .) view of channels-last image data (n, ., ., c). by default the last and channel dimensions are
+    swapped, as the experiments always have. with sgd_channels_last the stored layout is kept instead, so batches
+    gathered from the view are already channels-last and reach the convolutions without a copy. images are then
+    seen with height and width swapped relative to the default, so results are not bitwise comparable with it
+    '''
+    if not sgd_channels_last:
+        return x.transpose(1, -1)
+    return x.permute(0, 3, 1, 2)
+
+
+def ff_label_injection(layer_l, x, ys):
+    '''
+    first forward-forward layer applied to [x, y] for every label set y in ys (k, n, c), without repeating
+    the labels over positions. inputs are normalised as in forward_ff, the x part is computed once, and the
+    label part is the per-position normaliser convolved with the label weights, so zero padding stays exact.
+    label sets must share their norms per sample, as one-hot labels do.
+    returns (k * n, out_features, ...)
+    '''
+    n = x.shape[0]
+    n_classes = ys.shape[2]
+    in_x = x.shape[1]
+    spatial = (1,) * (x.ndim - 2)
+    y_sq = ys[0].square().sum(dim=1).view((n, 1) + spatial)
+    norm = (x.square().sum(dim=1, keepdim=True) + y_sq).sqrt() + 0.001
+    w_x = layer_l.weight[:, :in_x]
+    w_y = layer_l.weight[:, in_x:]
+    if isinstance(layer_l, nn.Linear):
+        out_x = nn.functional.linear(x / norm, w_x, layer_l.bias)
+        out_y = (ys @ w_y.T) / norm
+    else:
+        out_x = layer_l._conv_forward(x / norm, w_x, layer_l.bias)
+        w_y = w_y.transpose(0, 1).reshape((n_classes * w_y.shape[0], 1) + w_y.shape[2:])
+        out_y = layer_l._conv_forward(1 / norm, w_y, None)
+        out_y = out_y.view((n, n_classes, -1) + out_y.shape[2:])
+        out_y = torch.einsum('knc,nco...->kno...', ys, out_y)
+    return (out_x + out_y).flatten(0, 1)
+
+
+def ff_negative_labels(y_i):
+    '''one-hot labels of a random wrong class for every row'''
+    y_neg_i = torch.argmax(torch.rand_like(y_i) - y_i, dim=1)
+    return nn.functional.one_hot(y_neg_i, y_i.shape[1]).to(y_i.dtype)
+
+
+def ff_contrastive_losses(model, x_i, y_i):
+    '''per-layer forward-forward losses, true and wrong labels scored in one forward pass'''
+    goodnesses = model.forward_ff(x_i, torch.stack([y_i, ff_negative_labels(y_i)]))
+    n = len(x_i)
+    # goodnesses of autocast forward passes are reduced precision, the losses are float32
+    goodnesses = [g_l.float() for g_l in goodnesses]
+    return [torch.log(1 + torch.exp(torch.concatenate([2 - g_l[:n], g_l[n:] - 2]))).mean() for g_l in goodnesses]
+
+
+def scaled_backward_step(opt, loss, scaler=None, inputs=None):
+    '''backward pass and optimiser step, through the model's gradient scaler when it has one'''
+    if scaler is None:
+        loss.backward(inputs=inputs)
+        opt.step()
+        return
+    scaler.scale(loss).backward(inputs=inputs)
+    scaler.step(opt)
+    scaler.update()
+
+
+def sgd_step_backprop(model, x_i, y_i, loss_fn, n_batches):
+    '''one end-to-end backprop step, returns the detached batch loss'''
+    with sgd_autocast(model):
+        yhat_i = model(x_i)
+        loss = loss_fn(yhat_i, y_i)
+    model.opt.zero_grad()
+    scaled_backward_step(model.opt, loss, getattr(model, "grad_scaler", None))
+    return loss.detach()
+
+
+def sgd_step_local_supervision(model, x_i, y_i, loss_fn, n_batches):
+    '''one step of layerwise supervision through the local classifier heads'''
+    yhats = model.forward_ls(x_i)
+    for l in range(len(yhats)):
+        loss_l = loss_fn(yhats[l], y_i)
+        model.opts[l].zero_grad()
+        loss_l.backward(inputs=tuple(model.layers[l].parameters()))
+        model.opts[l].step()
+    return loss_l.detach() / len(yhats)
+
+
+def sgd_step_forward_forward(model, x_i, y_i, loss_fn, n_batches):
+    '''one forward-forward step, contrasting true labels against random wrong labels'''
+    local_losses = ff_contrastive_losses(model, x_i, y_i)
+    batch_loss = 0
+    for l, loss_l in enumerate(local_losses):
+        model.opts[l].zero_grad()
+        loss_l.backward(inputs=tuple(model.layers[l].parameters()))
+        model.opts[l].step()
+        batch_loss += loss_l.detach() / n_batches
+    return batch_loss
+
+
+def sgd_step_predictive_coding(model, x_i, y_i, loss_fn, n_batches):
+    '''one predictive coding step, layers learn to reconstruct their inputs'''
+    local_losses, yhat = model.forward_pc(x_i)
+    for l in range(len(model.layers) - 1):
+        model.opts[l].zero_grad()
+        model.back_opts[l].zero_grad()
+        local_losses[l].backward()
+        model.opts[l].step()
+        model.back_opts[l].step()
+    loss_l = loss_fn(yhat, y_i)
+    model.opts[-1].zero_grad()
+    loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
+    model.opts[-1].step()
+    return loss_l.detach() / n_batches
+
+
+def sgd_step_difference_target_propagation(model, x_i, y_i, loss_fn, n_batches):
+    '''one difference target propagation step'''
+    local_losses, yhat = model.forward_pc(x_i)
+    for l in range(len(model.layers) - 1):
+        model.opts[l].zero_grad()
+        model.back_opts[l+1].zero_grad()
+        local_losses[l].backward()
+        model.opts[l].step()
+        model.back_opts[l+1].step()
+    loss_l = loss_fn(yhat, y_i)
+    model.opts[-1].zero_grad()
+    loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
+    model.opts[-1].step()
+    return loss_l.detach() / n_batches
+
+
+def sgd_step_direct_random_target_projection(model, x_i, y_i, loss_fn, n_batches):
+    '''one step towards fixed random projections of the labels'''
+    x = x_i.detach()
+    for l in range(len(model.layers) - 1):
+        x = x.detach()
+        x = model.layers[l](x)
+        x = model.activation_fn(x)
+        target = model.forward_proj[l](y_i)
+        target = model.activation_fn(target)
+        loss_l = torch.mean((x - target) ** 2)
+        model.opts[l].zero_grad()
+        loss_l.backward(inputs=tuple(model.layers[l].parameters()))
+        model.opts[l].step()
+    x = x.detach()
+    yhat = model.layers[-1](x)
+    loss_l = loss_fn(yhat, y_i)
+    model.opts[-1].zero_grad()
+    loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
+    model.opts[-1].step()
+    return loss_l.detach() / n_batches
+
+
+def sgd_step_stochastic_forward_projection(model, x_i, y_i, loss_fn, n_batches):
+    '''one step towards sign projections of the layer input and labels, as in forward projection'''
+    local_losses, yhat = model.forward_fp(x_i, y_i)
+    for l in range(len(model.layers) - 1):
+        model.opts[l].zero_grad()
+        local_losses[l].backward(inputs=tuple(model.layers[l].parameters()))
+        model.opts[l].step()
+    loss_l = loss_fn(yhat, y_i)
+    model.opts[-1].zero_grad()
+    loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
+    model.opts[-1].step()
+    return loss_l.detach() / n_batches
+
+
+def fused_optimiser(model, names):
+    '''
+    one foreach adam over the parameters of the per-layer optimisers model.<names>, built once per model.
+    optimisers with the same hyperparameters share a parameter group, so their layers update in one pass
+    '''
+    if getattr(model, "fused_opt", None) is None:
+        groups = {}
+        for name in names:
+            for opt_l in getattr(model, name):
+                for group in opt_l.param_groups:
+                    hyper = dict(lr=group["lr"], betas=group["betas"], eps=group["eps"],
+                                 weight_decay=group["weight_decay"], amsgrad=group["amsgrad"])
+                    groups.setdefault(tuple(hyper.items()), dict(hyper, params=[]))["params"] += group["params"]
+        model.fused_opt = torch.optim.Adam(list(groups.values()), foreach=True)
+    return model.fused_opt
+
+
+def fused_backward_step(opt, loss, scaler=None):
+    '''
+    one backward pass of the summed local losses into the parameters of opt, then one optimiser step.
+    every layer's input is detached, so each layer's gradient comes from its own local loss alone,
+    as with a backward pass and step per layer
+    '''
+    opt.zero_grad()
+    params = [param for group in opt.param_groups for param in group["params"]]
+    scaled_backward_step(opt, loss, scaler, inputs=params)
+
+
+def sgd_step_local_supervision_fused(model, x_i, y_i, loss_fn, n_batches):
+    '''sgd_step_local_supervision with one backward pass and one optimiser step'''
+    with sgd_autocast(model):
+        yhats = model.forward_ls(x_i)
+        local_losses = [loss_fn(yhat_l, y_i) for yhat_l in yhats]
+    fused_backward_step(fused_optimiser(model, ["opts"]), sum(local_losses), getattr(model, "grad_scaler", None))
+    return local_losses[-1].detach() / len(yhats)
+
+
+def sgd_step_forward_forward_fused(model, x_i, y_i, loss_fn, n_batches):
+    '''sgd_step_forward_forward with one backward pass and one optimiser step'''
+    with sgd_autocast(model):
+        local_losses = ff_contrastive_losses(model, x_i, y_i)
+    fused_backward_step(fused_optimiser(model, ["opts"]), sum(local_losses), getattr(model, "grad_scaler", None))
+    batch_loss = 0
+    for loss_l in local_losses:
+        batch_loss += loss_l.detach() / n_batches
+    return batch_loss
+
+
+def sgd_step_predictive_coding_fused(model, x_i, y_i, loss_fn, n_batches):
+    '''sgd_step_predictive_coding with one backward pass and one optimiser step'''
+    with sgd_autocast(model):
+        local_losses, yhat = model.forward_pc(x_i)
+        loss_out = loss_fn(yhat, y_i)
+    fused_backward_step(fused_optimiser(model, ["opts", "back_opts"]), sum(local_losses) + loss_out,
+                        getattr(model, "grad_scaler", None))
+    return loss_out.detach() / n_batches
+
+
+def sgd_step_difference_target_propagation_fused(model, x_i, y_i, loss_fn, n_batches):
+    '''sgd_step_difference_target_propagation with one backward pass and one optimiser step'''
+    # the per-layer step zeroes and steps back_opts[l + 1] while the gradient lands on back layer l, so the
+    # back layers never change, and only the forward layers are updated here
+    with sgd_autocast(model):
+        local_losses, yhat = model.forward_pc(x_i)
+        loss_out = loss_fn(yhat, y_i)
+    fused_backward_step(fused_optimiser(model, ["opts"]), sum(local_losses) + loss_out,
+                        getattr(model, "grad_scaler", None))
+    return loss_out.detach() / n_batches
+
+
+def sgd_step_stochastic_forward_projection_fused(model, x_i, y_i, loss_fn, n_batches):
+    '''sgd_step_stochastic_forward_projection with one backward pass and one optimiser step'''
+    with sgd_autocast(model):
+        local_losses, yhat = model.forward_fp(x_i, y_i)
+        loss_out = loss_fn(yhat, y_i)
+    fused_backward_step(fused_optimiser(model, ["opts"]), sum(local_losses) + loss_out,
+                        getattr(model, "grad_scaler", None))
+    return loss_out.detach() / n_batches
+
+
+sgd_step_dict = {"backprop": sgd_step_backprop,
+                 "local_supervision": sgd_step_local_supervision,
+                 "forward_forward": sgd_step_forward_forward,
+                 "predictive_coding": sgd_step_predictive_coding,
+                 "difference_target_propagation": sgd_step_difference_target_propagation,
+                 "direct_random_target_projection": sgd_step_direct_random_target_projection,
+                 "stochastic_forward_projection": sgd_step_stochastic_forward_projection,
+                 }
+fused_sgd_step_dict = {"local_supervision": sgd_step_local_supervision_fused,
+                       "forward_forward": sgd_step_forward_forward_fused,
+                       "predictive_coding": sgd_step_predictive_coding_fused,
+                       "difference_target_propagation": sgd_step_difference_target_propagation_fused,
+                       "stochastic_forward_projection": sgd_step_stochastic_forward_projection_fused,
+                       }
+# steps taking one backward pass through one forward graph. the per-layer steps take a backward pass per layer
+# through a shared graph, which a compiled forward frees after the first
+compilable_sgd_steps = [sgd_step_backprop] + list(fused_sgd_step_dict.values())
+# steps whose one optimiser step comes after the backward pass, so a step that runs out of memory has changed no
+# parameters and can be retried. the per-layer steps update layer by layer, and a retry would step the earlier
+# layers twice on the same batch
+atomic_sgd_steps = [sgd_step_backprop] + list(fused_sgd_step_dict.values())
+compiled_sgd_step_dict = {}
+
+
+def sgd_step_fn(training_method, fused_step=None):
+    '''the uncompiled training step of a method, fused for layerwise methods'''
+    if fused_step is None:
+        fused_step = sgd_fused_local_steps
+    if training_method not in sgd_step_dict:
+        raise ValueError(f"unknown training method {training_method}")
+    if fused_step and training_method in fused_sgd_step_dict:
+        return fused_sgd_step_dict[training_method]
+    return sgd_step_dict[training_method]
+
+
+def sgd_step(training_method, compile_step=None, fused_step=None):
+    '''looks up the training step of a method, fused for layerwise methods and compiled once if requested'''
+    if compile_step is None:
+        compile_step = sgd_compile_steps
+    step_fn = sgd_step_fn(training_method, fused_step)
+    if not compile_step:
+        return step_fn
+    if step_fn not in compiled_sgd_step_dict:
+        if step_fn in compilable_sgd_steps:
+            compiled_sgd_step_dict[step_fn] = torch.compile(step_fn)
+        else:
+            print(f"{training_method} steps take a backward pass per layer, running uncompiled")
+            compiled_sgd_step_dict[step_fn] = step_fn
+    return compiled_sgd_step_dict[step_fn]
+
 
 def train_sgd(model,
               x,
               y,
               loss_fn,
-              batch_size=10, ):
-    torch.cuda.empty_cache()
+              batch_size=10,
+              compile_step=None,
+              transform=None,
+              fused_step=None, ):
+    trim_cuda_cache("epoch")
     model.train()
 
-    # training
-    rand_idx = torch.randperm(len(x))
-    x_batches = torch.split(x[rand_idx], split_size_or_sections=batch_size)
-    y_batches = torch.split(y[rand_idx], split_size_or_sections=batch_size)
+    # training, batches are gathered ahead of the step that uses them
+    batches = BatchProducer(as_split(x, y), batch_size, shuffle=True, transform=transform,
+                            memory_format=getattr(model, "memory_format", None))
+    n_batches = len(batches)
+    step_fn = sgd_step(model.training_method, compile_step, fused_step)
+    # only atomic steps are retried after running out of memory, otherwise the error is raised
+    retry_oom = sgd_step_fn(model.training_method, fused_step) in atomic_sgd_steps
+
+    # batch losses are detached, so no autograd graph outlives its step
     train_loss = 0
-    if model.training_method == "backprop":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            yhat_i = model(x_i)
-            loss = loss_fn(yhat_i, y_i)
-            model.opt.zero_grad()
-            loss.backward()
-            model.opt.step()
-            train_loss += loss
-    if model.training_method == "local_supervision":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            yhats = model.forward_ls(x_i)
-            for l in range(len(yhats)):
-                loss_l = loss_fn(yhats[l], y_i)
-                model.opts[l].zero_grad()
-                loss_l.backward(inputs=tuple(model.layers[l].parameters()))
-                model.opts[l].step()
-            train_loss += loss_l / len(yhats)
-    if model.training_method == "forward_forward":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            y_neg_i = torch.argmax(torch.rand_like(y_i) - y_i, dim=1).to(device)
-            y_neg_i = torch.eye(y_i.shape[1]).to(device)[y_neg_i]
-            while y_i.ndim < x_i.ndim:
-                y_i = torch.unsqueeze(y_i, dim=-1)
-                y_neg_i = torch.unsqueeze(y_neg_i, dim=-1)
-            y_i = y_i.repeat(repeats=(1, 1) + x_i.shape[2:])
-            y_neg_i = y_neg_i.repeat(repeats=(1, 1) + x_i.shape[2:])
-            xy_pos = torch.concatenate([x_i, y_i], dim=1)
-            xy_neg = torch.concatenate([x_i, y_neg_i], dim=1)
-            g_pos = model.forward_ff(xy_pos)
-            g_neg = model.forward_ff(xy_neg)
-            for l in range(len(g_pos)):
-                loss_l = torch.log(1 + torch.exp(torch.concatenate([2 - g_pos[l], g_neg[l] - 2]))).mean()
-                model.opts[l].zero_grad()
-                loss_l.backward(inputs=tuple(model.layers[l].parameters()))
-                model.opts[l].step()
-                train_loss += loss_l / len(x_batches)
-    if model.training_method == "predictive_coding":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            local_losses, yhat = model.forward_pc(x_i)
-            for l in range(len(model.layers) - 1):
-                model.opts[l].zero_grad()
-                model.back_opts[l].zero_grad()
-                local_losses[l].backward()
-                model.opts[l].step()
-                model.back_opts[l].step()
-            loss_l = loss_fn(yhat, y_i)
-            model.opts[-1].zero_grad()
-            loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
-            model.opts[-1].step()
-            train_loss += loss_l / len(x_batches)
-    if model.training_method == "difference_target_propagation":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            local_losses, yhat = model.forward_pc(x_i)
-            for l in range(len(model.layers) - 1):
-                model.opts[l].zero_grad()
-                model.back_opts[l+1].zero_grad()
-                local_losses[l].backward()
-                model.opts[l].step()
-                model.back_opts[l+1].step()
-            loss_l = loss_fn(yhat, y_i)
-            model.opts[-1].zero_grad()
-            loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
-            model.opts[-1].step()
-            train_loss += loss_l / len(x_batches)
-
-
-    if model.training_method == "direct_random_target_projection":
-        for x_i, y_i in zip(x_batches, y_batches):
-            x_i = x_i.to(device)
-            y_i = y_i.to(device)
-            x = x_i.detach()
-            for l in range(len(model.layers) - 1):
-                x = x.detach()
-                x = model.layers[l](x)
-                x = model.activation_fn(x)
-                target = model.forward_proj[l](y_i)
-                target = model.activation_fn(target)
-                loss_l = torch.mean((x - target) ** 2)
-                model.opts[l].zero_grad()
-                loss_l.backward(inputs=tuple(model.layers[l].parameters()))
-                model.opts[l].step()
-            x = x.detach()
-            yhat = model.layers[-1](x)
-            loss_l = loss_fn(yhat, y_i)
-            model.opts[-1].zero_grad()
-            loss_l.backward(inputs=tuple(model.layers[-1].parameters()))
-            model.opts[-1].step()
-            train_loss += loss_l / len(x_batches)
+    for x_i, y_i in batches:
+        if retry_oom:
+            train_loss += with_oom_retry(step_fn, model, x_i, y_i, loss_fn, n_batches)
+        else:
+            train_loss += step_fn(model, x_i, y_i, loss_fn, n_batches)
 
     return train_loss
 
 
+'''
+running mean and variance of a stream of values (welford), kept as device tensors so updates never wait
+for the device. stderr() is the standard error of the mean
+'''
+class StreamingMean:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.n
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    def stderr(self):
+        if self.n < 2:
+            return torch.zeros(())
+        return torch.as_tensor(self.m2 / (self.n - 1) / self.n).sqrt()
+
+
 def validate_sgd(model,
                  x,
                  y,
                  loss_fn,
-                 batch_size=25, ):
-    torch.cuda.empty_cache()
+                 batch_size=25,
+                 return_stderr=False, ):
+    trim_cuda_cache("epoch")
     model.eval()
     with torch.no_grad():
         val_loss = 0
-        x_batches = torch.split(x, split_size_or_sections=batch_size)
-        y_batches = torch.split(y, split_size_or_sections=batch_size)
+        batches = BatchProducer(as_split(x, y), batch_size, memory_format=getattr(model, "memory_format", None))
+        n_batches = len(batches)
+        # batch losses are also streamed, for the standard error of the validation loss
+        batch_stats = StreamingMean()
         if model.training_method != "forward_forward":
-            for x_i, y_i in zip(x_batches, y_batches):
-                x_i = x_i.to(device)
-                y_i = y_i.to(device)
-                yhat_i = model(x_i)
-                loss_i = loss_fn(yhat_i, y_i)
+            for x_i, y_i in batches:
+                with sgd_autocast(model):
+                    yhat_i = model(x_i)
+                    loss_i = loss_fn(yhat_i, y_i)
                 val_loss += loss_i
+                if return_stderr:
+                    batch_stats.update(loss_i)
         else:
-            for x_i, y_i in zip(x_batches, y_batches):
-                x_i = x_i.to(device)
-                y_i = y_i.to(device)
-                y_neg_i = torch.argmax(torch.rand_like(y_i) - y_i, dim=1).to(device)
-                y_neg_i = torch.eye(y_i.shape[1]).to(device)[y_neg_i]
-                while y_i.ndim < x_i.ndim:
-                    y_i = torch.unsqueeze(y_i, dim=-1)
-                    y_neg_i = torch.unsqueeze(y_neg_i, dim=-1)
-                y_i = y_i.repeat(repeats=(1, 1) + x_i.shape[2:])
-                y_neg_i = y_neg_i.repeat(repeats=(1, 1) + x_i.shape[2:])
-                xy_pos = torch.concatenate([x_i, y_i], dim=1)
-                xy_neg = torch.concatenate([x_i, y_neg_i], dim=1)
-                g_pos = model.forward_ff(xy_pos)
-                g_neg = model.forward_ff(xy_neg)
-                for g_pos_l, g_neg_l in zip(g_pos, g_neg):
-                    loss_l = torch.log(1 + torch.exp(torch.concatenate([2 - g_pos_l, g_neg_l - 2]))).mean()
-                    val_loss += loss_l / len(g_pos)
-        val_loss /= len(x_batches)
+            for x_i, y_i in batches:
+                with sgd_autocast(model):
+                    local_losses = ff_contrastive_losses(model, x_i, y_i)
+                for loss_l in local_losses:
+                    val_loss += loss_l / len(local_losses)
+                if return_stderr:
+                    batch_stats.update(sum(local_losses) / len(local_losses))
+        val_loss /= n_batches
+        if return_stderr:
+            return val_loss, batch_stats.stderr()
         return val_loss
 
 
@@ -1115,30 +2610,284 @@ def evaluate_sgd(model,
                  ):
     model.eval()
     with torch.no_grad():
-        torch.cuda.empty_cache()
-        x_batches = torch.split(x, split_size_or_sections=batch_size)
+        trim_cuda_cache("epoch")
+        data = as_split(x, y)
+        x_batches = (x_i for x_i, _ in BatchProducer(data, batch_size,
+                                                     memory_format=getattr(model, "memory_format", None)))
         if model.training_method != "forward_forward":
-            yhat = [model(x_i.to(device)) for x_i in x_batches]
+            yhat = []
+            for x_i in x_batches:
+                with sgd_autocast(model):
+                    yhat_i = model(x_i)
+                yhat.append(yhat_i.float())
         else:
+            # every class candidate is scored in one forward pass
             yhat = []
-            n_classes = y.shape[1]
+            n_classes = data.num_classes
+            candidates = torch.eye(n_classes, device=device).unsqueeze(1)
             for x_i in x_batches:
-                x_i = x_i.to(device)
-                y_candidates = torch.eye(n_classes).unsqueeze(1).repeat(1, len(x_i), 1).to(device)
-                while y_candidates.ndim < (x_i.ndim + 1):
-                    y_candidates = torch.unsqueeze(y_candidates, dim=-1)
-                y_candidates = y_candidates.repeat(repeats=(1, 1, 1) + x_i.shape[2:])
-                yhat_i = torch.zeros((len(x_i), n_classes))
-                for j in range(n_classes):
-                    xy_ij = torch.concatenate([x_i, y_candidates[j]], dim=1)
-                    goodness_i = model.forward_ff(xy_ij)
-                    yhat_i[:, j] = torch.mean(torch.stack(goodness_i), dim=0)
-                yhat.append(yhat_i)
+                with sgd_autocast(model):
+                    goodness_i = model.forward_ff(x_i, candidates.expand(-1, len(x_i), -1))
+                yhat_i = torch.mean(torch.stack(goodness_i).float(), dim=0).view(n_classes, len(x_i)).T
+                yhat.append(yhat_i.cpu())
 
         yhat = torch.concatenate(yhat)
-        metrics = compute_metrics(yhat, y)
+        metrics = compute_metrics(yhat, data.labels())
         return metrics
 
+
+def model_optimisers(model):
+    '''the optimisers an sgd model carries, keyed by attribute name'''
+    optimisers = {}
+    if hasattr(model, "opt"):
+        optimisers["opt"] = [model.opt]
+    if getattr(model, "fused_opt", None) is not None:
+        optimisers["fused_opt"] = [model.fused_opt]
+    for name in ["opts", "back_opts"]:
+        if hasattr(model, name):
+            optimisers[name] = list(getattr(model, name))
+    return optimisers
+
+
+'''
+Early stopping on the validation loss. Training stops once the loss has not improved for patience - 1
+epochs in a row. snapshot="memory" or "disk" keeps the weights and optimiser states of the best epoch,
+so the best model can be restored instead of retrained, snapshot=None only tracks the patience.
+'''
+class EarlyStopping:
+    def __init__(self, patience=5, snapshot="memory", path=None):
+        self.patience = patience
+        self.snapshot = snapshot
+        self.path = path
+        if snapshot == "disk" and path is None:
+            self.path = os.path.join(tempfile.gettempdir(), f"sgd_snapshot_{os.getpid()}_{id(self)}.pt")
+        self.best_loss = torch.inf
+        self.best_epoch = None
+        self.counter = 0
+        self.state = None
+
+    def update(self, model, val_loss, epoch, margin=0.):
+        '''
+        records a validation loss, returns True when training should stop.
+        only a loss more than margin below the best counts as an improvement
+        '''
+        if val_loss < self.best_loss - margin:
+            self.best_loss = val_loss
+            self.best_epoch = epoch
+            self.counter = 0
+            if self.snapshot:
+                self.save(model)
+        else:
+            self.counter += 1
+        return self.counter == (self.patience - 1)
+
+    def save(self, model):
+        state = {"model": {k: v.detach().clone() for k, v in model.state_dict().items()},
+                 "optimisers": {name: [copy.deepcopy(opt_l.state_dict()) for opt_l in opts]
+                                for name, opts in model_optimisers(model).items()}}
+        if self.snapshot == "disk":
+            torch.save(state, self.path)
+        else:
+            self.state = state
+
+    def restore(self, model):
+        '''loads the best weights and optimiser states back into the model'''
+        if self.best_epoch is None:
+            return model
+        state = torch.load(self.path, map_location=device) if self.snapshot == "disk" else self.state
+        model.load_state_dict(state["model"])
+        for name, opts in model_optimisers(model).items():
+            for opt_l, opt_state in zip(opts, state["optimisers"].get(name, [])):
+                opt_l.load_state_dict(opt_state)
+        return model
+
+    def clear(self):
+        if self.snapshot == "disk" and os.path.exists(self.path):
+            os.remove(self.path)
+        self.state = None
+
+
+sgd_refit_policies = ["last", "best", "warm_start", "retrain"]
+
+
+def fit_sgd_early_stopping(model,
+                           X_train,
+                           Y_train,
+                           X_val,
+                           Y_val,
+                           loss_fn,
+                           batch_size,
+                           patience=5,
+                           max_epochs=50,
+                           snapshot="memory",
+                           verbose=False,
+                           validate_every=1,
+                           validate_seconds=None,
+                           val_subsample=None,
+                           min_delta_se=0.,
+                           ):
+    '''
+    trains on the training split until the validation loss stops improving.
+    validation runs every validate_every epochs, or, with validate_seconds, once that much training time has
+    passed since the last validation, and patience counts validations. val_subsample (a number of rows) validates
+    on a fixed random subsample, drawn once. with min_delta_se > 0 a validation loss only counts as an improvement
+    when it is more than min_delta_se standard errors (over validation batches) below the best
+    '''
+    stopper = EarlyStopping(patience=patience, snapshot=snapshot)
+    train_loss = LossLog()
+    val_loss = LossLog()
+    val_data = as_split(X_val, Y_val)
+    if val_subsample is not None and val_subsample < len(val_data):
+        # its own generator, so the subsample is fixed and the global random state is untouched
+        generator = torch.Generator().manual_seed(0)
+        val_data = val_data.subset(torch.randperm(len(val_data), generator=generator)[:val_subsample])
+    last_validation = time.perf_counter()
+    for epoch_i in range(max_epochs):
+        train_loss_i = train_sgd(model=model,
+                                 x=X_train,
+                                 y=Y_train,
+                                 loss_fn=loss_fn,
+                                 batch_size=batch_size)
+        train_loss.append(train_loss_i)
+        if validate_seconds is None:
+            validate = (epoch_i + 1) % validate_every == 0
+        else:
+            validate = time.perf_counter() - last_validation >= validate_seconds
+        if not validate:
+            continue
+        val_loss_i, val_stderr_i = validate_sgd(model=model,
+                                                x=val_data,
+                                                y=None,
+                                                loss_fn=loss_fn,
+                                                batch_size=batch_size,
+                                                return_stderr=True)
+        last_validation = time.perf_counter()
+        val_loss.append(val_loss_i)
+        if verbose:
+            print(val_loss_i, val_stderr_i)
+        # the patience check is the one per-validation wait for the device
+        if stopper.update(model, val_loss_i, epoch_i, margin=min_delta_se * val_stderr_i):
+            break
+    return stopper, epoch_i, train_loss.values(), val_loss.values()
+
+
+def refit_sgd(model,
+              new_model,
+              stopper,
+              X_train,
+              Y_train,
+              X_val,
+              Y_val,
+              loss_fn,
+              batch_size,
+              n_epochs,
+              refit="last",
+              refit_epochs=1,
+              ):
+    '''
+    produces the final model after early stopping.
+    "last" keeps the model as trained, "best" restores the best snapshot,
+    "warm_start" restores the best snapshot and trains it for refit_epochs more epochs on train+val,
+    "retrain" trains new_model() from scratch on train+val for n_epochs epochs
+    '''
+    if refit not in sgd_refit_policies:
+        raise ValueError(f"unknown refit policy {refit}")
+    if refit in ["best", "warm_start"]:
+        model = stopper.restore(model)
+    stopper.clear()
+    if refit == "retrain":
+        model = new_model()
+    if refit in ["warm_start", "retrain"]:
+        print("final training")
+        trainval_data = DataSplit.concatenate([as_split(X_train, Y_train), as_split(X_val, Y_val)])
+        for _ in range(refit_epochs if refit == "warm_start" else n_epochs):
+            _ = train_sgd(model=model,
+                          x=trainval_data,
+                          y=None,
+                          loss_fn=loss_fn,
+                          batch_size=batch_size)
+    return model
+
+
+def time_sgd_epochs(model, x, y, loss_fn, batch_size, n_epochs=5, n_warmup=1):
+    '''wall times of n_epochs training epochs of model, after n_warmup untimed epochs'''
+    epoch_times = []
+    for epoch_i in range(n_warmup + n_epochs):
+        synchronise_device()
+        start_time = time.perf_counter()
+        _ = train_sgd(model=model,
+                      x=x,
+                      y=y,
+                      loss_fn=loss_fn,
+                      batch_size=batch_size)
+        synchronise_device()
+        if epoch_i >= n_warmup:
+            epoch_times.append(time.perf_counter() - start_time)
+    return np.array(epoch_times)
+
+
+def benchmark_sgd_epoch_time(new_model,
+                             x,
+                             y,
+                             loss_fn=torch.nn.CrossEntropyLoss(),
+                             batch_size=25,
+                             n_epochs=5,
+                             n_warmup=1,
+                             policies=["epoch", "oom"],
+                             ):
+    '''
+    steady-state training epoch time of new_model() under each cuda cache policy. the first n_warmup epochs
+    (allocator growth, compilation) are not timed. returns a data frame with one row per policy
+    '''
+    global cuda_cache_policy
+    previous_policy = cuda_cache_policy
+    rows = []
+    try:
+        for policy in policies:
+            cuda_cache_policy = policy
+            model = new_model()
+            epoch_times = time_sgd_epochs(model, x, y, loss_fn, batch_size, n_epochs, n_warmup)
+            rows.append({'policy': policy,
+                         'training_method': model.training_method,
+                         'mean_epoch_time': epoch_times.mean(),
+                         'min_epoch_time': epoch_times.min(),
+                         'max_epoch_time': epoch_times.max(),
+                         })
+    finally:
+        cuda_cache_policy = previous_policy
+    return pd.DataFrame(rows)
+
+
+def benchmark_sgd_configurations(new_model,
+                                 x,
+                                 y,
+                                 loss_fn=torch.nn.CrossEntropyLoss(),
+                                 batch_size=25,
+                                 n_epochs=5,
+                                 n_warmup=1,
+                                 configurations=[dict(precision="float32", channels_last=False),
+                                                 dict(precision="float32", channels_last=True),
+                                                 dict(precision="bfloat16", channels_last=False),
+                                                 dict(precision="bfloat16", channels_last=True)],
+                                 ):
+    '''
+    steady-state training epoch time of new_model() under each precision and memory format configuration,
+    passed to configure_sgd_model. x should be a channels_first_view of the images, its layout is converted
+    per batch where it differs from the model's. returns a data frame with one row per configuration
+    '''
+    rows = []
+    for configuration in configurations:
+        model = configure_sgd_model(new_model(), **configuration)
+        epoch_times = time_sgd_epochs(model, x, y, loss_fn, batch_size, n_epochs, n_warmup)
+        rows.append({'precision': model.precision,
+                     'channels_last': model.memory_format is not None,
+                     'training_method': model.training_method,
+                     'mean_epoch_time': epoch_times.mean(),
+                     'min_epoch_time': epoch_times.min(),
+                     'max_epoch_time': epoch_times.max(),
+                     })
+    return pd.DataFrame(rows)
+
 #@title sgd mlp functions
 # <editor-fold desc="SGD mlp training and evaluation functions">
 
@@ -1215,11 +2964,15 @@ class mlpModel(nn.Module):
         yhats.append(self.layers[-1](x))
         return yhats
 
-    def forward_ff(self, xy):
+    def forward_ff(self, xy, ys=None):
+        # with ys, xy holds the inputs alone and is scored under every label set in ys (k, n, c)
         goodnesses = []
-        for layer_l in self.layers[:-1]:
-            xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
-            xy = layer_l(xy)
+        for l, layer_l in enumerate(self.layers[:-1]):
+            if l == 0 and ys is not None:
+                xy = ff_label_injection(layer_l, xy, ys)
+            else:
+                xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
+                xy = layer_l(xy)
             xy = self.activation_fn(xy)
             goodness_l = xy.square().mean(dim=1)
             goodnesses.append(goodness_l)
@@ -1283,50 +3036,49 @@ def train_sgd_mlp(X_train,
                   max_epochs=100,
                   batch_size=50,
                   verbose=False,
-                  loss_fn=torch.nn.CrossEntropyLoss()):
-    torch.cuda.empty_cache()
+                  loss_fn=torch.nn.CrossEntropyLoss(),
+                  refit="last",
+                  refit_epochs=1,
+                  snapshot="memory",
+                  validate_every=1,
+                  validate_seconds=None,
+                  val_subsample=None,
+                  min_delta_se=0.,
+                  precision=None):
+    trim_cuda_cache("experiment")
     start_time = time.perf_counter()
     activation_fn = activation_dict[activation]
 
     in_features = X_train.shape[1]
-    model = mlpModel(
-        training_method=training_method,
-        in_features=in_features,
-        hidden_dims=hidden_dims,
-        num_classes=Y_train.shape[1],
-        activation_fn=activation_fn,
-    ).to(device)
-    train_loss = []
-    val_loss = []
-    best_val_loss = torch.inf
-    patience_counter = 0
-    for epoch_i in range(max_epochs):
-        train_loss_i = train_sgd(model=model,
-                                 x=X_train,
-                                 y=Y_train,
-                                 loss_fn=loss_fn,
-                                 batch_size=batch_size)
-        train_loss.append(train_loss_i.item())
-        val_loss_i = validate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  loss_fn=loss_fn,
-                                  batch_size=batch_size)
-        val_loss.append(val_loss_i.item())
-        if verbose:
-            print(val_loss_i)
-        if val_loss_i < best_val_loss:
-            best_val_loss = val_loss_i
-            patience_counter = 0
-        else:
-            patience_counter += 1
-        if patience_counter == (patience - 1):
-            break
+    def new_model():
+        model = mlpModel(
+            training_method=training_method,
+            in_features=in_features,
+            hidden_dims=hidden_dims,
+            num_classes=as_split(X_train, Y_train).num_classes,
+            activation_fn=activation_fn,
+        ).to(device)
+        return configure_sgd_model(model, precision)
+    model = new_model()
+    # snapshots are only taken when the refit policy uses them
+    stopper, epoch_i, train_loss, val_loss = fit_sgd_early_stopping(
+        model, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+        patience=patience,
+        max_epochs=max_epochs,
+        snapshot=snapshot if refit in ["best", "warm_start"] else None,
+        verbose=verbose,
+        validate_every=validate_every,
+        validate_seconds=validate_seconds,
+        val_subsample=val_subsample,
+        min_delta_se=min_delta_se)
 
     end_time = time.perf_counter()
     training_time = end_time - start_time
     training_epochs = epoch_i
 
+    model = refit_sgd(model, new_model, stopper, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+                      n_epochs=epoch_i, refit=refit, refit_epochs=refit_epochs)
+
     return model, training_time, training_epochs
 
 # </editor-fold>
@@ -1342,16 +3094,19 @@ class conv1dModel(nn.Module):
                  hidden_dims=None,
                  num_classes=None,
                  kernel_size=3,
+                 strided=True,  # odd layers are stride 2 convolutions, otherwise computed in full and subsampled
                  ):
         super(conv1dModel, self).__init__()
         self.activation_fn = activation_fn
         self.in_features = [in_features] + hidden_dims
+        self.strided = strided
         if training_method == "forward_forward":
             self.in_features[0] += num_classes
         self.out_features = hidden_dims + [num_classes]
+        self.strides = [2 if (l % 2 and strided) else 1 for l in range(len(hidden_dims))]
         self.layers = []
-        for in_l, out_l in zip(self.in_features[:-1], self.out_features[:-1]):
-            self.layers.append(nn.Conv1d(in_l, out_l, kernel_size))
+        for in_l, out_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+            self.layers.append(nn.Conv1d(in_l, out_l, kernel_size, stride=stride_l))
         self.layers.append(nn.Linear(self.in_features[-1], self.out_features[-1]))
         self.layers = nn.ModuleList(self.layers)
         self.batch_norms = nn.ModuleList([nn.BatchNorm1d(out_l) for out_l in hidden_dims[1::2]])
@@ -1367,14 +3122,14 @@ class conv1dModel(nn.Module):
                                           lr=0.03) for layer_l in self.layers]
         if training_method == "predictive_coding":
             self.back_layers = nn.ModuleList([])
-            for out_l, in_l in zip(self.in_features[:-1], self.out_features[:-1]):
-                self.back_layers.append(nn.ConvTranspose1d(in_l, out_l, kernel_size))
+            for out_l, in_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+                self.back_layers.append(nn.ConvTranspose1d(in_l, out_l, kernel_size, stride=stride_l))
             self.opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.layers]
             self.back_opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.back_layers]
         if training_method == "difference_target_propagation":
             self.back_layers = nn.ModuleList([])
-            for out_l, in_l in zip(self.in_features[:-1], self.out_features[:-1]):
-                self.back_layers.append(nn.ConvTranspose1d(in_l, out_l, kernel_size))
+            for out_l, in_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+                self.back_layers.append(nn.ConvTranspose1d(in_l, out_l, kernel_size, stride=stride_l))
             self.back_layers.append(nn.Linear(self.out_features[-1], self.in_features[-1]))
             self.opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.layers]
             self.back_opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.back_layers]
@@ -1385,7 +3140,8 @@ class conv1dModel(nn.Module):
             x = self.layers[l](x)
             x = self.activation_fn(x)
             if l % 2:
-                x = x[..., ::2]
+                if not self.strided:
+                    x = x[..., ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         x = torch.mean(x, dim=2)
@@ -1401,7 +3157,8 @@ class conv1dModel(nn.Module):
             yhat_l = self.ls_layers[l](x_mu)
             yhats.append(yhat_l)
             if l % 2:
-                x = x[..., ::2]
+                if not self.strided:
+                    x = x[..., ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
             x = torch.detach(x)
@@ -1410,18 +3167,25 @@ class conv1dModel(nn.Module):
         yhats.append(yhat)
         return yhats
 
-    def forward_ff(self, xy):
+    def forward_ff(self, xy, ys=None):
+        # with ys, xy holds the inputs alone and is scored under every label set in ys (k, n, c)
+        n_sets = 1 if ys is None else ys.shape[0]
         goodnesses = []
         for l in range(len(self.layers) - 1):
-            xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
-            xy = self.layers[l](xy)
+            if l == 0 and ys is not None:
+                xy = ff_label_injection(self.layers[l], xy, ys)
+            else:
+                xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
+                xy = self.layers[l](xy)
             xy = self.activation_fn(xy)
             goodness_l = xy.square().mean(dim=(1, 2))
             goodnesses.append(goodness_l)
             if l % 2:
-                xy = xy[..., ::2]
+                if not self.strided:
+                    xy = xy[..., ::2]
                 if l < len(self.batch_norms):
-                    xy = self.batch_norms[l // 2](xy)
+                    # batch statistics are taken per label set, as if each set were its own batch
+                    xy = torch.concatenate([self.batch_norms[l // 2](xy_k) for xy_k in xy.chunk(n_sets)])
             xy = torch.detach(xy)
         return goodnesses
 
@@ -1430,13 +3194,14 @@ class conv1dModel(nn.Module):
         for l in range(len(self.layers) - 1):
             x_out = self.layers[l](x)
             x_out = self.activation_fn(x_out)
-            xhat = self.back_layers[l](x_out)
+            xhat = self.back_layers[l](x_out, output_size=x.shape[2:])
             xhat = self.activation_fn(xhat)
             loss_l = torch.mean((xhat - x) ** 2)
             local_losses.append(loss_l)
             x = x_out.detach()
             if l % 2:
-                x = x[..., ::2]
+                if not self.strided:
+                    x = x[..., ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         x = torch.mean(x, dim=2)
@@ -1452,7 +3217,8 @@ class conv1dModel(nn.Module):
             h_list.append(x)
             x = x.detach()
             if l % 2:
-                x = x[..., ::2]
+                if not self.strided:
+                    x = x[..., ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         out_shape = x.shape[2]
@@ -1466,14 +3232,16 @@ class conv1dModel(nn.Module):
             h_curr = h_list[-l].detach()
             h_prev = h_list[-(l + 1)].detach()
             hhat_curr = hhat_list[-l].detach()
-            ghhat_curr = self.back_layers[-l](hhat_curr)
+            # strided transposed convolutions are sized like the forward layer's input
+            back_size = {"output_size": h_prev.shape[2:]} if (self.strided and l > 1) else {}
+            ghhat_curr = self.back_layers[-l](hhat_curr, **back_size)
             ghhat_curr = self.activation_fn(ghhat_curr)
-            gh_curr = self.back_layers[-l](h_curr)
+            gh_curr = self.back_layers[-l](h_curr, **back_size)
             gh_curr = self.activation_fn(gh_curr)
             if l == 1:
                 gh_curr = gh_curr[..., None].repeat((1, 1, out_shape))
                 ghhat_curr = ghhat_curr[..., None].repeat((1, 1, out_shape))
-            if (l % 2) == 0:
+            if (l % 2) == 0 and not self.strided:
                 gh_curr = gh_curr.repeat_interleave(repeats=2, dim=2)
                 ghhat_curr = ghhat_curr.repeat_interleave(repeats=2, dim=2)
             hhat_prev = h_prev + ghhat_curr - gh_curr
@@ -1499,180 +3267,414 @@ def train_sgd_conv1d(X_train,
                      max_epochs=50,
                      batch_size=25,
                      verbose=False,
-                     loss_fn=torch.nn.CrossEntropyLoss()):
-    torch.cuda.empty_cache()
+                     loss_fn=torch.nn.CrossEntropyLoss(),
+                     strided=True,
+                     refit="retrain",
+                     refit_epochs=1,
+                     snapshot="memory",
+                     validate_every=1,
+                     validate_seconds=None,
+                     val_subsample=None,
+                     min_delta_se=0.,
+                     precision=None):
+    trim_cuda_cache("experiment")
     start_time = time.perf_counter()
 
     activation_fn = activation_dict[activation]
-    model = conv1dModel(
-        in_features=X_train.shape[1],
-        hidden_dims=hidden_dims,
-        num_classes=Y_train.shape[1],
-        activation_fn=activation_fn,
-        kernel_size=kernel_size,
-        training_method=training_method
-    ).to(device)
-    train_loss = []
-    val_loss = []
-    best_val_loss = torch.inf
-    patience_counter = 0
-    for epoch_i in range(max_epochs):
-        train_loss_i = train_sgd(model=model,
-                                 x=X_train,
-                                 y=Y_train,
-                                 loss_fn=loss_fn,
-                                 batch_size=batch_size
-                                 )
-        train_loss.append(train_loss_i.item())
-        val_loss_i = validate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  loss_fn=loss_fn,
-                                  batch_size=batch_size)
-        val_loss.append(val_loss_i.item())
-        if verbose:
-            print(val_loss_i)
-        if val_loss_i < best_val_loss:
-            best_val_loss = val_loss_i
-            patience_counter = 0
-        else:
-            patience_counter += 1
-        if patience_counter == (patience - 1):
-            break
+    def new_model():
+        model = conv1dModel(
+            in_features=X_train.shape[1],
+            hidden_dims=hidden_dims,
+            num_classes=as_split(X_train, Y_train).num_classes,
+            activation_fn=activation_fn,
+            kernel_size=kernel_size,
+            training_method=training_method,
+            strided=strided
+        ).to(device)
+        return configure_sgd_model(model, precision)
+    model = new_model()
+    # snapshots are only taken when the refit policy uses them
+    stopper, epoch_i, train_loss, val_loss = fit_sgd_early_stopping(
+        model, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+        patience=patience,
+        max_epochs=max_epochs,
+        snapshot=snapshot if refit in ["best", "warm_start"] else None,
+        verbose=verbose,
+        validate_every=validate_every,
+        validate_seconds=validate_seconds,
+        val_subsample=val_subsample,
+        min_delta_se=min_delta_se)
 
     end_time = time.perf_counter()
     training_time = end_time - start_time
     training_epochs = epoch_i
 
-    model = conv1dModel(
-        in_features=X_train.shape[1],
-        hidden_dims=hidden_dims,
-        num_classes=Y_train.shape[1],
-        activation_fn=activation_fn,
-        kernel_size=kernel_size,
-        training_method=training_method
-    ).to(device)
-    print("final training")
-    X_trainval = torch.concatenate([X_train, X_val])
-    Y_trainval = torch.concatenate([Y_train, Y_val])
-    for _ in range(epoch_i):
-        _ = train_sgd(model=model,
-                      x=X_trainval,
-                      y=Y_trainval,
-                      loss_fn=loss_fn,
-                      batch_size=batch_size)
+    model = refit_sgd(model, new_model, stopper, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+                      n_epochs=epoch_i, refit=refit, refit_epochs=refit_epochs)
 
     return model, training_time, training_epochs
 
 
-# </editor-fold>
+'''
+trains the backprop conv1d models of several splits (X_train, Y_train, X_val, Y_val) in lock-step with
+train_sgd_stacked, with the model and refit policy of train_sgd_conv1d
+'''
+def train_sgd_conv1d_stacked(splits,
+                             hidden_dims,
+                             activation,
+                             training_method,
+                             kernel_size=3,
+                             patience=5,
+                             max_epochs=50,
+                             batch_size=25,
+                             verbose=False,
+                             loss_fn=torch.nn.CrossEntropyLoss(),
+                             strided=True,
+                             refit="retrain",
+                             precision=None):
+    X_train, Y_train, _, _ = splits[0]
+    activation_fn = activation_dict[activation]
+    def new_model():
+        model = conv1dModel(
+            in_features=X_train.shape[1],
+            hidden_dims=hidden_dims,
+            num_classes=as_split(X_train, Y_train).num_classes,
+            activation_fn=activation_fn,
+            kernel_size=kernel_size,
+            training_method=training_method,
+            strided=strided
+        ).to(device)
+        return configure_sgd_model(model, precision)
+    return train_sgd_stacked(new_model, splits,
+                             patience=patience,
+                             max_epochs=max_epochs,
+                             batch_size=batch_size,
+                             verbose=verbose,
+                             loss_fn=loss_fn,
+                             refit=refit)
 
-#@title sgd conv1d experiments
 
-# <editor-fold desc="SGD conv1d experiments">
+# </editor-fold>
 
-sgd_training_methods = [
-    "backprop",
-    "local_supervision",
-    "forward_forward",
-    "predictive_coding",
-    "difference_target_propagation",
-]
+#@title stacked sgd training functions
+# <editor-fold desc="SGD training of several models in lock-step with torch.func">
+
+sgd_stacked_folds = False # backprop rows of the 5-fold sgd grids (conv1d, ViT) train all folds in lock-step
+stacked_sgd_fits = {} # fits of all folds per grid key, see stacked_fold_fit
+
+def stacked_adam_step(params, grads, exp_avgs, exp_avg_sqs, steps, idx, hyper):
+    '''adam update of the models idx of stacked parameters, each model with its own step count'''
+    lr, (beta1, beta2), eps, weight_decay = hyper["lr"], hyper["betas"], hyper["eps"], hyper["weight_decay"]
+    steps[idx] += 1
+    for name, grad in grads.items():
+        param = params[name][idx]
+        if weight_decay:
+            grad = grad + weight_decay * param
+        step = steps[idx].view((-1,) + (1,) * (param.ndim - 1))
+        exp_avg = exp_avgs[name][idx].lerp(grad, 1 - beta1)
+        exp_avg_sq = exp_avg_sqs[name][idx] * beta2 + (1 - beta2) * grad * grad
+        step_size = lr / (1 - beta1 ** step)
+        denom = exp_avg_sq.sqrt() / (1 - beta2 ** step).sqrt() + eps
+        params[name][idx] = param - step_size * exp_avg / denom
+        exp_avgs[name][idx] = exp_avg
+        exp_avg_sqs[name][idx] = exp_avg_sq
+
+
+def stacked_batch_groups(batches):
+    '''groups the models by the shape of their current batch, models without a batch are left out'''
+    groups = {}
+    for k, batch_k in enumerate(batches):
+        if batch_k is not None:
+            groups.setdefault(tuple(batch_k[0].shape) + tuple(batch_k[1].shape), []).append(k)
+    return list(groups.values())
+
+
+def stacked_subset(tensors, idx, n_models):
+    '''stacked tensors of the models idx, the tensors themselves when idx covers every model'''
+    if len(idx) == n_models:
+        return tensors
+    return {name: tensor[idx] for name, tensor in tensors.items()}
 
-model_parameters = expand_grid({
-    'fold': torch.arange(5),
-    'activation': ["relu"],
-    'training_method': ["backprop","local_supervision"],
-})
 
-conv1d_datasets = ['human_nontata_promoters']
+'''
+trains models in lock-step, each on its own training split. parameters and buffers are stacked with
+torch.func.stack_module_state, and every step is one vmapped forward and backward over the models whose batches
+share a shape, followed by an adam update with the hyperparameters of the models' own optimisers. each model keeps
+its own shuffled batches and step count, and is masked out of the updates once it stops: after early stopping on
+its val_splits, or after its n_epochs epochs when val_splits is None. the models are updated in place, returns
+their training epochs
+'''
+def fit_sgd_stacked(models,
+                    train_splits,
+                    loss_fn,
+                    batch_size,
+                    val_splits=None,
+                    n_epochs=None,
+                    patience=5,
+                    max_epochs=50,
+                    verbose=False):
+    n_models = len(models)
+    params, buffers = torch.func.stack_module_state(models)
+    params = {name: param.detach() for name, param in params.items()}
+    base = copy.deepcopy(models[0]).to("meta")
+    # only the parameters the models' optimisers update are trained, as in train_sgd
+    opt_params = set(id(param) for group in models[0].opt.param_groups for param in group["params"])
+    opt_names = [name for name, param in models[0].named_parameters() if id(param) in opt_params]
+    hyper = models[0].opt.param_groups[0]
+    exp_avgs = {name: torch.zeros_like(params[name]) for name in opt_names}
+    exp_avg_sqs = {name: torch.zeros_like(params[name]) for name in opt_names}
+    steps = torch.zeros(n_models, device=params[opt_names[0]].device)
+
+    def batch_loss(params_k, buffers_k, x_i, y_i):
+        yhat_i = torch.func.functional_call(base, (params_k, buffers_k), (x_i,))
+        return loss_fn(yhat_i, y_i)
+    grad_fn = torch.func.vmap(torch.func.grad_and_value(batch_loss, argnums=0))
+    loss_fn_stacked = torch.func.vmap(batch_loss)
+
+    def run_epoch(data_splits, active, train):
+        '''one pass over every active model's batches, returns the mean batch loss per model'''
+        base.train(train)
+        iterators = [iter(BatchProducer(data_splits[k], batch_size, shuffle=train, device=None)) if active[k]
+                     else iter(()) for k in range(n_models)]
+        epoch_loss = torch.zeros(n_models, device=steps.device)
+        n_batches = torch.zeros(n_models, device=steps.device)
+        while True:
+            batches = [next(iterator, None) for iterator in iterators]
+            if all(batch_k is None for batch_k in batches):
+                return epoch_loss / n_batches.clamp(min=1)
+            for idx in stacked_batch_groups(batches):
+                x_i = torch.stack([batches[k][0] for k in idx]).to(device)
+                y_i = torch.stack([batches[k][1] for k in idx]).to(device)
+                params_idx = stacked_subset(params, idx, n_models)
+                buffers_idx = stacked_subset(buffers, idx, n_models)
+                if train:
+                    grads, loss_i = grad_fn(params_idx, buffers_idx, x_i, y_i)
+                    with torch.no_grad():
+                        stacked_adam_step(params, {name: grads[name] for name in opt_names},
+                                          exp_avgs, exp_avg_sqs, steps, idx, hyper)
+                        # batch norm running statistics are updated in place, in copies for a subset of models
+                        if len(idx) < n_models:
+                            for name, buffer in buffers_idx.items():
+                                buffers[name][idx] = buffer
+                else:
+                    with torch.no_grad():
+                        loss_i = loss_fn_stacked(params_idx, buffers_idx, x_i, y_i)
+                epoch_loss[idx] += loss_i.detach()
+                n_batches[idx] += 1
+
+    if val_splits is None:
+        training_epochs = list(n_epochs)
+        active = [n > 0 for n in training_epochs]
+        for epoch_i in range(max(training_epochs, default=0)):
+            run_epoch(train_splits, active, train=True)
+            active = [epoch_i + 1 < n for n in training_epochs]
+    else:
+        active = [True] * n_models
+        stoppers = [EarlyStopping(patience=patience, snapshot=None) for _ in range(n_models)]
+        training_epochs = [max_epochs - 1] * n_models
+        for epoch_i in range(max_epochs):
+            run_epoch(train_splits, active, train=True)
+            val_loss_i = run_epoch(val_splits, active, train=False)
+            for k in range(n_models):
+                if not active[k]:
+                    continue
+                if verbose:
+                    print(k, val_loss_i[k])
+                if stoppers[k].update(None, val_loss_i[k], epoch_i):
+                    active[k] = False
+                    training_epochs[k] = epoch_i
+            if not any(active):
+                break
+
+    # copied by the deduplicated names of stack_module_state, so layers registered twice are written once
+    stacked = params | buffers
+    with torch.no_grad():
+        for k, model in enumerate(models):
+            for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+                tensor.copy_(stacked[name][k])
+    return training_epochs
 
-verbose = False
 
-seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
-sgd_conv1d_experiments = []
-for dataset_i in conv1d_datasets:
+'''
+trains one backprop model per data split (e.g. one per fold) in lock-step with fit_sgd_stacked, so that several
+small models share the hardware. new_model() builds one untrained model, splits holds (X_train, Y_train, X_val,
+Y_val) per model. refit follows refit_sgd: "last" keeps the models as trained, "retrain" trains new models from
+scratch on train+val for their early stopping epochs, again in lock-step. the policies that restore snapshots are
+not supported. training_time is the wall time of the lock-step early stopping of all the models (without the
+refit, as in the sequential trainers), so it is the same for every model of the call
+'''
+def train_sgd_stacked(new_model,
+                      splits,
+                      patience=5,
+                      max_epochs=50,
+                      batch_size=25,
+                      verbose=False,
+                      loss_fn=torch.nn.CrossEntropyLoss(),
+                      refit="last"):
+    if refit not in ["last", "retrain"]:
+        raise ValueError(f"refit policy {refit} is not supported by stacked training")
+    trim_cuda_cache("experiment")
+    start_time = time.perf_counter()
 
-    print(dataset_i)
+    models = [new_model() for _ in splits]
+    if any(model.training_method != "backprop" for model in models):
+        raise ValueError("only backprop models can be trained stacked")
+    train_splits = [as_split(X_train, Y_train) for X_train, Y_train, _, _ in splits]
+    val_splits = [as_split(X_val, Y_val) for _, _, X_val, Y_val in splits]
+
+    training_epochs = fit_sgd_stacked(models, train_splits, loss_fn, batch_size,
+                                      val_splits=val_splits,
+                                      patience=patience,
+                                      max_epochs=max_epochs,
+                                      verbose=verbose)
+    end_time = time.perf_counter()
+    training_time = end_time - start_time
 
-    X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i, channels_last=False)
+    if refit == "retrain":
+        print("final training")
+        models = [new_model() for _ in splits]
+        trainval_splits = [DataSplit.concatenate([train_split, val_split])
+                           for train_split, val_split in zip(train_splits, val_splits)]
+        fit_sgd_stacked(models, trainval_splits, loss_fn, batch_size, n_epochs=training_epochs)
+
+    return [(model, training_time, training_epochs[k]) for k, model in enumerate(models)]
+
+
+'''
+the (model, training_time, training_epochs) of fold from the lock-step training of all folds, and the number of
+models trained together. train_folds() returns the fits of every fold, it runs for the first row of a key and its
+fits are kept in stacked_sgd_fits for the other folds' rows
+'''
+def stacked_fold_fit(key, fold, train_folds):
+    if key not in stacked_sgd_fits:
+        stacked_sgd_fits[key] = train_folds()
+    return stacked_sgd_fits[key][int(fold)], len(stacked_sgd_fits[key])
+
+
+# </editor-fold>
+
+#@title sgd conv1d experiments
+
+# <editor-fold desc="SGD conv1d experiments">
 
-    for model_parameters_i in range(len(model_parameters)):
-        print(model_parameters_i)
+sgd_training_methods = [
+    "backprop",
+    "local_supervision",
+    "forward_forward",
+    "predictive_coding",
+    "difference_target_propagation",
+]
+
+model_parameters = expand_grid({
+    'fold': torch.arange(5),
+    'activation': ["relu"],
+    'training_method': ["backprop","local_supervision"],
+})
+
+conv1d_datasets = ['human_nontata_promoters']
+
+verbose = False
+seed = 0
 
-        fold = model_parameters.fold[model_parameters_i]
-        activation = model_parameters.activation[model_parameters_i]
-        training_method = model_parameters.training_method[model_parameters_i]
-        hidden_dim = 32
-        n_blocks = 4
-        hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
 
-        train_folds = folds != fold
-        val_folds = torch.logical_not(train_folds)
-        X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-        Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
+def sgd_conv1d_experiment(fold, activation, training_method):
+    hidden_dim = 32
+    n_blocks = 4
+    hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
 
+    train_idx, val_idx = fold_indices(folds, fold)
+    train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+    val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+    if sgd_stacked_folds and training_method == "backprop":
+        def train_folds():
+            splits = [(DataSplit(X_trainval, Y_trainval, train_idx_k), None,
+                       DataSplit(X_trainval, Y_trainval, val_idx_k), None)
+                      for train_idx_k, val_idx_k in [fold_indices(folds, k) for k in range(len(folds.unique()))]]
+            return train_sgd_conv1d_stacked(splits,
+                                            hidden_dims=hidden_dims,
+                                            activation=activation,
+                                            training_method=training_method,
+                                            verbose=True)
+        (model, training_time, training_epochs), n_stacked_models = stacked_fold_fit(
+            ("conv1d", dataset_i, activation, tuple(hidden_dims)), fold, train_folds)
+    else:
         model, training_time, training_epochs = train_sgd_conv1d(
-            X_train=X_train,
-            Y_train=Y_train,
-            X_val=X_val,
-            Y_val=Y_val,
+            X_train=train_data,
+            Y_train=None,
+            X_val=val_data,
+            Y_val=None,
             hidden_dims=hidden_dims,
             activation=activation,
             training_method=training_method,
             verbose=True)
+        n_stacked_models = 1
 
-        train_metrics = evaluate_sgd(model=model,
-                                    x=X_train,
-                                    y=Y_train,
-                                    )
+    train_metrics = evaluate_sgd(model=model,
+                                x=train_data,
+                                y=None,
+                                )
 
-        val_metrics = evaluate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  )
+    val_metrics = evaluate_sgd(model=model,
+                              x=val_data,
+                              y=None,
+                              )
 
-        test_metrics = evaluate_sgd(model=model,
-                                    x=X_test,
-                                    y=Y_test,
-                                    )
-        if verbose:
-            print(training_method, dataset_i, activation, sep="\n")
-            print(train_metrics)
-            print(val_metrics)
-            print(test_metrics)
+    test_metrics = evaluate_sgd(model=model,
+                                x=X_test,
+                                y=Y_test,
+                                )
+    if verbose:
+        print(training_method, dataset_i, activation, sep="\n")
+        print(train_metrics)
+        print(val_metrics)
+        print(test_metrics)
 
-        out = {
-            'dataset': dataset_i,
-            'training_method': training_method,
-            'fold': fold,
-            'activation': activation,
-            'hidden_dim': hidden_dim,
-            'n_blocks': n_blocks,
-            'train_auc': train_metrics[0].item(),
-            'train_acc': train_metrics[1].item(),
-            'train_prec': train_metrics[2].item(),
-            'train_recall': train_metrics[3].item(),
-            'train_f1': train_metrics[4].item(),
-            'val_auc': val_metrics[0].item(),
-            'val_acc': val_metrics[1].item(),
-            'val_prec': val_metrics[2].item(),
-            'val_recall': val_metrics[3].item(),
-            'val_f1': val_metrics[4].item(),
-            'test_auc': test_metrics[0].item(),
-            'test_acc': test_metrics[1].item(),
-            'test_prec': test_metrics[2].item(),
-            'test_recall': test_metrics[3].item(),
-            'test_f1': test_metrics[4].item(),
-            'training_time': training_time,
-          'training_epochs': training_epochs,
-        }
-        sgd_conv1d_experiments.append(out)
+    out = {
+        'dataset': dataset_i,
+        'training_method': training_method,
+        'fold': fold,
+        'activation': activation,
+        'hidden_dim': hidden_dim,
+        'n_blocks': n_blocks,
+        'train_auc': train_metrics[0].item(),
+        'train_acc': train_metrics[1].item(),
+        'train_prec': train_metrics[2].item(),
+        'train_recall': train_metrics[3].item(),
+        'train_f1': train_metrics[4].item(),
+        'val_auc': val_metrics[0].item(),
+        'val_acc': val_metrics[1].item(),
+        'val_prec': val_metrics[2].item(),
+        'val_recall': val_metrics[3].item(),
+        'val_f1': val_metrics[4].item(),
+        'test_auc': test_metrics[0].item(),
+        'test_acc': test_metrics[1].item(),
+        'test_prec': test_metrics[2].item(),
+        'test_recall': test_metrics[3].item(),
+        'test_f1': test_metrics[4].item(),
+        'training_time': training_time,
+        'training_epochs': training_epochs,
+        'n_stacked_models': n_stacked_models,
+    }
+    return out
+
+
+sgd_conv1d_experiments = []
+for dataset_i in conv1d_datasets:
+
+    print(dataset_i)
+
+    X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i, channels_last=False)
+
+    # stacked rows are stored under their own keys, training_time is then the wall time of all n_stacked_models
+    store_file = os.path.join(store_dir, f"sgd_conv1d_experiments_{dataset_i}.jsonl")
+    sgd_conv1d_experiments.append(run_experiment_grid(sgd_conv1d_experiment,
+                                                      model_parameters,
+                                                      store_file=store_file,
+                                                      seed=seed,
+                                                      settings=dict(sgd_stacked_folds=True) if sgd_stacked_folds else None))
 
-sgd_conv1d_experiments = pd.DataFrame(sgd_conv1d_experiments)
+sgd_conv1d_experiments = pd.concat(sgd_conv1d_experiments, ignore_index=True)
 output_file = os.path.join(output_dir, "sgd_conv1d_experiments.csv")
 sgd_conv1d_experiments.to_csv(path_or_buf=output_file)
 
@@ -1691,18 +3693,21 @@ class conv2dModel(nn.Module):
                  num_classes=None,
                  kernel_size=3,
                  pad=0,
-                 lr=0.001
+                 lr=0.001,
+                 strided=True,  # odd layers are stride 2 convolutions, otherwise computed in full and subsampled
                  ):
         super().__init__()
         self.activation_fn = activation_fn
         self.in_features = [in_features] + hidden_dims
         self.pad = pad
+        self.strided = strided
         if training_method == "forward_forward":
             self.in_features[0] += num_classes
         self.out_features = hidden_dims + [num_classes]
+        self.strides = [2 if (l % 2 and strided) else 1 for l in range(len(hidden_dims))]
         self.layers = []
-        for in_l, out_l in zip(self.in_features[:-1], self.out_features[:-1]):
-            self.layers.append(nn.Conv2d(in_l, out_l, kernel_size, padding=self.pad))
+        for in_l, out_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+            self.layers.append(nn.Conv2d(in_l, out_l, kernel_size, stride=stride_l, padding=self.pad))
         self.layers.append(nn.Linear(self.in_features[-1], self.out_features[-1]))
         self.layers = nn.ModuleList(self.layers)
         self.batch_norms = nn.ModuleList([nn.BatchNorm2d(out_l) for out_l in hidden_dims[1::2]])
@@ -1721,14 +3726,14 @@ class conv2dModel(nn.Module):
                 [nn.Linear(num_classes, out_l) for out_l in hidden_dims])
         if training_method == "predictive_coding":
             self.back_layers = nn.ModuleList([])
-            for out_l, in_l in zip(self.in_features[:-1], self.out_features[:-1]):
-                self.back_layers.append(nn.ConvTranspose2d(in_l, out_l, kernel_size, padding=self.pad))
+            for out_l, in_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+                self.back_layers.append(nn.ConvTranspose2d(in_l, out_l, kernel_size, stride=stride_l, padding=self.pad))
             self.opts = [torch.optim.Adam(layer_l.parameters(), lr=lr) for layer_l in self.layers]
             self.back_opts = [torch.optim.Adam(layer_l.parameters(), lr=lr) for layer_l in self.back_layers]
         if training_method == "difference_target_propagation":
             self.back_layers = nn.ModuleList([])
-            for out_l, in_l in zip(self.in_features[:-1], self.out_features[:-1]):
-                self.back_layers.append(nn.ConvTranspose2d(in_l, out_l, kernel_size, padding=self.pad))
+            for out_l, in_l, stride_l in zip(self.in_features[:-1], self.out_features[:-1], self.strides):
+                self.back_layers.append(nn.ConvTranspose2d(in_l, out_l, kernel_size, stride=stride_l, padding=self.pad))
             self.back_layers.append(nn.Linear(self.out_features[-1], self.in_features[-1]))
             self.opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.layers]
             self.back_opts = [torch.optim.Adam(layer_l.parameters(), ) for layer_l in self.back_layers]
@@ -1738,7 +3743,8 @@ class conv2dModel(nn.Module):
             x = self.layers[l](x)
             x = self.activation_fn(x)
             if l % 2:
-                x = x[..., ::2, ::2]
+                if not self.strided:
+                    x = x[..., ::2, ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         x = torch.mean(x, dim=(2, 3))
@@ -1754,7 +3760,8 @@ class conv2dModel(nn.Module):
             yhat_l = self.ls_layers[l](x_mu)
             yhats.append(yhat_l)
             if l % 2:
-                x = x[..., ::2, ::2]
+                if not self.strided:
+                    x = x[..., ::2, ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
             x = torch.detach(x)
@@ -1763,18 +3770,25 @@ class conv2dModel(nn.Module):
         yhats.append(yhat)
         return yhats
 
-    def forward_ff(self, xy):
+    def forward_ff(self, xy, ys=None):
+        # with ys, xy holds the inputs alone and is scored under every label set in ys (k, n, c)
+        n_sets = 1 if ys is None else ys.shape[0]
         goodnesses = []
         for l in range(len(self.layers) - 1):
-            xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
-            xy = self.layers[l](xy)
+            if l == 0 and ys is not None:
+                xy = ff_label_injection(self.layers[l], xy, ys)
+            else:
+                xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
+                xy = self.layers[l](xy)
             xy = self.activation_fn(xy)
             goodness_l = xy.square().mean(dim=(1, 2, 3))
             goodnesses.append(goodness_l)
             if l % 2:
-                xy = xy[..., ::2, ::2]
+                if not self.strided:
+                    xy = xy[..., ::2, ::2]
                 if l < len(self.batch_norms):
-                    xy = self.batch_norms[l // 2](xy)
+                    # batch statistics are taken per label set, as if each set were its own batch
+                    xy = torch.concatenate([self.batch_norms[l // 2](xy_k) for xy_k in xy.chunk(n_sets)])
             xy = torch.detach(xy)
         return goodnesses
 
@@ -1783,13 +3797,14 @@ class conv2dModel(nn.Module):
         for l in range(len(self.layers) - 1):
             x_out = self.layers[l](x)
             x_out = self.activation_fn(x_out)
-            xhat = self.back_layers[l](x_out)
+            xhat = self.back_layers[l](x_out, output_size=x.shape[2:])
             xhat = self.activation_fn(xhat)
             loss_l = torch.mean((xhat - x) ** 2)
             local_losses.append(loss_l)
             x = x_out.detach()
             if l % 2:
-                x = x[..., ::2, ::2]
+                if not self.strided:
+                    x = x[..., ::2, ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         x = torch.mean(x, dim=(2, 3))
@@ -1805,7 +3820,8 @@ class conv2dModel(nn.Module):
             h_list.append(x)
             x = x.detach()
             if l % 2:
-                x = x[..., ::2, ::2]
+                if not self.strided:
+                    x = x[..., ::2, ::2]
                 if l < len(self.batch_norms):
                     x = self.batch_norms[l // 2](x)
         out_shape = (1, 1) +  x.shape[2:]
@@ -1819,14 +3835,16 @@ class conv2dModel(nn.Module):
             h_curr = h_list[-l].detach()
             h_prev = h_list[-(l + 1)].detach()
             hhat_curr = hhat_list[-l].detach()
-            ghhat_curr = self.back_layers[-l](hhat_curr)
+            # strided transposed convolutions are sized like the forward layer's input
+            back_size = {"output_size": h_prev.shape[2:]} if (self.strided and l > 1) else {}
+            ghhat_curr = self.back_layers[-l](hhat_curr, **back_size)
             ghhat_curr = self.activation_fn(ghhat_curr)
-            gh_curr = self.back_layers[-l](h_curr)
+            gh_curr = self.back_layers[-l](h_curr, **back_size)
             gh_curr = self.activation_fn(gh_curr)
             if l == 1:
                 gh_curr = gh_curr[..., None, None].repeat(out_shape)
                 ghhat_curr = ghhat_curr[..., None, None].repeat(out_shape)
-            if (l % 2) == 0:
+            if (l % 2) == 0 and not self.strided:
                 gh_curr = gh_curr.repeat_interleave(repeats=2, dim=2)
                 ghhat_curr = ghhat_curr.repeat_interleave(repeats=2, dim=2)
                 gh_curr = gh_curr.repeat_interleave(repeats=2, dim=3)
@@ -1856,53 +3874,54 @@ def train_sgd_conv2d(X_train,
                      loss_fn=torch.nn.CrossEntropyLoss(),
                      lr=0.001,
                      pad=0,
+                     strided=True,
+                     refit="last",
+                     refit_epochs=1,
+                     snapshot="memory",
+                     validate_every=1,
+                     validate_seconds=None,
+                     val_subsample=None,
+                     min_delta_se=0.,
+                     precision=None,
+                     channels_last=None,
                      ):
-    torch.cuda.empty_cache()
+    trim_cuda_cache("experiment")
     start_time = time.perf_counter()
 
     activation_fn = activation_dict[activation]
-    model = conv2dModel(
-        in_features=X_train.shape[1],
-        hidden_dims=hidden_dims,
-        num_classes=Y_train.shape[1],
-        activation_fn=activation_fn,
-        kernel_size=kernel_size,
-        training_method=training_method,
-        pad=pad,
-        lr=lr
-    ).to(device)
-    train_loss = []
-    val_loss = []
-    best_val_loss = torch.inf
-    patience_counter = 0
-    for epoch_i in range(max_epochs):
-        train_loss_i = train_sgd(model=model,
-                                 x=X_train,
-                                 y=Y_train,
-                                 loss_fn=loss_fn,
-                                 batch_size=batch_size
-                                 )
-        train_loss.append(train_loss_i.item())
-        val_loss_i = validate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  loss_fn=loss_fn,
-                                  batch_size=batch_size)
-        val_loss.append(val_loss_i.item())
-        if verbose:
-            print(val_loss_i)
-        if val_loss_i < best_val_loss:
-            best_val_loss = val_loss_i
-            patience_counter = 0
-        else:
-            patience_counter += 1
-        if patience_counter == (patience - 1):
-            break
+    def new_model():
+        model = conv2dModel(
+            in_features=X_train.shape[1],
+            hidden_dims=hidden_dims,
+            num_classes=as_split(X_train, Y_train).num_classes,
+            activation_fn=activation_fn,
+            kernel_size=kernel_size,
+            training_method=training_method,
+            pad=pad,
+            lr=lr,
+            strided=strided
+        ).to(device)
+        return configure_sgd_model(model, precision, channels_last)
+    model = new_model()
+    # snapshots are only taken when the refit policy uses them
+    stopper, epoch_i, train_loss, val_loss = fit_sgd_early_stopping(
+        model, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+        patience=patience,
+        max_epochs=max_epochs,
+        snapshot=snapshot if refit in ["best", "warm_start"] else None,
+        verbose=verbose,
+        validate_every=validate_every,
+        validate_seconds=validate_seconds,
+        val_subsample=val_subsample,
+        min_delta_se=min_delta_se)
 
     end_time = time.perf_counter()
     training_time = end_time - start_time
     training_epochs = epoch_i
 
+    model = refit_sgd(model, new_model, stopper, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+                      n_epochs=epoch_i, refit=refit, refit_epochs=refit_epochs)
+
     return model, training_time, training_epochs
 
 
@@ -1923,125 +3942,117 @@ all_training_methods = ["forward_projection", "random", "backprop", ]
 
 experiment_parameters = expand_grid({
     'rep': list(range(10)),
-    'n_sample': [20, 40]
+    'n_sample': [20, 40],
+    'training_method': all_training_methods,
 })
 
 seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
-conv2d_experiments = []
-for dataset_i in ['cxr', 'oct']:
 
-    print(dataset_i)
-    X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i, channels_last=True)
-    hidden_dim = 16
-    n_blocks = 4
-    hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
-    activation = "relu"
-    train_folds = folds != 0
-    val_folds = torch.logical_not(train_folds)
-    X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-    Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
 
-    for experiment_parameters_i in range(len(experiment_parameters)):
+def conv2d_fewshot_experiment(rep, n_sample, training_method):
+    n_train = round(n_sample * 0.8)
+    n_val = n_sample - n_train
 
-        print(dataset_i, experiment_parameters_i)
+    train_s = subsample_dataset(train_data, y=None, n_sample=n_train)
+    val_s = subsample_dataset(train_data, y=None, n_sample=n_val)
 
-        rep = experiment_parameters.rep[experiment_parameters_i]
-        n_sample = experiment_parameters.n_sample[experiment_parameters_i]
+    if training_method in ["forward_projection", "random", "label_projection", "noisy_label_projection"]:
 
-        try:
-          for training_method in all_training_methods:
-
-                n_train = round(n_sample * 0.8)
-                n_val = n_sample - n_train
-
-                X_train_s, Y_train_s = subsample_dataset(X_train,
-                                                          Y_train,
-                                                          n_sample=n_train)
-                X_val_s, Y_val_s = subsample_dataset(X_train,
-                                                      Y_train,
-                                                      n_sample=n_val)
-
-                if training_method in ["forward_projection", "random", "label_projection", "noisy_label_projection"]:
-
-                    X_trainval_s = torch.concatenate([X_train_s, X_val_s])
-                    Y_trainval_s = torch.concatenate([Y_train_s, Y_val_s])
-
-                    w_list, _, _, training_time = train_forward_conv2d(x=X_trainval_s,
-                                                                        y=Y_trainval_s,
-                                                                        training_method=training_method,
-                                                                        hidden_dim=hidden_dim,
-                                                                        activation=activation,
-                                                                        n_blocks=n_blocks,
-                                                                        device=device,
-                                                                        reg_factor=10,
-                                                                        batch_size=5
-                                                                        )
-                    train_metrics = evaluate_forward_conv2d(x=X_trainval_s,
-                                                            y=Y_trainval_s,
-                                                            w_list=w_list,
-                                                            activation=activation)
-                    test_metrics = evaluate_forward_conv2d(x=X_test,
-                                                            y=Y_test,
-                                                            w_list=w_list,
+        trainval_s = DataSplit.concatenate([train_s, val_s])
+
+        train_accumulator = MetricAccumulator(num_classes=trainval_s.num_classes)
+        w_list, _, _, training_time = train_forward_conv2d(x=trainval_s,
+                                                            y=None,
+                                                            training_method=training_method,
+                                                            hidden_dim=hidden_dim,
                                                             activation=activation,
-                                                            batch_size=50)
+                                                            n_blocks=n_blocks,
+                                                            device=device,
+                                                            reg_factor=10,
+                                                            batch_size=5,
+                                                            train_accumulator=train_accumulator
+                                                            )
+        train_metrics = train_accumulator.compute()
+        test_metrics = evaluate_forward_conv2d(x=X_test,
+                                                y=Y_test,
+                                                w_list=w_list,
+                                                activation=activation,
+                                                batch_size=50)
 
 
-                else:
+    else:
 
-                    model, training_time, training_epochs = train_sgd_conv2d(
-                        X_train=X_train_s.transpose(1, -1),
-                        Y_train=Y_train_s,
-                        X_val=X_val_s.transpose(1, -1),
-                        Y_val=Y_val_s,
-                        hidden_dims=hidden_dims,
-                        activation=activation,
-                        training_method=training_method,
-                        lr=0.0001,
-                        batch_size=25,
-                        patience=10,
-                        verbose=False)
-
-                    train_metrics = evaluate_sgd(model=model,
-                                                  x=X_train_s.transpose(1, -1),
-                                                  y=Y_train_s,
-                                                  )
-
-                    val_metrics = evaluate_sgd(model=model,
-                                                x=X_val_s.transpose(1, -1),
-                                                y=Y_val_s,
-                                                )
-
-                    test_metrics = evaluate_sgd(model=model,
-                                                x=X_test.transpose(1, -1),
-                                                y=Y_test,
-                                                )
-
-                print(training_method, n_sample)
-                print(train_metrics)
-                print(test_metrics)
-
-                out = {
-                    'dataset': dataset_i,
-                    'training_method': training_method,
-                    'activation': activation,
-                    'hidden_dim': hidden_dim,
-                    'n_blocks': n_blocks,
-                    'n_sample': n_sample,
-                    'train_auc': train_metrics[0].item(),
-                    'train_acc': train_metrics[1].item(),
-                    'test_auc': test_metrics[0].item(),
-                    'test_acc': test_metrics[1].item(),
-                    'training_time': training_time,
-                }
-                conv2d_experiments.append(out)
-        except:
-          print("skipped")
+        model, training_time, training_epochs = train_sgd_conv2d(
+            X_train=channels_first_view(train_s),
+            Y_train=None,
+            X_val=channels_first_view(val_s),
+            Y_val=None,
+            hidden_dims=hidden_dims,
+            activation=activation,
+            training_method=training_method,
+            lr=0.0001,
+            batch_size=25,
+            patience=10,
+            verbose=False)
+
+        train_metrics = evaluate_sgd(model=model,
+                                      x=channels_first_view(train_s),
+                                      y=None,
+                                      )
+
+        val_metrics = evaluate_sgd(model=model,
+                                    x=channels_first_view(val_s),
+                                    y=None,
+                                    )
+
+        test_metrics = evaluate_sgd(model=model,
+                                    x=channels_first_view(X_test),
+                                    y=Y_test,
+                                    )
+
+    print(training_method, n_sample)
+    print(train_metrics)
+    print(test_metrics)
 
-conv2d_experiments = pd.DataFrame(conv2d_experiments)
+    out = {
+        'dataset': dataset_i,
+        'training_method': training_method,
+        'activation': activation,
+        'hidden_dim': hidden_dim,
+        'n_blocks': n_blocks,
+        'n_sample': n_sample,
+        'train_auc': train_metrics[0].item(),
+        'train_acc': train_metrics[1].item(),
+        'test_auc': test_metrics[0].item(),
+        'test_acc': test_metrics[1].item(),
+        'training_time': training_time,
+    }
+    return out
+
+
+conv2d_experiments = []
+for dataset_i in ['cxr', 'oct']:
+
+    print(dataset_i)
+    X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i, channels_last=True)
+    hidden_dim = 16
+    n_blocks = 4
+    hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
+    activation = "relu"
+    train_idx, val_idx = fold_indices(folds, 0)
+    train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+    val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+    # the module level model settings are part of the row keys of the store
+    grid_settings = dict(hidden_dim=hidden_dim, n_blocks=n_blocks, activation=activation)
+    store_file = os.path.join(store_dir, f"conv2d_experiments_{dataset_i}.jsonl")
+    conv2d_experiments.append(run_experiment_grid(conv2d_fewshot_experiment,
+                                                  experiment_parameters,
+                                                  store_file=store_file,
+                                                  seed=seed,
+                                                  settings=grid_settings))
+
+conv2d_experiments = pd.concat(conv2d_experiments, ignore_index=True)
 output_file = os.path.join(output_dir, "conv2d_experiments.csv")
 conv2d_experiments.to_csv(path_or_buf=output_file)
 
@@ -2050,35 +4061,45 @@ conv2d_experiments.to_csv(path_or_buf=output_file)
 #@title forward conv2d cifar functions (with padding)
 
 
-def ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=10., device=device, reduce_factor=1):
-    x_dim = x_batches[0].shape[-1] # data
-    z_dim = z_batches[1].shape[-1] # targets
-
-    #accumulate data gram matrix and cross product of data and targets
-    gram_mat = torch.zeros((x_dim, x_dim), device=device)
-    xt_z = torch.zeros((x_dim, z_dim), device=device)
-    for x_i, z_i in zip(x_batches, z_batches):
-        x_i = x_i.to(device)
-        z_i = z_i.to(device)
-        x_i = x_i.flatten(start_dim=0, end_dim=2)
-        z_i = z_i.flatten(start_dim=0, end_dim=2)
-        xt_z += (x_i.T @ z_i) * reduce_factor
-        gram_mat += (x_i.T @ x_i) * reduce_factor
+def ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=10., device=device, reduce_factor=1, solver=None):
+    #accumulate data gram matrix and cross product of data and targets, regularise and solve for the weight matrix
+    w_hat = ridge_regression_batches(x_batches, z_batches, reg_factor=reg_factor, reduce_factor=reduce_factor,
+                                     solver=solver, device=device)
 
-    #regularise
-    gram_mat += torch.eye(gram_mat.shape[0], device=device) * reg_factor
-
-    #invert gram matrix
-    try:
-        gram_inv = torch.inverse(gram_mat)
-    except:
-        print("singular gram matrix, consider increasing regularisation factor")
-        gram_inv = torch.eye(gram_mat.shape[0], device=device)
+    return w_hat
 
-    #compute weight matrix
-    w_hat = gram_inv @ xt_z
 
-    return w_hat
+'''
+target potentials z of a batch of conv2d patches x_i (labels y_i), given the projection matrices q and u
+'''
+def conv2d_projection_targets(x_i, y_i, q, u,
+                              activation="relu",
+                              training_method="forward_projection",
+                              device=device,
+                              ):
+    x_i = x_i.to(device)
+    y_i = y_i.to(device)
+
+    #generate target values (z)
+    y_proj = torch.sign(y_i @ u)
+    match training_method:
+        case "forward_projection":
+            x_proj = torch.sign(x_i @ q)
+        case "label_projection":
+            x_proj = torch.zeros(x_i.shape[:-1] + (u.shape[-1],),
+                                 device=device)
+        case "noisy_label_projection":
+            x_proj = torch.sign(torch.randn(x_i.shape[:-1] + (u.shape[-1],),
+                                            device=device))
+
+    z_i = x_proj + y_proj
+
+    # transpose target distribution
+    if activation_shift_dict[activation] != 0:
+        z_i += activation_shift_dict[activation]
+    if activation_rescale_dict[activation] != 1:
+        z_i *= activation_rescale_dict[activation]
+    return z_i
 
 
 def fit_w_conv2d(x_batches,
@@ -2090,6 +4111,7 @@ def fit_w_conv2d(x_batches,
                  device=device,
                  training_method="forward_projection",
                  reduce_factor=1,
+                 ridge_solver=None,
                  ):
     x_channels = x_batches[0].shape[-1]
     y_channels = y_batches[0].shape[-1]
@@ -2099,33 +4121,12 @@ def fit_w_conv2d(x_batches,
 
     z_batches = [] # targets
     for x_i, y_i in zip(x_batches, y_batches):
-
-        x_i = x_i.to(device)
-        y_i = y_i.to(device)
-
-        #generate target values (z)
-        y_proj = torch.sign(y_i @ u)
-        match training_method:
-            case "forward_projection":
-                x_proj = torch.sign(x_i @ q)
-            case "label_projection":
-                x_proj = torch.zeros(x_i.shape[:-1] + (u.shape[-1],),
-                                     device=device)
-            case "noisy_label_projection":
-                x_proj = torch.sign(torch.randn(x_i.shape[:-1] + (u.shape[-1],),
-                                                device=device))
-
-        z_i = x_proj + y_proj
-
-        # transpose target distribution
-        if activation_shift_dict[activation] != 0:
-            z_i += activation_shift_dict[activation]
-        if activation_rescale_dict[activation] != 1:
-            z_i *= activation_rescale_dict[activation]
+        z_i = conv2d_projection_targets(x_i, y_i, q, u, activation=activation, training_method=training_method)
         z_batches.append(z_i.to("cpu"))
 
     #fit weight
-    w = ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=reg_factor, reduce_factor=reduce_factor)
+    w = ridge_regression_w_conv2d(x_batches, z_batches, reg_factor=reg_factor, reduce_factor=reduce_factor,
+                                  solver=ridge_solver)
 
     if return_qu:
         return w, q, u
@@ -2162,14 +4163,13 @@ def train_forward_conv2d(x,
                          return_qu=False,
                          verbose=False,
                          device=device,
+                         train_accumulator=None,  # MetricAccumulator for output layer predictions on x
+                         ridge_solver=None,  # solver name, or a list with one per hidden layer and the output layer
                          ):
     activation_fn = activation_dict[activation]
     pad_size = kernel_size//2
     pad_tuple = (0,0,pad_size, pad_size, pad_size, pad_size, 0,0)
 
-    if y.ndim == 2:
-        y = y[:, None, None, :]
-
     hidden_dims = [round(hidden_dim * 2 ** (i // 2)) for i in range(n_blocks * 2)]
 
     start_time = time.perf_counter()
@@ -2177,9 +4177,8 @@ def train_forward_conv2d(x,
     q_list = [] # data projection matrices
     u_list = [] # label projeciton matrices
 
-    rand_idx = torch.randperm(len(x))
-    x_batches = list(torch.split(x[rand_idx], split_size_or_sections=batch_size))
-    y_batches = list(torch.split(y[rand_idx], split_size_or_sections=batch_size))
+    x_batches, y_batches = BatchProducer(as_split(x, y), batch_size, shuffle=True, device=None).lists()
+    y_batches = [y_i[:, None, None, :] if y_i.ndim == 2 else y_i for y_i in y_batches]
 
     # fit hidden layers
     for l in range(len(hidden_dims)):
@@ -2213,37 +4212,94 @@ def train_forward_conv2d(x,
                                    activation=activation,
                                    training_method=training_method,
                                    reg_factor=reg_factor,
-                                   reduce_factor=reduce_factor
+                                   reduce_factor=reduce_factor,
+                                   ridge_solver=layer_solver(ridge_solver, l),
                                    )
             q_list.append(q)
             u_list.append(u)
         w_list.append(w)
 
-        # forward
-        x_batches = [activation_fn(x_i.to(device) @ w).to("cpu") for x_i in x_batches]
+        # forward, the last hidden layer is computed batch by batch while fitting the output layer
+        if l < len(hidden_dims) - 1:
+            x_batches = [activation_fn(x_i.to(device) @ w).to("cpu") for x_i in x_batches]
 
-    # fitting output layer
+    # fitting output layer on pooled (or flattened) features, streamed into the gram matrix without keeping the
+    # final feature maps. the features are only kept when train_accumulator needs them
     if verbose:
         print('fitting output layer')
+    # one pooled row per sample. solvers other than gram also need the pooled features
+    output_ridge = RidgeAccumulator(reduce_factor=reduce_factor)
+    output_solver = None
+    pooled_batches = []
     for i in range(len(x_batches)):
-        x_batches[i] = concatenate_ones(x_batches[i])
-        if global_layer == "average":
-            x_batches[i] = torch.mean(x_batches[i], dim=(1, 2), keepdim=True)
-        elif global_layer == "flatten":
-            x_batches[i] = x_batches[i].flatten(start_dim=1)[:, None, None, :]
-        y_batches[i] = 2 * y_batches[i] - 1
-
+        x_i = pool_output_features(activation_fn(x_batches[i].to(device) @ w_list[-1]), global_layer)
+        y_i = 2 * y_batches[i].to(device) - 1
+        x_batches[i] = None
+        if output_solver is None:
+            output_solver = resolve_ridge_solver(x_i.shape[-1], layer_solver(ridge_solver, len(hidden_dims)),
+                                                 n_rows=sum(len(y_i) for y_i in y_batches), device=device)
+        if output_solver == "gram":
+            output_ridge.update(x_i, y_i)
+        if output_solver != "gram" or train_accumulator is not None:
+            pooled_batches.append((x_i, y_i))
 
     # fit weight
-    w = ridge_regression_w_conv2d(x_batches, y_batches, reg_factor=1, reduce_factor=reduce_factor)
+    if output_solver == "gram":
+        w = output_ridge.solve(reg_factor=1)
+    else:
+        pooled_x, pooled_y = zip(*pooled_batches)
+        w = ridge_regression_batches(pooled_x, pooled_y, reg_factor=1, reduce_factor=reduce_factor,
+                                     solver=output_solver)
 
     w_list.append(w)
     end_time = time.perf_counter()
     training_time = end_time - start_time
 
+    # training set predictions from the pooled features, argmax of the +-1 targets gives the labels
+    if train_accumulator is not None:
+        for x_i, y_i in pooled_batches:
+            train_accumulator.update(x_i @ w, y_i)
+
     return w_list, q_list, u_list, training_time
 
 
+def predict_forward_conv2d(x_i,
+                           w_list,
+                           activation,
+                           kernel_size=3,
+                           pad=False,
+                           global_layer="average",
+                           ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    for l in range(len(w_list) - 1):
+        if pad:
+            #pad_size = kernel_size // 2
+            x_i = pad_array(x_i)
+            #x_i = torch.nn.functional.pad(x_i, pad=pad_tuple, mode='constant')
+
+        # convolution and pooling
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
+        x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+
+        x_i = x_i.flatten(start_dim=3)
+        x_i = concatenate_ones(x_i)
+
+        # forward
+        x_i = activation_fn(x_i @ w_list[l])
+
+    # extract global average or flattened features (with the ones column) as prediction
+    x_i = pool_output_features(x_i, global_layer)[:, 0, 0, :]
+    yhat_i = x_i @ w_list[-1]
+
+    return yhat_i
+
+
+'''
+evaluate on x, or on several splits of x in one forward pass when split_masks are given
+'''
 def evaluate_forward_conv2d(x,
                             y,
                             w_list,
@@ -2252,52 +4308,402 @@ def evaluate_forward_conv2d(x,
                             pad=False,
                             global_layer="average",
                             batch_size=1000,
+                            split_masks=None,
+                            ):
+    def predict_fn(x_i):
+        return predict_forward_conv2d(x_i,
+                                      w_list,
+                                      activation,
+                                      kernel_size=kernel_size,
+                                      pad=pad,
+                                      global_layer=global_layer)
+
+    metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size)
+
+    return metrics
+
+
+'''
+predictions (models, n, classes) of stacked conv2d weights (see stack_w_lists) on the batch x_i
+'''
+def predict_forward_conv2d_stacked(x_i,
+                                   w_stack,
+                                   activation,
+                                   kernel_size=3,
+                                   pad=False,
+                                   global_layer="average",
+                                   ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    shared = True
+    for l in range(len(w_stack) - 1):
+        if pad:
+            x_i = pad_array(x_i)
+
+        # convolution and pooling, once for all models
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
+        x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+
+        x_i = x_i.flatten(start_dim=3)
+        x_i = concatenate_ones(x_i)
+
+        # forward
+        x_i = activation_fn(stacked_linear(x_i, w_stack[l], shared))
+        shared = False
+
+    # extract global average or flattened features (with the ones column) as prediction
+    x_i = pool_output_features(x_i, global_layer)[:, 0, 0, :]
+    yhat_i = stacked_linear(x_i, w_stack[-1], shared)
+
+    return yhat_i.reshape(w_stack[-1].shape[0], -1, yhat_i.shape[-1])
+
+
+'''
+train an ensemble of n_members forward conv2d models that differ only in their random projections (or weights, for
+random). the members share the batch order, and while their inputs coincide (the first layer) also the unfolded
+batches and one gram matrix: their targets are solved together and the weights split. deeper layers are fit member
+by member in the same sweep, and the output layers are streamed in lock-step, each batch of labels loaded once for
+all members. layers are solved with ridge_solver as in train_forward_conv2d, so a single member reproduces it.
+returns lists of the members' w_list, q_list and u_list, the averaged-prediction model (a function of a batch,
+predicting with all members in one stacked pass, e.g. for evaluate_splits) and the training time
+'''
+def train_forward_conv2d_ensemble(x,
+                                  y,
+                                  training_method,
+                                  n_members=5,
+                                  activation='relu',
+                                  hidden_dim=16,
+                                  n_blocks=3,
+                                  kernel_size=3,
+                                  global_layer="average",
+                                  pad=False,
+                                  batch_size=25,
+                                  reg_factor=0.01,
+                                  reduce_factor=1,
+                                  return_qu=False,
+                                  verbose=False,
+                                  device=device,
+                                  ridge_solver=None,  # solver name, or one per hidden layer and the output layer
+                                  ):
+    activation_fn = activation_dict[activation]
+
+    hidden_dims = [round(hidden_dim * 2 ** (i // 2)) for i in range(n_blocks * 2)]
+
+    start_time = time.perf_counter()
+    w_lists = [[] for _ in range(n_members)]
+    q_lists = [[] for _ in range(n_members)]
+    u_lists = [[] for _ in range(n_members)]
+
+    x_batches, y_batches = BatchProducer(as_split(x, y), batch_size, shuffle=True, device=None).lists()
+    y_batches = [y_i[:, None, None, :] if y_i.ndim == 2 else y_i for y_i in y_batches]
+    member_batches = [x_batches] * n_members
+
+    # fit hidden layers
+    for l in range(len(hidden_dims)):
+
+        if verbose:
+            print('fitting layer', l)
+
+        # pooling
+        stride = 2 - ((l + 1) % 2)
+        shared = all(batches is member_batches[0] for batches in member_batches)
+
+        # convolution, once for batches shared between members
+        for batches in (member_batches[:1] if shared else member_batches):
+            for i in range(len(batches)):
+                x_i = batches[i]
+                if pad:
+                    x_i = pad_array(x_i)
+                x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
+                x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+                x_i = x_i.flatten(start_dim=3)
+                x_i = concatenate_ones(x_i)
+                batches[i] = x_i
+
+        # fitting hidden weights
+        if training_method == "random":
+            for m in range(n_members):
+                w = torch.randn((member_batches[m][0].shape[-1], hidden_dims[l])).to(device)
+                w /= w.norm(dim=-1, keepdim=True)
+                w_lists[m].append(w)
+        if training_method in ["forward_projection", "label_projection", "noisy_label_projection"]:
+            if shared:
+                qu = [(torch.randn((member_batches[0][0].shape[-1], hidden_dims[l]), device=device),
+                       torch.randn((y_batches[0].shape[-1], hidden_dims[l]), device=device))
+                      for _ in range(n_members)]
+                z_batches = [torch.concatenate([conv2d_projection_targets(x_i, y_i, q, u,
+                                                                          activation=activation,
+                                                                          training_method=training_method)
+                                                for q, u in qu], dim=-1).to("cpu")
+                             for x_i, y_i in zip(member_batches[0], y_batches)]
+                w_all = ridge_regression_w_conv2d(member_batches[0], z_batches, reg_factor=reg_factor,
+                                                  reduce_factor=reduce_factor, solver=layer_solver(ridge_solver, l))
+                fits = [(w, q, u) for w, (q, u) in zip(torch.split(w_all, hidden_dims[l], dim=1), qu)]
+            else:
+                fits = [fit_w_conv2d(member_batches[m],
+                                     y_batches,
+                                     hidden_dim=hidden_dims[l],
+                                     return_qu=True,
+                                     activation=activation,
+                                     training_method=training_method,
+                                     reg_factor=reg_factor,
+                                     reduce_factor=reduce_factor,
+                                     ridge_solver=layer_solver(ridge_solver, l),
+                                     ) for m in range(n_members)]
+            for m, (w, q, u) in enumerate(fits):
+                w_lists[m].append(w)
+                q_lists[m].append(q if return_qu else None)
+                u_lists[m].append(u if return_qu else None)
+
+        # forward, the last hidden layer is computed batch by batch while fitting the output layers
+        if l < len(hidden_dims) - 1:
+            member_batches = [[activation_fn(x_i.to(device) @ w_lists[m][-1]).to("cpu") for x_i in member_batches[m]]
+                              for m in range(n_members)]
+
+    # fitting output layers on pooled (or flattened) features, in lock-step over the batches. the members' features
+    # have the same shape, so they share the output solver. solvers other than gram keep the pooled features
+    if verbose:
+        print('fitting output layers')
+    output_ridges = [RidgeAccumulator(reduce_factor=reduce_factor) for _ in range(n_members)]
+    output_solver = None
+    pooled_batches = [[] for _ in range(n_members)]
+    for i in range(len(y_batches)):
+        y_i = 2 * y_batches[i].to(device) - 1
+        for m in range(n_members):
+            x_i = pool_output_features(activation_fn(member_batches[m][i].to(device) @ w_lists[m][-1]), global_layer)
+            if output_solver is None:
+                output_solver = resolve_ridge_solver(x_i.shape[-1], layer_solver(ridge_solver, len(hidden_dims)),
+                                                     n_rows=sum(len(y_i) for y_i in y_batches), device=device)
+            if output_solver == "gram":
+                output_ridges[m].update(x_i, y_i)
+            else:
+                pooled_batches[m].append((x_i, y_i))
+        for m in range(n_members):
+            member_batches[m][i] = None
+
+    for m in range(n_members):
+        if output_solver == "gram":
+            w = output_ridges[m].solve(reg_factor=1)
+        else:
+            pooled_x, pooled_y = zip(*pooled_batches[m])
+            w = ridge_regression_batches(pooled_x, pooled_y, reg_factor=1, reduce_factor=reduce_factor,
+                                         solver=output_solver)
+        w_lists[m].append(w)
+    end_time = time.perf_counter()
+    training_time = end_time - start_time
+
+    w_stack = stack_w_lists(w_lists)[0][1]
+
+    def ensemble_fn(x_i):
+        return predict_forward_conv2d_stacked(x_i,
+                                              w_stack,
+                                              activation,
+                                              kernel_size=kernel_size,
+                                              pad=pad,
+                                              global_layer=global_layer).mean(dim=0)
+
+    return w_lists, q_lists, u_lists, ensemble_fn, training_time
+
+
+'''
+evaluate the ensemble of w_lists by its averaged predictions, on x or on several splits of x (see evaluate_splits)
+'''
+def evaluate_forward_conv2d_ensemble(x,
+                                     y,
+                                     w_lists,
+                                     activation,
+                                     kernel_size=3,
+                                     pad=False,
+                                     global_layer="average",
+                                     batch_size=1000,
+                                     split_masks=None,
+                                     ):
+    w_stack = stack_w_lists(w_lists)[0][1]
+
+    def predict_fn(x_i):
+        return predict_forward_conv2d_stacked(x_i,
+                                              w_stack,
+                                              activation,
+                                              kernel_size=kernel_size,
+                                              pad=pad,
+                                              global_layer=global_layer).mean(dim=0)
+
+    metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size)
+
+    return metrics
+
+#@title quantised inference functions
+# <editor-fold desc="int8 quantised inference for forward models">
+
+'''
+symmetric int8 quantisation of a layer weight matrix, one scale per output channel. the last row is the intercept
+(see concatenate_ones) and stays in float. returns (int8 weights, channel scales, intercept)
+'''
+def quantise_layer(w):
+    w = w.to(device)
+    bias = w[-1]
+    w = w[:-1]
+    scale = w.abs().amax(dim=0).clamp(min=torch.finfo(w.dtype).tiny) / 127
+    w_q = torch.round(w / scale).clamp(-127, 127).to(torch.int8)
+    return w_q, scale, bias
+
+
+'''
+post-training quantisation of a forward w_list. a flattened conv2d output layer has an intercept row per position,
+flatten_channels (the channels of the last hidden layer) folds them into one intercept
+'''
+def quantise_w_list(w_list, flatten_channels=None):
+    qw_list = [quantise_layer(w) for w in w_list[:-1]]
+    w = w_list[-1]
+    if flatten_channels is not None:
+        w = w.reshape(-1, flatten_channels + 1, w.shape[-1])
+        w = torch.concatenate([w[:, :-1].flatten(end_dim=1), w[:, -1].sum(dim=0, keepdim=True)])
+    qw_list.append(quantise_layer(w))
+    return qw_list
+
+
+'''
+int8 layer on float activations x (..., in), without the ones column. every row is quantised with its own scale,
+the int8 product is accumulated in int32 by torch._int_mm (a float matmul of the int8 values where the device or
+shape is not supported), rescaled and the intercept added
+'''
+def quantised_linear(x, qw):
+    w_q, w_scale, bias = qw
+    x_2d = x.reshape(-1, x.shape[-1])
+    x_scale = x_2d.abs().amax(dim=1, keepdim=True).clamp(min=torch.finfo(x_2d.dtype).tiny) / 127
+    x_q = torch.round(x_2d / x_scale).clamp(-127, 127).to(torch.int8)
+    try:
+        out = torch._int_mm(x_q, w_q).to(x_2d.dtype)
+    except (RuntimeError, NotImplementedError):
+        out = x_q.to(x_2d.dtype) @ w_q.to(x_2d.dtype)
+    out = out * x_scale * w_scale + bias
+    return out.reshape(x.shape[:-1] + (w_q.shape[-1],))
+
+
+def predict_forward_mlp_quantised(x_i,
+                                  qw_list,
+                                  activation,
+                                  ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    for l in range(len(qw_list) - 1):
+        x_i = activation_fn(quantised_linear(x_i, qw_list[l]))
+
+    yhat_i = quantised_linear(x_i, qw_list[-1])
+
+    return yhat_i
+
+
+def predict_forward_conv1d_quantised(x_i,
+                                     qw_list,
+                                     activation,
+                                     kernel_size=3,
+                                     ):
+    activation_fn = activation_dict[activation]
+    x_i = x_i.to(device)
+
+    for l in range(len(qw_list) - 1):
+        # convolution and pooling
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride).flatten(start_dim=2)
 
-                            ):
+        # forward
+        x_i = activation_fn(quantised_linear(x_i, qw_list[l]))
+
+    # output, the average of the ones column is the intercept
+    x_i = torch.mean(x_i, dim=1)
+    yhat_i = quantised_linear(x_i, qw_list[-1])
+
+    return yhat_i
+
+
+def predict_forward_conv2d_quantised(x_i,
+                                     qw_list,
+                                     activation,
+                                     kernel_size=3,
+                                     pad=False,
+                                     global_layer="average",
+                                     ):
     activation_fn = activation_dict[activation]
-    pad_size = kernel_size // 2
-    pad_tuple = (0,0,pad_size, pad_size, pad_size, pad_size, 0,0)
-    x_batches = torch.split(x, split_size_or_sections=batch_size)
+    x_i = x_i.to(device)
 
-    yhat = []
-    for x_i in x_batches:
-        x_i = x_i.to(device)
+    for l in range(len(qw_list) - 1):
+        if pad:
+            x_i = pad_array(x_i)
 
-        for l in range(len(w_list) - 1):
-            if pad:
-                #pad_size = kernel_size // 2
-                x_i = pad_array(x_i)
-                #x_i = torch.nn.functional.pad(x_i, pad=pad_tuple, mode='constant')
+        # convolution and pooling
+        stride = 2 - ((l + 1) % 2)
+        x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
+        x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+        x_i = x_i.flatten(start_dim=3)
 
-            # convolution and pooling
-            stride = 2 - ((l + 1) % 2)
-            x_i = x_i.unfold(dimension=1, size=kernel_size, step=stride)  #
-            x_i = x_i.unfold(dimension=2, size=kernel_size, step=stride)  #
+        # forward
+        x_i = activation_fn(quantised_linear(x_i, qw_list[l]))
 
-            x_i = x_i.flatten(start_dim=3)
-            x_i = concatenate_ones(x_i)
+    # global average or flattened features, the intercept replaces the ones column
+    match global_layer:
+        case "average":
+            x_i = torch.mean(x_i, dim=(1, 2))
+        case "flatten":
+            x_i = x_i.flatten(start_dim=1)
+    yhat_i = quantised_linear(x_i, qw_list[-1])
 
-            # forward
-            x_i = activation_fn(x_i @ w_list[l])
+    return yhat_i
 
-        # output
-        x_i = concatenate_ones(x_i)
-        y = torch.squeeze(y)
 
-        # extract global average as prediction
-        match global_layer:
-            case "average":
-                x_i = torch.mean(x_i, dim=(1, 2))
-            case "flatten":
-                x_i = x_i.flatten(start_dim=1)
-        yhat_i = x_i @ w_list[-1]
-        yhat.append(yhat_i.to("cpu"))
+'''
+accuracy regression of a quantised model against its float model on x, in one pass. predict_fn and
+predict_quantised_fn are the float and quantised predict functions of the model (e.g. predict_forward_conv2d and
+predict_forward_conv2d_quantised), called with predict_kwargs. returns the metrics of both, their difference, the
+fraction of rows whose predicted class is unchanged, the largest absolute change of an output and the weight sizes
+in bytes
+'''
+def quantisation_report(x,
+                        y,
+                        w_list,
+                        qw_list,
+                        predict_fn,
+                        predict_quantised_fn,
+                        batch_size=1000,
+                        verbose=True,
+                        **predict_kwargs,
+                        ):
+    data = as_split(x, y)
+    float_accumulator = MetricAccumulator(num_classes=data.num_classes)
+    quantised_accumulator = MetricAccumulator(num_classes=data.num_classes)
+    n_agree = 0
+    max_output_change = 0.
+    for x_i, y_i in BatchProducer(data, batch_size):
+        yhat_i = predict_fn(x_i, w_list, **predict_kwargs).reshape(len(x_i), -1)
+        yhat_q_i = predict_quantised_fn(x_i, qw_list, **predict_kwargs).reshape(len(x_i), -1)
+        float_accumulator.update(yhat_i, y_i)
+        quantised_accumulator.update(yhat_q_i, y_i)
+        n_agree += (torch.argmax(yhat_i, dim=-1) == torch.argmax(yhat_q_i, dim=-1)).sum().item()
+        max_output_change = max(max_output_change, (yhat_q_i - yhat_i).abs().max().item())
+
+    float_metrics = float_accumulator.compute()
+    quantised_metrics = quantised_accumulator.compute()
+    report = {"float_metrics": float_metrics,
+              "quantised_metrics": quantised_metrics,
+              "metric_change": quantised_metrics - float_metrics,
+              "agreement": n_agree / len(data),
+              "max_output_change": max_output_change,
+              "float_bytes": sum(w.numel() * w.element_size() for w in w_list),
+              "quantised_bytes": sum(t.numel() * t.element_size() for qw in qw_list for t in qw),
+              }
 
-    yhat = torch.concatenate(yhat)
+    if verbose:
+        for name, a, b in zip(["auc", "acc", "recall", "prec", "f1"], float_metrics, quantised_metrics):
+            print(f"{name}: float {a:.4f}, int8 {b:.4f} ({b - a:+.4f})")
+        print(f"predicted class agreement {report['agreement']:.4f}, "
+              f"weights {report['float_bytes']} -> {report['quantised_bytes']} bytes")
 
-    metrics = compute_metrics(yhat, y)
+    return report
 
-    return metrics
+# </editor-fold>
 
 #@title conv2d cifar few shot experiments
 
@@ -2313,13 +4719,119 @@ all_training_methods = ["forward_projection", "random","backprop", "local_superv
 
 experiment_parameters = expand_grid({
     'rep': list(range(5)),
-    'n_sample': [50, 100]
+    'n_sample': [50, 100],
+    'training_method': all_training_methods,
 })
 
 seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
+ensemble_members = 1 # forward rows train (and are evaluated as) an ensemble of this many members, see train_forward_conv2d_ensemble
+
+
+def conv2d_cifar_fewshot_experiment(rep, n_sample, training_method):
+    n_train = round(n_sample * 0.8)
+    n_val = n_sample - n_train
+
+    train_s = subsample_dataset(train_data, y=None, n_sample=n_train)
+    val_s = subsample_dataset(train_data, y=None, n_sample=n_val)
+
+    if training_method in ["forward_projection", "random", ]:
+
+        trainval_s = DataSplit.concatenate([train_s, val_s])
+
+        if ensemble_members > 1:
+            _, _, _, ensemble_fn, training_time = train_forward_conv2d_ensemble(x=trainval_s,
+                                                                                y=None,
+                                                                                training_method=training_method,
+                                                                                n_members=ensemble_members,
+                                                                                hidden_dim=hidden_dim,
+                                                                                activation=activation,
+                                                                                n_blocks=n_blocks,
+                                                                                device=device,
+                                                                                reg_factor=10,
+                                                                                reduce_factor=0.01,
+                                                                                batch_size=25,
+                                                                                pad=True,
+                                                                                verbose=False,
+                                                                                )
+            train_metrics = evaluate_splits(ensemble_fn, trainval_s, None, batch_size=50)
+            test_metrics = evaluate_splits(ensemble_fn, X_test, Y_test, batch_size=50)
+        else:
+            train_accumulator = MetricAccumulator(num_classes=trainval_s.num_classes)
+            w_list, _, _, training_time = train_forward_conv2d(x=trainval_s,
+                                                              y=None,
+                                                              training_method=training_method,
+                                                              hidden_dim=hidden_dim,
+                                                              activation=activation,
+                                                              n_blocks=n_blocks,
+                                                              device=device,
+                                                              reg_factor=10,
+                                                              reduce_factor=0.01,
+                                                              batch_size=25,
+                                                              pad=True,
+                                                              verbose=False,
+                                                              train_accumulator=train_accumulator
+                                                              )
+            train_metrics = train_accumulator.compute()
+            test_metrics = evaluate_forward_conv2d(x=X_test,
+                                                  y=Y_test,
+                                                  w_list=w_list,
+                                                  activation=activation,
+                                                  batch_size=50,
+                                                  pad=True,)
+
+
+    else:
+
+        model, training_time, training_epochs = train_sgd_conv2d(
+            X_train=channels_first_view(train_s),
+            Y_train=None,
+            X_val=channels_first_view(val_s),
+            Y_val=None,
+            hidden_dims=hidden_dims,
+            activation=activation,
+            training_method=training_method,
+            lr=0.0001,
+            batch_size=25,
+            patience=10,
+            pad=1,
+            verbose=False)
+
+        train_metrics = evaluate_sgd(model=model,
+                                    x=channels_first_view(train_s),
+                                    y=None,
+                                    )
+
+        val_metrics = evaluate_sgd(model=model,
+                                  x=channels_first_view(val_s),
+                                  y=None,
+                                  )
+
+        test_metrics = evaluate_sgd(model=model,
+                                    x=channels_first_view(X_test),
+                                    y=Y_test,
+                                    )
+
+    print(training_method, n_sample)
+    print(train_metrics)
+    print(test_metrics)
+
+    out = {
+        'dataset': 'CIFAR',
+        'training_method': training_method,
+        'activation': activation,
+        'hidden_dim': hidden_dim,
+        'n_blocks': n_blocks,
+        'n_sample': n_sample,
+        'ensemble_members': ensemble_members if training_method in ["forward_projection", "random", ] else 1,
+        'train_auc': train_metrics[0].item(),
+        'train_acc': train_metrics[1].item(),
+        'test_auc': test_metrics[0].item(),
+        'test_acc': test_metrics[1].item(),
+        'training_time': training_time,
+    }
+    return out
+
+
 conv2d_experiments = []
 for dataset_i in ['CIFAR10']:
 
@@ -2329,131 +4841,30 @@ for dataset_i in ['CIFAR10']:
     n_blocks = 4
     hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
     activation = "relu"
-    train_folds = folds != 0
-    val_folds = torch.logical_not(train_folds)
-
-    X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-    Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
+    train_idx, val_idx = fold_indices(folds, 0)
 
     n_classes = 2
-    selected_idx = Y_train[:, :n_classes].sum(dim=1) > 0
-    X_train = X_train[selected_idx]
-    Y_train = Y_train[selected_idx][:, :n_classes]
-    selected_idx = Y_val[:, :n_classes].sum(dim=1) > 0
-    X_val = X_val[selected_idx]
-    Y_val = Y_val[selected_idx][:, :n_classes]
+    train_idx = train_idx[Y_trainval[train_idx, :n_classes].sum(dim=1) > 0]
+    val_idx = val_idx[Y_trainval[val_idx, :n_classes].sum(dim=1) > 0]
+    train_data = DataSplit(X_trainval, Y_trainval[:, :n_classes], train_idx)
+    val_data = DataSplit(X_trainval, Y_trainval[:, :n_classes], val_idx)
     selected_idx = Y_test[:, :n_classes].sum(dim=1) > 0
     X_test = X_test[selected_idx]
     Y_test = Y_test[selected_idx][:, :n_classes]
 
-    for experiment_parameters_i in range(len(experiment_parameters)):
-
-        print(dataset_i, experiment_parameters_i)
-
-        rep = experiment_parameters.rep[experiment_parameters_i]
-        n_sample = experiment_parameters.n_sample[experiment_parameters_i]
-
-        for training_method in all_training_methods:
-
-            n_train = round(n_sample * 0.8)
-            n_val = n_sample - n_train
-
-            X_train_s, Y_train_s = subsample_dataset(X_train,
-                                                    Y_train,
-                                                    n_sample=n_train)
-            X_val_s, Y_val_s = subsample_dataset(X_train,
-                                                Y_train,
-                                                n_sample=n_val)
-
-            if training_method in ["forward_projection", "random", ]:
-
-                X_trainval_s = torch.concatenate([X_train_s, X_val_s])
-                Y_trainval_s = torch.concatenate([Y_train_s, Y_val_s])
-
-                w_list, _, _, training_time = train_forward_conv2d(x=X_trainval_s,
-                                                                  y=Y_trainval_s,
-                                                                  training_method=training_method,
-                                                                  hidden_dim=hidden_dim,
-                                                                  activation=activation,
-                                                                  n_blocks=n_blocks,
-                                                                  device=device,
-                                                                  reg_factor=10,
-                                                                  reduce_factor=0.01,
-                                                                  batch_size=25,
-                                                                  pad=True,
-                                                                  verbose=False
-                                                                  )
-                train_metrics = evaluate_forward_conv2d(x=X_trainval_s,
-                                                        y=Y_trainval_s,
-                                                        w_list=w_list,
-                                                        activation=activation,
-                                                        batch_size=50,
-                                                        pad=True,
-                                                        )
-                test_metrics = evaluate_forward_conv2d(x=X_test,
-                                                      y=Y_test,
-                                                      w_list=w_list,
-                                                      activation=activation,
-                                                      batch_size=50,
-                                                        pad=True,)
-
-
-            else:
-
-                model, training_time, training_epochs = train_sgd_conv2d(
-                    X_train=X_train_s.transpose(1, -1),
-                    Y_train=Y_train_s,
-                    X_val=X_val_s.transpose(1, -1),
-                    Y_val=Y_val_s,
-                    hidden_dims=hidden_dims,
-                    activation=activation,
-                    training_method=training_method,
-                    lr=0.0001,
-                    batch_size=25,
-                    patience=10,
-                    pad=1,
-                    verbose=False)
-
-                train_metrics = evaluate_sgd(model=model,
-                                            x=X_train_s.transpose(1, -1),
-                                            y=Y_train_s,
-                                            )
-
-                val_metrics = evaluate_sgd(model=model,
-                                          x=X_val_s.transpose(1, -1),
-                                          y=Y_val_s,
-                                          )
-
-                test_metrics = evaluate_sgd(model=model,
-                                            x=X_test.transpose(1, -1),
-                                            y=Y_test,
-                                            )
-
-            print(training_method, n_sample)
-            print(train_metrics)
-            print(test_metrics)
-
-            out = {
-                'dataset': 'CIFAR',
-                'training_method': training_method,
-                'activation': activation,
-                'hidden_dim': hidden_dim,
-                'n_blocks': n_blocks,
-                'n_sample': n_sample,
-                'train_auc': train_metrics[0].item(),
-                'train_acc': train_metrics[1].item(),
-                'test_auc': test_metrics[0].item(),
-                'test_acc': test_metrics[1].item(),
-                'training_time': training_time,
-            }
-            conv2d_experiments.append(out)
-
-
-
-
-  conv2d_experiments = pd.DataFrame(conv2d_experiments)
-  output_file = os.path.join(output_dir, "conv2d_cifar_experiments.csv")
-  conv2d_experiments.to_csv(path_or_buf=output_file)
+    # the module level model settings are part of the row keys of the store
+    grid_settings = dict(hidden_dim=hidden_dim, n_blocks=n_blocks, activation=activation,
+                         ensemble_members=ensemble_members)
+    store_file = os.path.join(store_dir, f"conv2d_cifar_experiments_{dataset_i}.jsonl")
+    conv2d_experiments.append(run_experiment_grid(conv2d_cifar_fewshot_experiment,
+                                                  experiment_parameters,
+                                                  store_file=store_file,
+                                                  seed=seed,
+                                                  settings=grid_settings))
+
+conv2d_experiments = pd.concat(conv2d_experiments, ignore_index=True)
+output_file = os.path.join(output_dir, "conv2d_cifar_experiments.csv")
+conv2d_experiments.to_csv(path_or_buf=output_file)
 
 # </editor-fold>
 
@@ -2595,7 +5006,8 @@ def train_forward_transformer(x,
                               reg_factor=10.,
                               training_method="forward_projection",
                               verbose=False,
-                              device=device):
+                              device=device,
+                              train_accumulator=None):
     """
     Train a transformer model using ridge regression for weights.
 
@@ -2613,11 +5025,14 @@ def train_forward_transformer(x,
         return_qu (bool): Whether to return projection matrices.
         verbose (bool): Whether to print progress.
         device (str): Device to use for training.
+        train_accumulator (MetricAccumulator): Optional accumulator that receives the output layer
+            predictions on x, so training metrics need no extra forward pass.
 
     Returns:
         dict: Dictionary containing trained weights and training time.
     """
     with torch.no_grad():
+        x, y = as_split(x, y).gather()
         if y.ndim == 2:
             y = torch.unsqueeze(y, dim=1)
 
@@ -2702,91 +5117,111 @@ def train_forward_transformer(x,
 
         w_list = [w_embedding, w_query_list, w_key_list, w_value_list, w_mlp_list, w_out]
 
+        # training set predictions from the pooled features, argmax of the +-1 targets gives the labels
+        if train_accumulator is not None:
+            for x_i, y_i in zip(x_batches, y_batches):
+                train_accumulator.update(x_i @ w_out, y_i)
+
         # Return weights and training time
         return w_list, training_time
 
 
-def evaluate_forward_transformer(x,
-                                 y,
-                                 w_list,
-                                 patch_size,
-                                 activation="relu",
-                                 batch_size=100,
-                                 global_layer="average",
-                                 device="cpu"):
+def predict_forward_transformer(x_i,
+                                w_list,
+                                patch_size,
+                                activation="relu",
+                                global_layer="average",
+                                device="cpu"):
     """
-    Evaluate a trained transformer model.
+    Apply a trained transformer model to one batch.
 
     Args:
-        x (torch.Tensor): Input tensor of shape (n_samples, height, width, channels).
-        y (torch.Tensor): Target tensor of shape (n_samples, num_classes).
-        w_query_list (list): List of query weight matrices for each attention layer.
-        w_key_list (list): List of key weight matrices for each attention layer.
-        w_value_list (list): List of value weight matrices for each attention layer.
-        w_mlp_list (list): List of MLP weight matrices for each layer.
-        w_out (torch.Tensor): Output layer weight matrix.
+        x_i (torch.Tensor): Input tensor of shape (batch_size, height, width, channels).
+        w_list (list): Weights returned by train_forward_transformer.
         patch_size (int): Size of patches to extract.
         activation (str): Activation function to use.
-        batch_size (int): Batch size for evaluation.
         global_layer (str): Global pooling method ("average" or "flatten").
         device (str): Device to use for evaluation.
 
     Returns:
-        torch.Tensor: Evaluation metrics.
+        torch.Tensor: Predictions of shape (batch_size, 1, num_classes).
     """
     w_embedding, w_query_list, w_key_list, w_value_list, w_mlp_list, w_out = w_list
 
     with torch.no_grad():
-        if y.ndim == 2:
-            y = torch.unsqueeze(y, dim=1)
-
-        start_time = time.perf_counter()
         activation_fn = activation_dict[activation]
-        height, width = x.shape[1:3]
-        num_patches_height = height // patch_size
+        num_patches_height = x_i.shape[1] // patch_size
 
         # Step 1: Extract patches
-        x = x.permute(0, 3, 1, 2)  # Convert to (n, channels, height, width)
-        x = extract_patches(x, patch_size)
+        x_i = x_i.to(device).permute(0, 3, 1, 2)  # Convert to (n, channels, height, width)
+        x_i = extract_patches(x_i, patch_size)
 
         # Step 2: Add positional encoding
         positional_encoding = torch.linspace(-1, 1, num_patches_height)[:, None].repeat((1, num_patches_height))
         positional_encoding = torch.stack([positional_encoding.T, positional_encoding])
         positional_encoding = positional_encoding.flatten(start_dim=1).T[None, ...]
-        x = add_positional_encoding(x, positional_encoding)
-
-        # Step 3: Split into batches
-        x_batches = list(torch.split(x, split_size_or_sections=batch_size))
-        y_batches = list(torch.split(y, split_size_or_sections=batch_size))
+        x_i = add_positional_encoding(x_i, positional_encoding)
 
-        # Step 4: embedding layer
-        x_batches = [activation_fn(x_i @ w_embedding) for x_i in x_batches]
+        # Step 3: embedding layer
+        x_batches = [activation_fn(x_i @ w_embedding)]
 
-        # Step 5: attention layers
+        # Step 4: attention layers
         n_attn_layers = len(w_query_list)
         for layer in range(n_attn_layers):
             # Apply multi-head attention
-            w_query = w_query_list[layer]
-            w_key = w_key_list[layer]
-            w_value = w_value_list[layer]
-            x_batches = multi_head_attention(x_batches, w_query, w_key, w_value)
+            x_batches = multi_head_attention(x_batches, w_query_list[layer], w_key_list[layer], w_value_list[layer])
 
             # Apply MLP weights
             x_batches = [concatenate_ones(x_i) for x_i in x_batches]
-            w_mlp = w_mlp_list[layer]
-            x_batches = [activation_fn(x_i @ w_mlp) for x_i in x_batches]
+            x_batches = [activation_fn(x_i @ w_mlp_list[layer]) for x_i in x_batches]
 
-        # Step 6: Apply output layer
-        for i in range(len(x_batches)):
-            x_batches[i] = concatenate_ones(x_batches[i])
-            if global_layer == "flatten":
-                x_batches[i] = x_batches[i].flatten(start_dim=1)[:, None, :]
-            else:
-                x_batches[i] = torch.mean(x_batches[i], dim=1, keepdim=True)
-            y_batches[i] = 2 * y_batches[i] - 1
-        yhat = [x_i @ w_out for x_i in x_batches]
-        yhat = torch.concatenate(yhat)
-        metrics = compute_metrics(yhat, y)
+        # Step 5: Apply output layer
+        x_i = concatenate_ones(x_batches[0])
+        if global_layer == "flatten":
+            x_i = x_i.flatten(start_dim=1)[:, None, :]
+        else:
+            x_i = torch.mean(x_i, dim=1, keepdim=True)
+        yhat_i = x_i @ w_out
+
+    return yhat_i
+
+
+def evaluate_forward_transformer(x,
+                                 y,
+                                 w_list,
+                                 patch_size,
+                                 activation="relu",
+                                 batch_size=100,
+                                 global_layer="average",
+                                 device="cpu",
+                                 split_masks=None):
+    """
+    Evaluate a trained transformer model.
+
+    Args:
+        x (torch.Tensor): Input tensor of shape (n_samples, height, width, channels).
+        y (torch.Tensor): Target tensor of shape (n_samples, num_classes).
+        w_list (list): Weights returned by train_forward_transformer.
+        patch_size (int): Size of patches to extract.
+        activation (str): Activation function to use.
+        batch_size (int): Batch size for evaluation.
+        global_layer (str): Global pooling method ("average" or "flatten").
+        device (str): Device to use for evaluation.
+        split_masks (dict): Optional boolean masks or index tensors over the rows of x. All splits are
+            evaluated in one forward pass.
+
+    Returns:
+        torch.Tensor: Evaluation metrics, or a dictionary of metrics per split when split_masks is given.
+    """
+    def predict_fn(x_i):
+        return predict_forward_transformer(x_i,
+                                           w_list,
+                                           patch_size,
+                                           activation=activation,
+                                           global_layer=global_layer,
+                                           device=device)
+
+    metrics = evaluate_splits(predict_fn, x, y, split_masks=split_masks, batch_size=batch_size)
 
     return metrics
 
@@ -2801,12 +5236,8 @@ model_parameters = expand_grid({
     'activation': ["relu"],
 })
 verbose = True
-
 seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
-forward_conv1d_experiments = []
+
 dataset_i = "CIFAR10"
 n_classes = 2
 print(dataset_i)
@@ -2830,19 +5261,10 @@ n_ViT_layers = 4
 mlp_dim = 64
 global_layer = "average"
 attn_softmax = True
-experiments = []
-for model_parameters_i in range(len(model_parameters)):
-
-    print(model_parameters_i)
 
-    training_method = model_parameters.training_method[model_parameters_i]
-    fold = model_parameters.fold[model_parameters_i]
-    activation = model_parameters.activation[model_parameters_i]
 
-    train_folds = folds != fold
-    val_folds = torch.logical_not(train_folds)
-    X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-    Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
+def forward_vit_experiment(fold, training_method, activation):
+    train_idx, val_idx = fold_indices(folds, fold)
 
     w_list, training_time = train_forward_transformer(x=X_trainval,
                                                       y=Y_trainval,
@@ -2855,20 +5277,15 @@ for model_parameters_i in range(len(model_parameters)):
                                                       num_heads=num_heads,
                                                       global_layer=global_layer
                                                       )
-    train_metrics = evaluate_forward_transformer(x=X_train,
-                                                 y=Y_train,
+    split_metrics = evaluate_forward_transformer(x=X_trainval,
+                                                 y=Y_trainval,
                                                  w_list=w_list,
                                                  patch_size=patch_size,
                                                  device=device,
                                                  activation=activation,
-                                                 global_layer=global_layer)
-    val_metrics = evaluate_forward_transformer(x=X_val,
-                                               y=Y_val,
-                                               w_list=w_list,
-                                               patch_size=patch_size,
-                                               device=device,
-                                               activation=activation,
-                                               global_layer=global_layer)
+                                                 global_layer=global_layer,
+                                                 split_masks={"train": train_idx, "val": val_idx})
+    train_metrics, val_metrics = split_metrics["train"], split_metrics["val"]
     test_metrics = evaluate_forward_transformer(x=X_test,
                                                 y=Y_test,
                                                 w_list=w_list,
@@ -2909,8 +5326,14 @@ for model_parameters_i in range(len(model_parameters)):
         'test_f1': test_metrics[4].item(),
         'training_time': training_time,
     }
-    experiments.append(out)
-experiments = pd.DataFrame(experiments)
+    return out
+
+
+store_file = os.path.join(store_dir, "forward_vit_experiments.jsonl")
+experiments = run_experiment_grid(forward_vit_experiment,
+                                  model_parameters,
+                                  store_file=store_file,
+                                  seed=seed)
 output_file = os.path.join(output_dir, "forward_vit_experiments.csv")
 experiments.to_csv(path_or_buf=output_file)
 
@@ -3021,64 +5444,92 @@ def train_sgd_vit(X_train,
                      verbose=False,
                      device=device,
                      training_method="backprop",
-                     loss_fn=torch.nn.CrossEntropyLoss()):
-    torch.cuda.empty_cache()
+                     loss_fn=torch.nn.CrossEntropyLoss(),
+                     refit="retrain",
+                     refit_epochs=1,
+                     snapshot="memory",
+                     validate_every=1,
+                     validate_seconds=None,
+                     val_subsample=None,
+                     min_delta_se=0.,
+                     precision=None,
+                     channels_last=None):
+    trim_cuda_cache("experiment")
     start_time = time.perf_counter()
 
-    model = ViTModel(
-        n_classes=Y_train.shape[1],
-        num_heads=num_heads,
-        patch_size=patch_size,
-        embed_dim=embed_dim,
-        mlp_dim=mlp_dim,
-        n_ViT_layers=n_ViT_layers,
-        training_method=training_method,
-    ).to(device)
-    train_loss = []
-    val_loss = []
-    best_val_loss = torch.inf
-    patience_counter = 0
-    for epoch_i in range(max_epochs):
-        train_loss_i = train_sgd(model=model,
-                                 x=X_train,
-                                 y=Y_train,
-                                 loss_fn=loss_fn,
-                                 batch_size=batch_size
-                                 )
-        train_loss.append(train_loss_i.item())
-        val_loss_i = validate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  loss_fn=loss_fn,
-                                  batch_size=batch_size)
-        val_loss.append(val_loss_i.item())
-        if verbose:
-            print(val_loss_i)
-        if val_loss_i < best_val_loss:
-            best_val_loss = val_loss_i
-            patience_counter = 0
-        else:
-            patience_counter += 1
-        if patience_counter == (patience - 1):
-            break
+    def new_model():
+        model = ViTModel(
+            n_classes=as_split(X_train, Y_train).num_classes,
+            num_heads=num_heads,
+            patch_size=patch_size,
+            embed_dim=embed_dim,
+            mlp_dim=mlp_dim,
+            n_ViT_layers=n_ViT_layers,
+            training_method=training_method,
+        ).to(device)
+        return configure_sgd_model(model, precision, channels_last)
+    model = new_model()
+    # snapshots are only taken when the refit policy uses them
+    stopper, epoch_i, train_loss, val_loss = fit_sgd_early_stopping(
+        model, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+        patience=patience,
+        max_epochs=max_epochs,
+        snapshot=snapshot if refit in ["best", "warm_start"] else None,
+        verbose=verbose,
+        validate_every=validate_every,
+        validate_seconds=validate_seconds,
+        val_subsample=val_subsample,
+        min_delta_se=min_delta_se)
 
     end_time = time.perf_counter()
     training_time = end_time - start_time
     training_epochs = epoch_i
 
-    model = ViTModel().to(device)
-    print("final training")
-    X_trainval = torch.concatenate([X_train, X_val])
-    Y_trainval = torch.concatenate([Y_train, Y_val])
-    for _ in range(epoch_i):
-        _ = train_sgd(model=model,
-                      x=X_trainval,
-                      y=Y_trainval,
-                      loss_fn=loss_fn,
-                      batch_size=batch_size)
+    model = refit_sgd(model, new_model, stopper, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+                      n_epochs=epoch_i, refit=refit, refit_epochs=refit_epochs)
 
     return model, training_time, training_epochs
 
+
+'''
+trains the backprop ViT models of several splits (X_train, Y_train, X_val, Y_val) in lock-step with
+train_sgd_stacked, with the model and refit policy of train_sgd_vit
+'''
+def train_sgd_vit_stacked(splits,
+                          patience=5,
+                          max_epochs=25,
+                          batch_size=25,
+                          embed_dim=64,
+                          mlp_dim=64,
+                          num_heads=8,
+                          n_ViT_layers=4,
+                          patch_size=4,
+                          verbose=False,
+                          training_method="backprop",
+                          loss_fn=torch.nn.CrossEntropyLoss(),
+                          refit="retrain",
+                          precision=None,
+                          channels_last=None):
+    X_train, Y_train, _, _ = splits[0]
+    def new_model():
+        model = ViTModel(
+            n_classes=as_split(X_train, Y_train).num_classes,
+            num_heads=num_heads,
+            patch_size=patch_size,
+            embed_dim=embed_dim,
+            mlp_dim=mlp_dim,
+            n_ViT_layers=n_ViT_layers,
+            training_method=training_method,
+        ).to(device)
+        return configure_sgd_model(model, precision, channels_last)
+    return train_sgd_stacked(new_model, splits,
+                             patience=patience,
+                             max_epochs=max_epochs,
+                             batch_size=batch_size,
+                             verbose=verbose,
+                             loss_fn=loss_fn,
+                             refit=refit)
+
 # </editor-fold>
 
 #@title SGD ViT experiments
@@ -3091,12 +5542,8 @@ model_parameters = expand_grid({
 })
 
 verbose = False
-
 seed = 0
-random.seed(seed)
-torch.manual_seed(seed)
-np.random.seed(seed)
-experiments = []
+
 dataset_i = "CIFAR10"
 
 print(dataset_i)
@@ -3111,45 +5558,58 @@ selected_idx = Y_test[:, :n_classes].any(dim=(1,))
 X_test = X_test[selected_idx]
 Y_test = Y_test[selected_idx][:, :n_classes]
 
-for model_parameters_i in range(len(model_parameters)):
-    print(model_parameters_i)
 
-    fold = model_parameters.fold[model_parameters_i]
-    activation = model_parameters.activation[model_parameters_i]
-    training_method = model_parameters.training_method[model_parameters_i]
+def sgd_vit_experiment(fold, activation, training_method):
     embed_dim = 64
     mlp_dim = 64
     n_ViT_layers = 4
     num_heads = 8
     patch_size = 4
 
-    train_folds = folds != fold
-    val_folds = torch.logical_not(train_folds)
-    X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-    Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
-
-    model, training_time, training_epochs = train_sgd_vit(
-        X_train=X_train,
-        Y_train=Y_train,
-        X_val=X_val,
-        Y_val=Y_val,
-        max_epochs=50,
-        batch_size=25,
-        patch_size=patch_size,
-        embed_dim=embed_dim,
-        mlp_dim=mlp_dim,
-        n_ViT_layers=n_ViT_layers,
-        num_heads=num_heads,
-        verbose=True)
+    train_idx, val_idx = fold_indices(folds, fold)
+    train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+    val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+    if sgd_stacked_folds and training_method == "backprop":
+        def train_folds():
+            splits = [(DataSplit(X_trainval, Y_trainval, train_idx_k), None,
+                       DataSplit(X_trainval, Y_trainval, val_idx_k), None)
+                      for train_idx_k, val_idx_k in [fold_indices(folds, k) for k in range(len(folds.unique()))]]
+            return train_sgd_vit_stacked(splits,
+                                         max_epochs=50,
+                                         batch_size=25,
+                                         patch_size=patch_size,
+                                         embed_dim=embed_dim,
+                                         mlp_dim=mlp_dim,
+                                         n_ViT_layers=n_ViT_layers,
+                                         num_heads=num_heads,
+                                         verbose=True)
+        (model, training_time, training_epochs), n_stacked_models = stacked_fold_fit(
+            ("vit", dataset_i, embed_dim, mlp_dim, n_ViT_layers, num_heads, patch_size), fold, train_folds)
+    else:
+        model, training_time, training_epochs = train_sgd_vit(
+            X_train=train_data,
+            Y_train=None,
+            X_val=val_data,
+            Y_val=None,
+            max_epochs=50,
+            batch_size=25,
+            patch_size=patch_size,
+            embed_dim=embed_dim,
+            mlp_dim=mlp_dim,
+            n_ViT_layers=n_ViT_layers,
+            num_heads=num_heads,
+            verbose=True)
+        n_stacked_models = 1
 
     train_metrics = evaluate_sgd(model=model,
-                                  x=X_train,
-                                  y=Y_train,
+                                  x=train_data,
+                                  y=None,
                                   )
 
     val_metrics = evaluate_sgd(model=model,
-                                x=X_val,
-                                y=Y_val,
+                                x=val_data,
+                                y=None,
                                 )
 
     test_metrics = evaluate_sgd(model=model,
@@ -3189,10 +5649,18 @@ for model_parameters_i in range(len(model_parameters)):
         'test_f1': test_metrics[4].item(),
         'training_time': training_time,
         'training_epochs': training_epochs,
+        'n_stacked_models': n_stacked_models,
     }
-    experiments.append(out)
+    return out
+
 
-experiments = pd.DataFrame(experiments)
+# stacked rows are stored under their own keys, training_time is then the wall time of all n_stacked_models
+store_file = os.path.join(store_dir, "sgd_vit_experiments.jsonl")
+experiments = run_experiment_grid(sgd_vit_experiment,
+                                  model_parameters,
+                                  store_file=store_file,
+                                  seed=seed,
+                                  settings=dict(sgd_stacked_folds=True) if sgd_stacked_folds else None)
 output_file = os.path.join(output_dir, f"sgd_vit_experiments.csv")
 experiments.to_csv(path_or_buf=output_file)
 
@@ -3209,13 +5677,99 @@ if True:
 
   experiment_parameters = expand_grid({
       'rep': list(range(5)),
-      'n_sample': [1000]
+      'n_sample': [1000],
+      'training_method': all_training_methods,
   })
 
   seed = 0
-  random.seed(seed)
-  torch.manual_seed(seed)
-  np.random.seed(seed)
+
+
+  def conv2d_cifar_10class_experiment(rep, n_sample, training_method):
+      n_train = round(n_sample * 0.8)
+      n_val = n_sample - n_train
+
+      train_s = subsample_dataset(train_data, y=None, n_sample=n_train)
+      val_s = subsample_dataset(train_data, y=None, n_sample=n_val)
+
+      if training_method in ["forward_projection", "random", ]:
+
+          trainval_s = DataSplit.concatenate([train_s, val_s])
+
+          train_accumulator = MetricAccumulator(num_classes=trainval_s.num_classes)
+          w_list, _, _, training_time = train_forward_conv2d(x=trainval_s,
+                                                            y=None,
+                                                            training_method=training_method,
+                                                            hidden_dim=hidden_dim,
+                                                            activation=activation,
+                                                            n_blocks=n_blocks,
+                                                            device=device,
+                                                            reg_factor=10,
+                                                            reduce_factor=0.01,
+                                                            batch_size=25,
+                                                            pad=True,
+                                                            verbose=False,
+                                                            train_accumulator=train_accumulator
+                                                            )
+          train_metrics = train_accumulator.compute()
+          test_metrics = evaluate_forward_conv2d(x=X_test,
+                                                y=Y_test,
+                                                w_list=w_list,
+                                                activation=activation,
+                                                batch_size=50,
+                                                pad=True,)
+
+
+      else:
+
+          model, training_time, training_epochs = train_sgd_conv2d(
+              X_train=channels_first_view(train_s),
+              Y_train=None,
+              X_val=channels_first_view(val_s),
+              Y_val=None,
+              hidden_dims=hidden_dims,
+              activation=activation,
+              training_method=training_method,
+              lr=0.0001,
+              batch_size=25,
+              patience=10,
+              pad=1,
+              verbose=False)
+
+          train_metrics = evaluate_sgd(model=model,
+                                      x=channels_first_view(train_s),
+                                      y=None,
+                                      )
+
+          val_metrics = evaluate_sgd(model=model,
+                                    x=channels_first_view(val_s),
+                                    y=None,
+                                    )
+
+          test_metrics = evaluate_sgd(model=model,
+                                      x=channels_first_view(X_test),
+                                      y=Y_test,
+                                      )
+
+      print(training_method, n_sample)
+      print(train_metrics)
+      print(test_metrics)
+
+      out = {
+          'dataset': dataset_i,
+          'training_method': training_method,
+          'activation': activation,
+          'hidden_dim': hidden_dim,
+          'n_blocks': n_blocks,
+          'n_sample': n_sample,
+          'train_auc': train_metrics[0].item(),
+          'train_acc': train_metrics[1].item(),
+          'test_auc': test_metrics[0].item(),
+          'test_acc': test_metrics[1].item(),
+          'training_time': training_time,
+      }
+      return out
+
+
   conv2d_experiments = []
   for dataset_i in ['CIFAR10']:
 
@@ -3226,127 +5780,21 @@ if True:
       n_blocks = 4
       hidden_dims = [hidden_dim * 2 ** (i // 2) for i in range(n_blocks * 2)]
       activation = "relu"
-      train_folds = folds != 0
-      val_folds = torch.logical_not(train_folds)
-      X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-      Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
-
-      for experiment_parameters_i in range(len(experiment_parameters)):
-
-          print(dataset_i, experiment_parameters_i)
-          rep = experiment_parameters.rep[experiment_parameters_i]
-          n_sample = experiment_parameters.n_sample[experiment_parameters_i]
-          conv2d_experiments_i = []
-
-
-          for training_method in all_training_methods:
-
-              n_train = round(n_sample * 0.8)
-              n_val = n_sample - n_train
-
-              X_train_s, Y_train_s = subsample_dataset(X_train,
-                                                      Y_train,
-                                                      n_sample=n_train)
-              X_val_s, Y_val_s = subsample_dataset(X_train,
-                                                  Y_train,
-                                                  n_sample=n_val)
-
-             # try:
-
-              if training_method in ["forward_projection", "random", ]:
-
-                  X_trainval_s = torch.concatenate([X_train_s, X_val_s])
-                  Y_trainval_s = torch.concatenate([Y_train_s, Y_val_s])
-
-                  w_list, _, _, training_time = train_forward_conv2d(x=X_trainval_s,
-                                                                    y=Y_trainval_s,
-                                                                    training_method=training_method,
-                                                                    hidden_dim=hidden_dim,
-                                                                    activation=activation,
-                                                                    n_blocks=n_blocks,
-                                                                    device=device,
-                                                                    reg_factor=10,
-                                                                    reduce_factor=0.01,
-                                                                    batch_size=25,
-                                                                    pad=True,
-                                                                    verbose=False
-                                                                    )
-                  train_metrics = evaluate_forward_conv2d(x=X_trainval_s,
-                                                          y=Y_trainval_s,
-                                                          w_list=w_list,
-                                                          activation=activation,
-                                                          batch_size=50,
-                                                          pad=True,
-                                                          )
-                  test_metrics = evaluate_forward_conv2d(x=X_test,
-                                                        y=Y_test,
-                                                        w_list=w_list,
-                                                        activation=activation,
-                                                        batch_size=50,
-                                                          pad=True,)
-
-
-              else:
-
-                  model, training_time, training_epochs = train_sgd_conv2d(
-                      X_train=X_train_s.transpose(1, -1),
-                      Y_train=Y_train_s,
-                      X_val=X_val_s.transpose(1, -1),
-                      Y_val=Y_val_s,
-                      hidden_dims=hidden_dims,
-                      activation=activation,
-                      training_method=training_method,
-                      lr=0.0001,
-                      batch_size=25,
-                      patience=10,
-                      pad=1,
-                      verbose=False)
-
-                  train_metrics = evaluate_sgd(model=model,
-                                              x=X_train_s.transpose(1, -1),
-                                              y=Y_train_s,
-                                              )
-
-                  val_metrics = evaluate_sgd(model=model,
-                                            x=X_val_s.transpose(1, -1),
-                                            y=Y_val_s,
-                                            )
-
-                  test_metrics = evaluate_sgd(model=model,
-                                              x=X_test.transpose(1, -1),
-                                              y=Y_test,
-                                              )
-
-              print(training_method, n_sample)
-              print(train_metrics)
-              print(test_metrics)
-
-              out = {
-                  'dataset': dataset_i,
-                  'training_method': training_method,
-                  'activation': activation,
-                  'hidden_dim': hidden_dim,
-                  'n_blocks': n_blocks,
-                  'n_sample': n_sample,
-                  'train_auc': train_metrics[0].item(),
-                  'train_acc': train_metrics[1].item(),
-                  'test_auc': test_metrics[0].item(),
-                  'test_acc': test_metrics[1].item(),
-                  'training_time': training_time,
-              }
-              conv2d_experiments.append(out)
-              conv2d_experiments_i.append(out)
-
-              #except:
-               # pass
-
-          if False:
-            conv2d_experiments_i = pd.DataFrame(conv2d_experiments_i)
-            timenow = datetime.now().strftime("%Y-%m-%d %H%M%S")
-            output_file = os.path.join(output_dir, f"conv2d_cifar_experiments_rep{rep}_{timenow}.csv")
-            conv2d_experiments_i.to_csv(path_or_buf=output_file)
-
-  conv2d_experiments = pd.DataFrame(conv2d_experiments)
+      train_idx, val_idx = fold_indices(folds, 0)
+      train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+      val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+      # every finished (rep, method) is kept in the store, so an interrupted run can be resumed. the module level
+      # model settings are part of the row keys of the store
+      grid_settings = dict(hidden_dim=hidden_dim, n_blocks=n_blocks, activation=activation)
+      store_file = os.path.join(store_dir, f"conv2d_cifar_experiments_10class_1k_{dataset_i}.jsonl")
+      conv2d_experiments.append(run_experiment_grid(conv2d_cifar_10class_experiment,
+                                                    experiment_parameters,
+                                                    store_file=store_file,
+                                                    seed=seed,
+                                                    settings=grid_settings))
+
+  conv2d_experiments = pd.concat(conv2d_experiments, ignore_index=True)
 
   timenow = datetime.now().strftime("%Y-%m-%d %H%M%S")
   output_file = os.path.join(output_dir, f"conv2d_cifar_experiments_10class_1k_{timenow}.csv")
@@ -3426,11 +5874,15 @@ class mlpModel(nn.Module):
         yhats.append(self.layers[-1](x))
         return yhats
 
-    def forward_ff(self, xy):
+    def forward_ff(self, xy, ys=None):
+        # with ys, xy holds the inputs alone and is scored under every label set in ys (k, n, c)
         goodnesses = []
-        for layer_l in self.layers[:-1]:
-            xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
-            xy = layer_l(xy)
+        for l, layer_l in enumerate(self.layers[:-1]):
+            if l == 0 and ys is not None:
+                xy = ff_label_injection(layer_l, xy, ys)
+            else:
+                xy = xy / (xy.norm(dim=1, keepdim=True) + 0.001)
+                xy = layer_l(xy)
             xy = self.activation_fn(xy)
             goodness_l = xy.square().mean(dim=1)
             goodnesses.append(goodness_l)
@@ -3509,50 +5961,49 @@ def train_sgd_mlp(X_train,
                   max_epochs=100,
                   batch_size=50,
                   verbose=False,
-                  loss_fn=torch.nn.CrossEntropyLoss()):
-    torch.cuda.empty_cache()
+                  loss_fn=torch.nn.CrossEntropyLoss(),
+                  refit="last",
+                  refit_epochs=1,
+                  snapshot="memory",
+                  validate_every=1,
+                  validate_seconds=None,
+                  val_subsample=None,
+                  min_delta_se=0.,
+                  precision=None):
+    trim_cuda_cache("experiment")
     start_time = time.perf_counter()
     activation_fn = activation_dict[activation]
 
     in_features = X_train.shape[1]
-    model = mlpModel(
-        training_method=training_method,
-        in_features=in_features,
-        hidden_dims=hidden_dims,
-        num_classes=Y_train.shape[1],
-        activation_fn=activation_fn,
-    ).to(device)
-    train_loss = []
-    val_loss = []
-    best_val_loss = torch.inf
-    patience_counter = 0
-    for epoch_i in range(max_epochs):
-        train_loss_i = train_sgd(model=model,
-                                 x=X_train,
-                                 y=Y_train,
-                                 loss_fn=loss_fn,
-                                 batch_size=batch_size)
-        train_loss.append(train_loss_i.item())
-        val_loss_i = validate_sgd(model=model,
-                                  x=X_val,
-                                  y=Y_val,
-                                  loss_fn=loss_fn,
-                                  batch_size=batch_size)
-        val_loss.append(val_loss_i.item())
-        if verbose:
-            print(val_loss_i)
-        if val_loss_i < best_val_loss:
-            best_val_loss = val_loss_i
-            patience_counter = 0
-        else:
-            patience_counter += 1
-        if patience_counter == (patience - 1):
-            break
+    def new_model():
+        model = mlpModel(
+            training_method=training_method,
+            in_features=in_features,
+            hidden_dims=hidden_dims,
+            num_classes=as_split(X_train, Y_train).num_classes,
+            activation_fn=activation_fn,
+        ).to(device)
+        return configure_sgd_model(model, precision)
+    model = new_model()
+    # snapshots are only taken when the refit policy uses them
+    stopper, epoch_i, train_loss, val_loss = fit_sgd_early_stopping(
+        model, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+        patience=patience,
+        max_epochs=max_epochs,
+        snapshot=snapshot if refit in ["best", "warm_start"] else None,
+        verbose=verbose,
+        validate_every=validate_every,
+        validate_seconds=validate_seconds,
+        val_subsample=val_subsample,
+        min_delta_se=min_delta_se)
 
     end_time = time.perf_counter()
     training_time = end_time - start_time
     training_epochs = epoch_i
 
+    model = refit_sgd(model, new_model, stopper, X_train, Y_train, X_val, Y_val, loss_fn, batch_size,
+                      n_epochs=epoch_i, refit=refit, refit_epochs=refit_epochs)
+
     return model, training_time, training_epochs
 
 # </editor-fold>
@@ -3573,85 +6024,83 @@ if True:
     tabular_datasets = ["FashionMNIST"]
 
     seed = 0
-    random.seed(seed)
-    torch.manual_seed(seed)
-    np.random.seed(seed)
-    sgd_mlp_experiments = []
     verbose = True
+
+
+    def sgd_mlp_experiment(fold, training_method, activation):
+        train_idx, val_idx = fold_indices(folds, fold)
+        train_data = DataSplit(X_trainval, Y_trainval, train_idx)
+        val_data = DataSplit(X_trainval, Y_trainval, val_idx)
+
+        model, training_time, training_epochs = train_sgd_mlp(X_train=train_data,
+                                                              Y_train=None,
+                                                              X_val=val_data,
+                                                              Y_val=None,
+                                                              activation=activation,
+                                                              training_method=training_method,
+                                                              hidden_dims=[1000] * 3,
+                                                              batch_size=50,
+                                                              verbose=True,
+                                                              patience=5,
+                                                              max_epochs=100)
+
+        train_metrics = evaluate_sgd(model=model,
+                                    x=train_data,
+                                    y=None,
+                                    )
+
+        val_metrics = evaluate_sgd(model=model,
+                                  x=val_data,
+                                  y=None,
+                                  )
+        test_metrics = evaluate_sgd(model=model,
+                                    x=X_test,
+                                    y=Y_test,
+                                    )
+        if verbose:
+            print(train_metrics)
+            print(val_metrics)
+            print(test_metrics)
+
+        out = {
+            'dataset': dataset_i,
+            'training_method': training_method,
+            'fold': fold,
+            'activation': activation,
+            'train_auc': train_metrics[0].item(),
+            'train_acc': train_metrics[1].item(),
+            'train_prec': train_metrics[2].item(),
+            'train_recall': train_metrics[3].item(),
+            'train_f1': train_metrics[4].item(),
+            'val_auc': val_metrics[0].item(),
+            'val_acc': val_metrics[1].item(),
+            'val_prec': val_metrics[2].item(),
+            'val_recall': val_metrics[3].item(),
+            'val_f1': val_metrics[4].item(),
+            'test_auc': test_metrics[0].item(),
+            'test_acc': test_metrics[1].item(),
+            'test_prec': test_metrics[2].item(),
+            'test_recall': test_metrics[3].item(),
+            'test_f1': test_metrics[4].item(),
+            'training_time': training_time,
+            "training_epochs": training_epochs,
+        }
+        return out
+
+
+    sgd_mlp_experiments = []
     for dataset_i in tabular_datasets:
 
         print(dataset_i)
         X_trainval, Y_trainval, X_test, Y_test, folds = load_dataset(dataset_i)
 
-        for model_parameters_i in range(len(model_parameters)):
-
-            print(model_parameters_i)
-            fold = model_parameters.fold[model_parameters_i]
-            training_method = model_parameters.training_method[model_parameters_i]
-            activation = model_parameters.activation[model_parameters_i]
-
-
-            train_folds = folds != torch.tensor(fold, dtype=torch.float32)
-            val_folds = torch.logical_not(train_folds)
-            X_train, X_val = X_trainval[train_folds], X_trainval[val_folds]
-            Y_train, Y_val = Y_trainval[train_folds], Y_trainval[val_folds]
-
-            model, training_time, training_epochs = train_sgd_mlp(X_train=X_train,
-                                                                  Y_train=Y_train,
-                                                                  X_val=X_val,
-                                                                  Y_val=Y_val,
-                                                                  activation=activation,
-                                                                  training_method=training_method,
-                                                                  hidden_dims=[1000] * 3,
-                                                                  batch_size=50,
-                                                                  verbose=True,
-                                                                  patience=5,
-                                                                  max_epochs=100)
-
-            train_metrics = evaluate_sgd(model=model,
-                                        x=X_train,
-                                        y=Y_train,
-                                        )
-
-            val_metrics = evaluate_sgd(model=model,
-                                      x=X_val,
-                                      y=Y_val,
-                                      )
-            test_metrics = evaluate_sgd(model=model,
-                                        x=X_test,
-                                        y=Y_test,
-                                        )
-            if verbose:
-                print(train_metrics)
-                print(val_metrics)
-                print(test_metrics)
-
-            out = {
-                'dataset': dataset_i,
-                'training_method': training_method,
-                'fold': fold,
-                'activation': activation,
-                'train_auc': train_metrics[0].item(),
-                'train_acc': train_metrics[1].item(),
-                'train_prec': train_metrics[2].item(),
-                'train_recall': train_metrics[3].item(),
-                'train_f1': train_metrics[4].item(),
-                'val_auc': val_metrics[0].item(),
-                'val_acc': val_metrics[1].item(),
-                'val_prec': val_metrics[2].item(),
-                'val_recall': val_metrics[3].item(),
-                'val_f1': val_metrics[4].item(),
-                'test_auc': test_metrics[0].item(),
-                'test_acc': test_metrics[1].item(),
-                'test_prec': test_metrics[2].item(),
-                'test_recall': test_metrics[3].item(),
-                'test_f1': test_metrics[4].item(),
-                'training_time': training_time,
-                "training_epochs": training_epochs,
-            }
-            sgd_mlp_experiments.append(out)
-
-    sgd_mlp_experiments = pd.DataFrame(sgd_mlp_experiments)
+        store_file = os.path.join(store_dir, f"sgd_mlp_experiments_sfp_{dataset_i}.jsonl")
+        sgd_mlp_experiments.append(run_experiment_grid(sgd_mlp_experiment,
+                                                       model_parameters,
+                                                       store_file=store_file,
+                                                       seed=seed))
+
+    sgd_mlp_experiments = pd.concat(sgd_mlp_experiments, ignore_index=True)
     output_file = os.path.join(output_dir, "sgd_mlp_experiments_sfp.csv")
     sgd_mlp_experiments.to_csv(path_or_buf=output_file)
 